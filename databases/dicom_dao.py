@@ -3,19 +3,25 @@
 
 Data Access Objects for persisting PyDicom DataSet objects.
 
-Currently we support couchdb through the DicomCouch class.
+Currently we support couchdb through the DicomCouch class, and
+local directories (SQLite plus blob files, no server needed)
+through the DicomSQLite class. Both implement DicomStore.
 
-Limitations:
- - Private tags are discarded
+Documents are stored either in our own json layout or in the
+DICOM JSON Model (PS3.18 F.2), see DicomCouch.
 
 TODO:
  - Unit tests with multiple objects open at a time
  - Unit tests with rtstruct objects
- - Support for mongodb (mongo has more direct support for binary data)
+ - Support for mongodb (mongo has more direct support for binary data),
+   as another DicomStore
 
 Dependencies:
  - PyDicom
  - python-couchdb
+ - xxhash (optional, for DicomCouch(..., hash_name='xxh64'))
+ - zstandard or lz4 (optional, for DicomCouch(..., codec='zstd')
+   or codec='lz4'; zlib is always available)
 
 Tested with:
  - PyDicom 0.9.4-1
@@ -31,12 +37,41 @@ Tested with:
 #    available at https://github.com/pydicom/pydicom
 #
 
+import base64
+import collections
+import contextlib
+import copy
+import decimal
 import hashlib
+import io
+import json
 import os
-import string
+import sqlite3
+import tempfile
+import zlib
+from urllib.parse import quote
+
 import couchdb
 import pydicom
 
+try:
+    import xxhash
+    have_xxhash = True
+except ImportError:
+    have_xxhash = False
+
+try:
+    import zstandard
+    have_zstandard = True
+except ImportError:
+    have_zstandard = False
+
+try:
+    import lz4.frame
+    have_lz4 = True
+except ImportError:
+    have_lz4 = False
+
 
 def uid2str(uid):
     """ Convert PyDicom uid to a string """
@@ -51,8 +86,223 @@ def uid2str(uid):
 
 BINARY_VR_VALUES = ['OW', 'OB', 'OW/OB', 'US or SS']
 
+# Binary elements are streamed to and from couchdb in chunks of
+# this many bytes, so a transfer never holds more than one chunk
+# on top of the element value itself.
+CHUNK_SIZE = 1024 * 1024
+ATTACHMENT_CONTENT_TYPE = 'application/octet-stream'
+
+# Attachments compressed with codec=... are stored with these
+# content types, so they can be read whatever the setting
+CODEC_CONTENT_TYPES = {
+    'zstd': 'application/zstd',
+    'lz4': 'application/x-lz4',
+    'zlib': 'application/zlib',
+}
+PIXEL_DATA_TAG = pydicom.tag.Tag(0x7fe0, 0x0010)
+
+# Document formats. 'legacy' is our original layout from
+# pydicom2json, 'dicomjson' is the DICOM JSON Model of
+# PS3.18 F.2 from pydicom2dicomjson.
+LEGACY_FORMAT = 'legacy'
+DICOMJSON_FORMAT = 'dicomjson'
+
+# Documents carry our own bookkeeping under this key
+DAO_KEY = 'dicom_dao'
+
+# Legacy format (sequence item) dicts keep the VRs of elements
+# the DICOM dictionary can't give, e.g. private tags, under this key
+VR_KEY = 'vr'
+
+# Attributes DicomCouch.query() can search on, most selective
+# first, with the name of the view that indexes each of them
+QUERY_VIEWS = collections.OrderedDict([
+    ('SeriesInstanceUID', 'by_series_instance_uid'),
+    ('StudyInstanceUID', 'by_study_instance_uid'),
+    ('PatientID', 'by_patient_id'),
+    ('StudyDate', 'by_study_date'),
+    ('Modality', 'by_modality'),
+])
+DESIGN_DOC = '_design/dicom_dao'
+
+# Counts the instances stored for each series
+SERIES_VIEW = 'series_instances'
+
+# Documents hold a whole series or a single instance, keyed by
+SERIES_LEVEL = 'series'
+INSTANCE_LEVEL = 'instance'
+LEVEL_KEYWORDS = {SERIES_LEVEL: 'SeriesInstanceUID',
+                  INSTANCE_LEVEL: 'SOPInstanceUID'}
+
+_VIEW_MAP_FUNCTION = """function(doc) {
+  var value = doc['%(dicomjson)s'];
+  if (value) {
+    value = value.Value ? value.Value[0] : null;
+  } else {
+    value = doc['%(legacy)s'];
+  }
+  if (value !== undefined && value !== null && value !== '') {
+    emit(value, null);
+  }
+}"""
+
+# In DICOM JSON documents binary values up to this many
+# bytes are stored inline rather than as attachments
+BULK_DATA_THRESHOLD = 1024
+
+# With dedup=True binary elements are stored once per distinct
+# value, as the BLOB_ATTACHMENT of a document whose id is
+# BLOB_PREFIX followed by the BLOB_HASH of the value
+BLOB_PREFIX = 'dicom_dao-blob-'
+BLOB_ATTACHMENT = 'value'
+BLOB_HASH = 'sha256'
+
+# Documents read per request when iterating over a store
+PAGE_SIZE = 100
+
+# Seconds a DicomSQLite write waits for another connection's
+# transaction to finish before failing with 'database is locked'
+SQLITE_TIMEOUT = 60
+
+
+class WriteConflict(couchdb.ResourceConflict):
+    """ Raised when documents of a DicomCouch bulk write
+        conflicted with changes made by someone else
+
+    errors maps the keys of those documents to their
+    couchdb errors. Every other document of the write was
+    stored in full, attachments included.
+    """
+
+    def __init__(self, errors):
+        super(WriteConflict, self).__init__(
+            'Document update conflict: %s' % ', '.join(sorted(errors)))
+        self.errors = errors
+
+
+class DicomStore(dict):
+    """ The interface shared by our Data Access Objects
+
+    Every back end stores pydicom.dataset.Dataset objects by
+    key, following the dict-like pattern of python-couchdb:
+        db[key] = dcm
+        dcm = db[key]
+        del db[key]
+    together with
+        db.update(items)          bulk write of (key, dcm) pairs
+        headers = db.query(...)   header-only search, see QUERY_VIEWS
+        db.delete_many(keys, ...) bulk delete by key and/or query
+        db.compact()              reclaim the space of deletions
+        db.close()                release connections and files
+        for key, dcm in db.iter_items():
+                                  every dataset, a page at a time
+        series = db.get_series(series_uid)
+        counts = db.count_instances(series_uid, ...)
+
+    Datasets are keyed by the attribute LEVEL_KEYWORDS gives
+    for the store's level: SeriesInstanceUID by default, or
+    SOPInstanceUID for a store of single instances, so that
+    writing one instance of a series touches one small
+    document. key(dcm) returns the key for a dataset.
+
+    Back ends implement __getitem__, __setitem__, __delitem__,
+    query and count_instances. update() writes one item at a
+    time and get_series() reads the datasets query() finds
+    one at a time, unless a back end has something faster.
+    """
+
+    level = SERIES_LEVEL
+
+    def __getitem__(self, key):
+        """ Retrieve the DICOM object stored under key """
+        raise NotImplementedError
+
+    def __setitem__(self, key, dcm):
+        """ Write the supplied DICOM object under key """
+        raise NotImplementedError
+
+    def __delitem__(self, key):
+        """ Delete the DICOM object stored under key """
+        raise NotImplementedError
+
+    def query(self, **criteria):
+        """ Return header-only datasets matching all criteria """
+        raise NotImplementedError
+
+    def count_instances(self, *series_uids):
+        """ Map SeriesInstanceUIDs to the number of instances
+            stored for them, for all series if none are given """
+        raise NotImplementedError
+
+    def update(self, items):
+        """ Write many DICOM objects
 
-class DicomCouch(dict):
+        items is a mapping or an iterable of (key, dcm) pairs.
+        """
+        if hasattr(items, 'items'):
+            items = items.items()
+        for key, dcm in items:
+            self[key] = dcm
+
+    def get_series(self, series_uid):
+        """ Return the datasets of a series, in InstanceNumber
+            order """
+        return _sort_instances([self[self.key(dcm)] for dcm in
+                                self.query(SeriesInstanceUID=series_uid)])
+
+    def key(self, dcm):
+        """ Return the key dcm is stored under at this level """
+        return getattr(dcm, LEVEL_KEYWORDS[self.level])
+
+    def delete(self, dcm):
+        """ Delete the supplied DICOM object, stored under
+            its key """
+        del self[self.key(dcm)]
+
+    def delete_many(self, keys=(), purge=False, **criteria):
+        """ Delete the objects stored under keys and those
+            matching criteria, as for query()
+
+        Keys that are not stored are ignored. Returns the
+        keys that were deleted. purge=True asks back ends
+        that keep tombstones of deleted objects to remove
+        them too; those that keep none ignore it.
+
+        """
+        keys = list(keys)
+        if criteria:
+            keys.extend(self.key(dcm) for dcm in self.query(**criteria))
+        deleted = []
+        for key in collections.OrderedDict.fromkeys(keys):
+            try:
+                del self[key]
+            except KeyError:
+                continue
+            deleted.append(key)
+        return deleted
+
+    def compact(self):
+        """ Reclaim the space used by deleted and replaced
+            objects, where the back end needs to be asked """
+        pass
+
+    def iter_keys(self, page_size=PAGE_SIZE):
+        """ Yield every key in the store, in key order """
+        raise NotImplementedError
+
+    def iter_items(self, page_size=PAGE_SIZE):
+        """ Yield (key, dcm) for every dataset in the store,
+            in key order """
+        for key in self.iter_keys(page_size):
+            yield key, self[key]
+
+    def close(self):
+        """ Release the resources held by the store, where
+            the back end holds any """
+        pass
+
+
+class DicomCouch(DicomStore):
     """ A Data Access Object for persisting
         PyDicom objects into CouchDB
 
@@ -64,17 +314,71 @@ class DicomCouch(dict):
 
     The only constraints on the key are that it must be
     json-serializable and unique within the database instance.
-    In theory it should be possible to use any DICOM UID.
-    Unfortunately I have written this code under the assumption
-    that SeriesInstanceUID will always be used.
-    This will be fixed.
+    By default a document holds a series, keyed by its
+    SeriesInstanceUID. With level='instance' each document
+    holds one instance, keyed by its SOPInstanceUID, and a
+    series is read back with a single view query:
+        db = DicomCouch('http://localhost:5984/', 'dbname',
+                        level='instance')
+        db[dcm.SOPInstanceUID] = dcm
+        series = db.get_series(dcm.SeriesInstanceUID)
+        counts = db.count_instances(dcm.SeriesInstanceUID)
+
+    Documents are stored in our original json layout unless
+    the DicomCouch is created with doc_format='dicomjson', in
+    which case they follow the DICOM JSON Model (PS3.18 F.2):
+    every VR is stored explicitly and large
+    binary elements are attachments referenced by BulkDataURI,
+    so DICOMweb-style clients can use the documents directly.
+    Documents in either format can be read whatever the setting.
+
+    With dedup=True binary elements are not attached to the
+    document but stored by content, in a blob document keyed
+    by their BLOB_HASH and shared by every dataset with the
+    same value. Blob documents count their references and are
+    deleted with the last one, so re-sent studies and
+    duplicated series add no pixel data and no upload:
+        db = DicomCouch('http://localhost:5984/', 'dbname',
+                        dedup=True)
+
+    Pixel data is stored as it is found: encapsulated (JPEG,
+    RLE, ...) pixel data is never decompressed. Other binary
+    elements can be compressed with codec='zstd', 'lz4' or
+    'zlib', or codec='auto' for the best one installed. The
+    codec is recorded in the content type of each attachment
+    and the values are decompressed on reading:
+        db = DicomCouch('http://localhost:5984/', 'dbname',
+                        codec='auto')
+
+    Two optional caches save round trips to couchdb. With
+    cache_size (in bytes) datasets that are read are kept in
+    an LRU cache, keyed by document id and revision. Reading
+    a cached dataset costs one HEAD request to check that its
+    revision is current, instead of fetching the document and
+    every attachment. With write_behind, writes are queued
+    and a dataset written to the same key several times is
+    only stored once, when flush() is called or write_behind
+    keys are queued:
+        db = DicomCouch('http://localhost:5984/', 'dbname',
+                        cache_size=512 * 1024 * 1024,
+                        write_behind=100)
+        ...
+        db.flush()
 
     Retrieving object with key 'foo':
         dcm = db['foo']
 
-    Deleting object with key 'foo':
-        dcm = db['foo']
-        db.delete(dcm)
+    Finding the series of a patient, or those matching any of
+    the attributes in QUERY_VIEWS, without reading attachments:
+        headers = db.query(PatientID='123', Modality='CT')
+        headers = db.query(StudyDate=('20100101', '20101231'))
+
+    Deleting object with key 'foo', or all of a patient's
+    objects with two _bulk_docs requests and one view query,
+    then compacting the database to free the space:
+        del db['foo']
+        db.delete_many(PatientID='123')
+        db.compact()
 
     TODO:
      - It is possible to have couchdb assign a uid
@@ -82,79 +386,381 @@ class DicomCouch(dict):
        should be supported.
     """
 
-    def __init__(self, server, db):
-        """ Create connection to couchdb server/db """
+    def __init__(self, server, db, hash_name='md5',
+                 doc_format=LEGACY_FORMAT, dedup=False,
+                 cache_size=0, write_behind=0, level=SERIES_LEVEL,
+                 codec=None):
+        """ Create connection to couchdb server/db
+
+        hash_name picks the hash used to spot modified
+        binary elements. With 'md5' (the default) we can
+        reuse the digests couchdb already keeps for every
+        attachment, so reading a dataset hashes nothing.
+        Any other hashlib name (e.g. 'blake2b') or 'xxh64'
+        (needs the xxhash package) is cheaper to compute
+        when re-saving, but is hashed locally on read.
+        hash_name is not used for blobs when dedup is true,
+        they are addressed by BLOB_HASH instead.
+
+        cache_size is the most bytes of binary elements and
+        documents to keep in the read cache, 0 for no cache.
+        write_behind is the number of keys to queue before
+        writing them, 0 to write at once. Queued datasets are
+        written as they are at that time, not as they were
+        when queued.
+
+        level is SERIES_LEVEL or INSTANCE_LEVEL, see key().
+
+        codec is None to store binary elements as they are,
+        one of CODEC_CONTENT_TYPES or 'auto'.
+
+        """
         super(DicomCouch, self).__init__()
+        _new_hash(hash_name)  # Fail now rather than on first save
+        if doc_format not in (LEGACY_FORMAT, DICOMJSON_FORMAT):
+            raise ValueError("Unknown document format '%s'" % doc_format)
+        if level not in LEVEL_KEYWORDS:
+            raise ValueError("Unknown level '%s'" % level)
+        self.level = level
+        if codec == 'auto':
+            codec = _best_codec()
+        _new_compressor(codec)  # Fail now rather than on first save
+        self._codec = codec
+        self._hash_name = hash_name
+        self._doc_format = doc_format
+        self._dedup = dedup
         self._meta = {}
+        self._views_installed = False
+        self._cache = collections.OrderedDict()
+        self._cache_size = cache_size
+        self._cached_bytes = 0
+        self._write_behind = write_behind
+        self._pending = collections.OrderedDict()
         server = couchdb.Server(server)
         try:
             self._db = server[db]
-        except couchdb.client.ResourceNotFound:
+        except couchdb.ResourceNotFound:
             self._db = server.create(db)
 
     def __getitem__(self, key):
         """ Retrieve DICOM object with
-            specified SeriesInstanceUID """
-        doc = self._db[key]
-        dcm = json2pydicom(doc)
+            specified key """
+        if key in self._pending:
+            self.flush()
+        if key in self._cache:
+            dcm = self.__cached(key)
+            if dcm is not None:
+                return dcm
+        return self.__dataset(key, self._db[key])
+
+    def __dataset(self, key, doc, keep_meta=True):
+        """ Build the DICOM object for a document, reading
+            its attachments
+
+        Unless keep_meta is false the DAO remembers the
+        document, to write the dataset back efficiently.
 
-        if dcm.SeriesInstanceUID not in self._meta:
-            self._meta[dcm.SeriesInstanceUID] = {}
-            self._meta[dcm.SeriesInstanceUID]['hashes'] = {}
+        """
+        if key in self._cache:
+            dcm = self.__cached(key, doc['_rev'])
+            if dcm is not None:
+                return dcm
+        dcm, str2tag = _doc2pydicom(doc)
 
+        # Keep a copy of the couch doc for use in DELETE operations
+        meta = self.__new_meta(doc)
+        size = 0
         if '_attachments' in doc:
-            self.__get_attachments(dcm, doc)
+            size += self.__get_attachments(dcm, doc, meta['digests'],
+                                           str2tag)
+        for id, blob_id in _doc_blobs(doc).items():
+            buf = io.BytesIO()
+            self.__read_attachment(blob_id, BLOB_ATTACHMENT, buf)
+            size += buf.tell()
+            _add_element(dcm, id.split(':'), buf.getvalue(), str2tag)
         _set_meta_info_dcm(dcm)
-        # Keep a copy of the couch doc for use in DELETE operations
-        self._meta[dcm.SeriesInstanceUID]['doc'] = doc
+        if keep_meta:
+            self._meta[key] = meta
+        if self._cache_size:
+            self.__cache(key, dcm, meta, size)
         return dcm
 
     def __setitem__(self, key, dcm):
         """ Write the supplied DICOM object to the database """
-        try:
-            dcm.PixelData = dcm.pixel_array.tostring()
-
-        # Silently ignore errors due to pixel_array not existing
-        except AttributeError:
-            pass
-
-        # Silently ignore attempts to modify compressed pixel data
-        except NotImplementedError:
-            pass
+        self.update([(key, dcm)])
+
+    def __delitem__(self, key):
+        """ Delete the object with key, whether or not it has
+            been read by this DAO. Raises KeyError if there is
+            none, as for any DicomStore. """
+        if not self.delete_many([key]):
+            raise KeyError(key)
+
+    def update(self, items):
+        """ Write many DICOM objects to the database, or queue
+            them if this DAO was created with write_behind """
+        if hasattr(items, 'items'):
+            items = items.items()
+        if not self._write_behind:
+            self.__write(items)
+            return
+        for key, dcm in items:
+            self._pending.pop(key, None)  # Requeue at the end
+            self._pending[key] = dcm
+        if len(self._pending) >= self._write_behind:
+            self.flush()
+
+    def flush(self):
+        """ Write all of the queued DICOM objects """
+        while self._pending:
+            pending = list(self._pending.items())
+            self._pending.clear()
+            self.__write(pending)
+
+    def __write(self, items):
+        """ Write many DICOM objects to the database
+
+        All of the documents are written with a single
+        _bulk_docs request, after at most one _all_docs
+        request for the revisions and attachment stubs of
+        documents this DAO has not read. New and modified
+        attachments are then uploaded one by one.
+
+        Couchdb commits the documents of a bulk write one by
+        one, so if some of them fail the others still get
+        their attachments, and only then is WriteConflict
+        (or the first error that is not a conflict) raised.
+
+        With dedup, references to the blobs the documents use
+        are added before the documents are written and those
+        they no longer use are released afterwards, so if
+        anything fails a blob may be kept too long but is
+        never deleted while in use.
 
-        # Silently ignore errors due to PixelData not existing
-        except TypeError:
-            pass
+        """
+        writes = []
+        for key, dcm in items:
+            self.__uncache(key)
+            jsn, binary_elements, ids = self.__encode(key, dcm)
+            writes.append((dcm, jsn, binary_elements, ids))
+
+        # We have not read these documents, but they may have been
+        # written before. Their attachment stubs tell us which
+        # binary elements are already stored and unchanged.
+        unread = [jsn['_id'] for dcm, jsn, _, _ in writes
+                  if jsn['_id'] not in self._meta]
+        if unread:
+            for row in self._db.view('_all_docs', keys=unread,
+                                     include_docs=True):
+                if row.doc is not None:
+                    self._meta[row.key] = self.__new_meta(row.doc)
+
+        added = collections.Counter()
+        blob_changes = []
+        elements = {}
+        for dcm, jsn, binary_elements, ids in writes:
+            key = jsn['_id']
+            old_blobs = collections.Counter()
+            if key in self._meta:
+                old_doc = self._meta[key]['doc']
+                old_blobs.update(_doc_blobs(old_doc).values())
+                self.__set_meta_info_jsn(jsn, key, [] if self._dedup else ids)
+            new_blobs = _doc_blobs(jsn)
+            for id, (tagstack, element) in zip(ids, binary_elements):
+                if id in new_blobs:
+                    elements[new_blobs[id]] = element
+            new_blobs = collections.Counter(new_blobs.values())
+            added.update(new_blobs - old_blobs)
+            blob_changes.append((old_blobs, new_blobs))
+        self.__add_blob_refs(added, elements)
+
+        # Actually write to the db
+        results = self._db.update([jsn for _, jsn, _, _ in writes])
+        errors = collections.OrderedDict()
+        written = []
+        released = collections.Counter()
+        for (success, id, error), write, (old_blobs, new_blobs) in zip(
+                results, writes, blob_changes):
+            if success:
+                written.append(write)
+                released.update(old_blobs - new_blobs)
+            else:
+                errors[id] = error
+                # Our document is out of date, and the references
+                # we added for it are not used
+                self._meta.pop(id, None)
+                released.update(new_blobs - old_blobs)
+        self.__release_blobs(released)
+
+        for dcm, jsn, binary_elements, ids in written:
+            key = jsn['_id']
+            if key not in self._meta:
+                self._meta[key] = self.__new_meta(jsn)
+            if self._dedup:
+                ids = []
+            content_types = dict(
+                (id, stub.get('content_type', ATTACHMENT_CONTENT_TYPE))
+                for id, stub in jsn.get('_attachments', {}).items())
+            content_types.update(self.__put_attachments(
+                key, binary_elements, ids, jsn))
+            # Keep a local copy of the document. put_attachment()
+            # has kept _rev up to date, and stubs for the attachments
+            # stop the next write from dropping them, so there is no
+            # need to GET the document back from couch.
+            jsn['_attachments'] = dict(
+                (id, {'stub': True, 'content_type': content_types[id]})
+                for id in ids)
+            self._meta[key]['doc'] = jsn
+
+        for error in errors.values():
+            if not isinstance(error, couchdb.ResourceConflict):
+                raise error
+        if errors:
+            raise WriteConflict(errors)
+
+    def __cached(self, key, current_rev=None):
+        """ Return a copy of the cached dataset for key, or None
+            if the document has changed since it was cached
+
+        The current revision is found with a HEAD request,
+        unless it is given.
 
-        jsn,
-        binary_elements,
-        file_meta_binary_elements = pydicom2json(dcm)
+        """
+        rev, dcm, meta, size = self._cache[key]
+        if current_rev is None:
+            try:
+                status, headers, body = self._db.resource.head(key)
+            except couchdb.ResourceNotFound:
+                self.__uncache(key)
+                raise
+            current_rev = headers.get('ETag', '').strip('"')
+        if current_rev != rev:
+            self.__uncache(key)
+            return None
+        self._cache.move_to_end(key)
+        self._meta[key] = meta
+        return copy.deepcopy(dcm)
+
+    def __cache(self, key, dcm, meta, size):
+        """ Add a copy of a dataset just read to the cache,
+            evicting the least recently used to make room """
+        size += len(json.dumps(meta['doc']))
+        if size > self._cache_size:
+            return
+        self.__uncache(key)
+        self._cache[key] = (meta['doc']['_rev'], copy.deepcopy(dcm),
+                            meta, size)
+        self._cached_bytes += size
+        while self._cached_bytes > self._cache_size:
+            evicted = self._cache.popitem(last=False)[1]
+            self._cached_bytes -= evicted[3]
+
+    def __uncache(self, key):
+        """ Drop key from the cache """
+        if key in self._cache:
+            self._cached_bytes -= self._cache.pop(key)[3]
+
+    def __encode(self, key, dcm):
+        """ Convert a DICOM object into the document for key
+
+        Returns the tuple (jsn, binary_elements, ids) as for
+        _pydicom2doc. With dedup the document also maps each
+        attachment id to the blob holding the value.
 
-        _strip_elements(jsn, binary_elements)
-        _strip_elements(jsn['file_meta'], file_meta_binary_elements)
-        if dcm.SeriesInstanceUID in self._meta:
-            self.__set_meta_info_jsn(jsn, dcm)
+        """
+        blobs = {}
+
+        def attachment_uri(id, value):
+            """ Reference the attachment relative to the database """
+            if not self._dedup:
+                return quote(key, safe='') + '/' + quote(id)
+            blobs[id] = _blob_id(value)
+            return quote(blobs[id], safe='') + '/' + BLOB_ATTACHMENT
+
+        jsn, binary_elements, ids = _pydicom2doc(dcm, self._doc_format,
+                                                 attachment_uri)
+        if self._dedup:
+            for id, (tagstack, element) in zip(ids, binary_elements):
+                if id not in blobs:
+                    blobs[id] = _blob_id(element.value)
+            jsn.setdefault(DAO_KEY, {})['blobs'] = blobs
+        jsn['_id'] = key
+        return jsn, binary_elements, ids
+
+    def __add_blob_refs(self, counts, elements):
+        """ Add counts[blob_id] references to each blob
+
+        Blobs that do not exist yet are created by uploading
+        the value of elements[blob_id]. Couchdb has no transactions, so we
+        rely on its revisions instead: any blob changed by
+        someone else in the meantime is read and tried again.
 
-        try:  # Actually write to the db
-            self._db[key] = jsn
-        except TypeError as type_error:
-            if str(type_error) == 'string indices must be integers, not str':
-                pass
+        """
+        while counts:
+            retry = collections.Counter()
+            blobs = []
+            for row in self._db.view('_all_docs', keys=list(counts),
+                                     include_docs=True):
+                blob = row.doc
+                if blob is None:
+                    blob = self.__put_blob(row.key, elements[row.key])
+                    if blob is None:
+                        retry[row.key] = counts[row.key]
+                        continue
+                refs = blob.setdefault(DAO_KEY, {}).get('refs', 0)
+                blob[DAO_KEY]['refs'] = refs + counts[row.key]
+                blobs.append(blob)
+            for success, id, error in self._db.update(blobs):
+                if not success:
+                    if not isinstance(error, couchdb.ResourceConflict):
+                        raise error
+                    retry[id] = counts[id]
+            counts = retry
+
+    def __put_blob(self, blob_id, element):
+        """ Upload a new blob, returning its document
+
+        The value is uploaded before the reference count is
+        set, so a blob document always has its value. Returns
+        None if someone else created the blob first.
 
-        if dcm.SeriesInstanceUID not in self._meta:
-            self._meta[dcm.SeriesInstanceUID] = {}
-            self._meta[dcm.SeriesInstanceUID]['hashes'] = {}
-
-        self.__put_attachments(dcm, binary_elements, jsn)
-        # Get a local copy of the document
-        # We get this from couch because we get the _id,
-        # _rev and _attachments keys which will ensure
-        # we don't overwrite the attachments we just uploaded.
-        # I don't really like the extra HTTP GET and
-        # I think we can generate what we need without doing
-        # it. Don't have time to work out how yet.
-        self._meta[dcm.SeriesInstanceUID]['doc'] = \
-            self._db[dcm.SeriesInstanceUID]
+        """
+        blob = {'_id': blob_id, '_rev': None}  # No rev creates the doc
+        codec = self.__element_codec(element)
+        try:
+            self._db.put_attachment(blob, _AttachmentStream(
+                element.value, hashlib.new(BLOB_HASH), codec),
+                BLOB_ATTACHMENT, _codec_content_type(codec))
+        except couchdb.ResourceConflict:
+            return None
+        blob['_attachments'] = {BLOB_ATTACHMENT: {
+            'stub': True, 'content_type': _codec_content_type(codec)}}
+        return blob
+
+    def __release_blobs(self, counts):
+        """ Remove counts[blob_id] references from each blob,
+            deleting blobs that are no longer referenced """
+        while counts:
+            retry = collections.Counter()
+            blobs = []
+            for row in self._db.view('_all_docs', keys=list(counts),
+                                     include_docs=True):
+                blob = row.doc
+                if blob is None:
+                    continue  # Already gone
+                refs = blob.get(DAO_KEY, {}).get('refs', 0) - counts[row.key]
+                if refs > 0:
+                    blob[DAO_KEY]['refs'] = refs
+                else:
+                    blob = {'_id': blob['_id'], '_rev': blob['_rev'],
+                            '_deleted': True}
+                blobs.append(blob)
+            for success, id, error in self._db.update(blobs):
+                if not success:
+                    if not isinstance(error, couchdb.ResourceConflict):
+                        raise error
+                    retry[id] = counts[id]
+            counts = retry
 
     def __str__(self):
         """ Return the string representation of the
@@ -166,101 +772,1159 @@ class DicomCouch(dict):
             of the couchdb client """
         return repr(self._db)
 
-    def __get_attachments(self, dcm, doc):
+    def __get_attachments(self, dcm, doc, digests, str2tag):
         """ Set binary tags by retrieving attachments
             from couchdb.
 
-        Values are hashed so they are only updated
-        if they have changed.
+        Digests are kept so attachments are only
+        uploaded again if they have changed. Where
+        couchdb's own md5 digest will do we use it,
+        otherwise (e.g. the attachment is compressed, so
+        couchdb's digest is not of the value) each
+        attachment is hashed while it is streamed in.
+        Returns the number of bytes read.
 
         """
+        size = 0
         for id in doc['_attachments'].keys():
             tagstack = id.split(':')
-            value = self._db.get_attachment(doc['_id'], id)
-            _add_element(dcm, tagstack, value)
-            value = hashlib.md5(value)
-            self._meta[dcm.SeriesInstanceUID]['hashes'][id] = value
-
-    def __put_attachments(self, dcm, binary_elements, jsn):
-        """ Upload all new and modified attachments """
-        func = self.__attachment_update_needed
-        elements_to_update = \
-            [(tagstack, item)
-             for tagstack, item in binary_elements
-             if func(dcm,
-                     _tagstack2id(tagstack + [item.tag]),
-                     item)
-            ]  # nopep8
-        for tagstack, element in elements_to_update:
-            id = _tagstack2id(tagstack + [element.tag])
-            self._db.put_attachment(jsn, element.value, id)
-            self._meta[dcm.SeriesInstanceUID]['hashes'][id] = \
-                hashlib.md5(element.value)
+            value_hash = None
+            if (self._hash_name != 'md5' or id not in digests or
+                    digests[id][3] is not None):
+                value_hash = _new_hash(self._hash_name)
+            buf = io.BytesIO()
+            self.__read_attachment(doc['_id'], id, buf, value_hash)
+            # getvalue() hands back the BytesIO buffer itself
+            # rather than a copy, as nothing else references it
+            value = buf.getvalue()
+            _add_element(dcm, tagstack, value, str2tag)
+            size += len(value)
+            if value_hash is not None:
+                digests[id] = (len(value), self._hash_name,
+                               value_hash.digest(), None)
+        return size
+
+    def __read_attachment(self, doc_id, id, fileobj, value_hash=None):
+        """ Stream an attachment from couchdb into fileobj
+
+        The attachment is read CHUNK_SIZE bytes at a time,
+        decompressed if its content type names a codec and,
+        if value_hash is given, each chunk is hashed on the
+        way through.
 
-    def delete(self, dcm):
-        """ Delete from database and remove meta info from the DAO """
-        self._db.delete(self._meta[dcm.SeriesInstanceUID]['doc'])
-        self._meta.pop(dcm.SeriesInstanceUID)
-
-    def __set_meta_info_jsn(self, jsn, dcm):
-        """ Set the couch-specific meta data for supplied dict """
-        jsn['_rev'] = self._meta[dcm.SeriesInstanceUID]['doc']['_rev']
-        if '_attachments' in self._meta[dcm.SeriesInstanceUID]['doc']:
-            jsn['_attachments'] = \
-                self._meta[dcm.SeriesInstanceUID]['doc']['_attachments']
-
-    def __attachment_update_needed(self, dcm, id, binary_element):
-        """ Compare hashes for binary element and return true if different """
+        """
+        status, headers, response = self._db.resource(doc_id).get(id)
+        if response is None:
+            return  # python-couchdb gives no body for empty attachments
+        decompressor = _new_decompressor(
+            _content_type_codec(headers.get('Content-Type')))
         try:
-            hashes = self._meta[dcm.SeriesInstanceUID]['hashes']
-        except KeyError:
-            return True  # If no hashes dict then attachments do not exist
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                if decompressor is not None:
+                    chunk = decompressor.decompress(chunk)
+                if value_hash is not None:
+                    value_hash.update(chunk)
+                fileobj.write(chunk)
+        finally:
+            response.close()
+
+    def __put_attachments(self, key, binary_elements, ids, jsn):
+        """ Upload all new and modified attachments, returning
+            the content types of those uploaded by id """
+        digests = self._meta[key]['digests']
+        for id in set(digests) - set(ids):
+            del digests[id]  # Dropped along with the binary element
+        content_types = {}
+        for id, (tagstack, element) in zip(ids, binary_elements):
+            codec = self.__element_codec(element)
+            if not self.__attachment_update_needed(digests.get(id),
+                                                   element.value, codec):
+                continue
+            stream = _AttachmentStream(element.value,
+                                       _new_hash(self._hash_name), codec)
+            content_types[id] = _codec_content_type(codec)
+            self._db.put_attachment(jsn, stream, id, content_types[id])
+            digests[id] = (len(element.value), self._hash_name,
+                           stream.hash.digest(), None)
+        return content_types
+
+    def __element_codec(self, element):
+        """ Return the codec to store a binary element with,
+            None for encapsulated pixel data """
+        if element.tag == PIXEL_DATA_TAG and element.is_undefined_length:
+            return None  # Already compressed
+        return self._codec
+
+    def query(self, **criteria):
+        """ Return header-only datasets matching all criteria
+
+        Criteria are given as keyword=value for keywords in
+        QUERY_VIEWS, or keyword=(first, last) for an inclusive
+        range, e.g. of StudyDate. The first criterion in
+        QUERY_VIEWS order is looked up in its couchdb view and
+        any others are checked against the returned datasets,
+        so the cost depends on the number of matches, not on
+        the size of the database.
+
+        Binary elements are not retrieved. The datasets are
+        meant for searching and listing; use db[key] to get
+        the full dataset.
 
-        if id not in hashes or hashes[id].digest() != \
-                hashlib.md5(binary_element.value).digest():
-            return True
+        """
+        return [dcm for doc, dcm in self.__query_docs(criteria)]
+
+    def __query_docs(self, criteria):
+        """ Return (doc, header-only dataset) pairs for all
+            documents matching criteria """
+        _check_criteria(criteria)
+        self.flush()
+        self.__ensure_views()
+
+        keyword = [keyword for keyword in QUERY_VIEWS
+                   if keyword in criteria][0]
+        value = criteria[keyword]
+        options = {'include_docs': True}
+        if isinstance(value, tuple):
+            options['startkey'], options['endkey'] = value
         else:
-            return False
+            options['key'] = value
+        rows = self._db.view('%s/%s' % (DESIGN_DOC[len('_design/'):],
+                                        QUERY_VIEWS[keyword]), **options)
+        matches = []
+        for row in rows:
+            dcm = _doc2pydicom(row.doc)[0]
+            if all(_matches(dcm, other, criteria[other])
+                   for other in criteria if other != keyword):
+                matches.append((row.doc, dcm))
+        return matches
+
+    def get_series(self, series_uid):
+        """ Return the datasets of a series, in InstanceNumber order
+
+        The documents come from a single view query, so only
+        their attachments are read one by one. Cached datasets
+        need no further requests at all.
 
+        """
+        self.flush()
+        self.__ensure_views()
+        rows = self._db.view('%s/%s' % (
+            DESIGN_DOC[len('_design/'):],
+            QUERY_VIEWS['SeriesInstanceUID']), key=series_uid,
+            include_docs=True)
+        return _sort_instances([self.__dataset(row.id, row.doc)
+                                for row in rows])
+
+    def count_instances(self, *series_uids):
+        """ Map SeriesInstanceUIDs to the number of instances
+            stored for them, for all series if none are given """
+        self.flush()
+        self.__ensure_views()
+        options = {'group': True}
+        if series_uids:
+            options['keys'] = list(series_uids)
+        rows = self._db.view('%s/%s' % (DESIGN_DOC[len('_design/'):],
+                                        SERIES_VIEW), **options)
+        return dict((row.key, row.value) for row in rows)
+
+    def __ensure_views(self):
+        """ Install or update our design document, once per DAO """
+        if self._views_installed:
+            return
+        design = self._db.get(DESIGN_DOC) or {'_id': DESIGN_DOC}
+        views = _design_views()
+        if design.get('views') != views:
+            design['language'] = 'javascript'
+            design['views'] = views
+            self._db.save(design)
+        self._views_installed = True
+
+    def delete_many(self, keys=(), purge=False, **criteria):
+        """ Delete the objects stored under keys and those
+            matching criteria, as for query()
+
+        The revisions of the keys come from one _all_docs
+        request and the documents found by criteria from
+        the view query() would use, then everything is
+        deleted with one _bulk_docs request. Documents
+        changed by someone else in the meantime are read and
+        deleted again. Keys that are not stored are ignored.
+        Returns the keys that were deleted.
+
+        Deleted documents leave a tombstone, which compact()
+        does not remove. With purge=True the tombstones are
+        purged as well. Only do that if the database is not
+        replicated, as purges are not.
 
-def _add_element(dcm, tagstack, value):
-    """ Add element with tag, vr and value to dcm
-        at location tagstack """
-    current_node = dcm
-    for item in tagstack[:-1]:
+        """
+        self.flush()
+        docs = collections.OrderedDict()
+        if criteria:
+            for doc, dcm in self.__query_docs(criteria):
+                docs[doc['_id']] = doc
+        keys = [key for key in keys if key not in docs]
+        deleted = []
+        tombstones = []
+        released = collections.Counter()
+        while keys or docs:
+            if keys:
+                for row in self._db.view('_all_docs', keys=keys,
+                                         include_docs=True):
+                    if row.doc is not None:
+                        docs[row.id] = row.doc
+            if not docs:
+                break
+            keys = []
+            results = self._db.update([
+                {'_id': doc['_id'], '_rev': doc['_rev'], '_deleted': True}
+                for doc in docs.values()])
+            for (success, id, rev), doc in zip(results, docs.values()):
+                if success:
+                    deleted.append(id)
+                    tombstones.append({'_id': id, '_rev': rev})
+                    released.update(_doc_blobs(doc).values())
+                elif isinstance(rev, couchdb.ResourceConflict):
+                    keys.append(id)  # Changed meanwhile, read it again
+                else:
+                    raise rev
+            docs = collections.OrderedDict()
+
+        for key in deleted:
+            self._pending.pop(key, None)
+            self.__uncache(key)
+            self._meta.pop(key, None)
+        self.__release_blobs(released)
+        if purge and tombstones:
+            self._db.purge(tombstones)
+        return deleted
+
+    def compact(self):
+        """ Compact the database and our views, and remove
+            index files of views that no longer exist
+
+        Couchdb keeps old revisions, including the
+        attachments of replaced and deleted documents, until
+        the database is compacted. Compaction runs in the
+        background on the server; this only starts it.
+
+        """
+        self._db.compact()
+        if self._views_installed or self._db.get(DESIGN_DOC) is not None:
+            self._db.compact(DESIGN_DOC[len('_design/'):])
+        self._db.cleanup()
+
+    def iter_keys(self, page_size=PAGE_SIZE):
+        """ Yield the key of every dataset, in key order
+
+        _all_docs is read page_size rows per request, so
+        memory use does not grow with the database. Design
+        and blob documents are skipped.
+
+        """
+        for row in self.__all_docs(page_size, False):
+            yield row.id
+
+    def iter_items(self, page_size=PAGE_SIZE):
+        """ Yield (key, dcm) for every dataset, in key order
+
+        Documents are read page_size at a time, with their
+        revisions, so each dataset then only needs its
+        attachments read. Only one page of documents and
+        one dataset are held at a time; unlike db[key] the
+        DAO does not remember the documents.
+
+        """
+        for row in self.__all_docs(page_size, True):
+            yield row.id, self.__dataset(row.id, row.doc, keep_meta=False)
+
+    @property
+    def url(self):
+        """ The URL of the couch database """
+        return self._db.resource.url
+
+    def changes(self, since=0, limit=PAGE_SIZE, timeout=None):
+        """ Return the changes to datasets after sequence since
+
+        Returns the tuple (changes, last_seq), where changes is
+        a list of (key, doc) with doc None for deleted datasets,
+        in the order they were made, and last_seq is the
+        sequence to ask for changes since next time. At most
+        limit changes are returned; with timeout (in seconds)
+        we wait that long for a change if there are none.
+        Design and blob documents are left out.
+
+        """
+        return self._changes_page(since, limit, timeout)[:2]
+
+    def _changes_page(self, since, limit, timeout):
+        """ Return (changes, last_seq, more) as for changes(),
+            with more False once the feed has been read to
+            its end
+
+        The feed is at its end when it returns fewer than
+        limit results, counting those left out. Sequences
+        are opaque from CouchDB 2 on, so last_seq can't be
+        compared with since to find out.
+
+        """
+        options = {'since': since, 'limit': limit, 'include_docs': True}
+        if timeout is not None:
+            options['feed'] = 'longpoll'
+            options['timeout'] = int(timeout * 1000)
+        feed = self._db.changes(**options)
+        changes = []
+        for change in feed['results']:
+            if not _is_dataset_id(change['id']):
+                continue
+            doc = None if change.get('deleted') else change['doc']
+            changes.append((change['id'], doc))
+        more = len(feed['results']) >= limit
+        return changes, feed['last_seq'], more
+
+    def __all_docs(self, page_size, include_docs):
+        """ Yield the _all_docs rows of dataset documents,
+            reading page_size rows per request """
+        self.flush()
+        options = {'limit': page_size + 1, 'include_docs': include_docs}
+        while True:
+            rows = list(self._db.view('_all_docs', **options))
+            for row in rows[:page_size]:
+                if not _is_dataset_id(row.id):
+                    continue
+                yield row
+            if len(rows) <= page_size:
+                return
+            # The extra row starts the next page
+            options['startkey'] = rows[page_size].id
+
+    def __new_meta(self, doc):
+        """ Create the meta info we keep for a couch document """
+        return {'doc': doc,
+                'digests': _stub_digests(doc.get('_attachments', {}))}
+
+    def __set_meta_info_jsn(self, jsn, key, ids):
+        """ Set the couch-specific meta data for supplied dict
+
+        Only stubs for attachments in ids are kept, so
+        binary elements that have been removed from the
+        dataset lose their attachment too.
+
+        """
+        jsn['_rev'] = self._meta[key]['doc']['_rev']
+        attachments = self._meta[key]['doc'].get('_attachments', {})
+        jsn['_attachments'] = dict((id, attachments[id])
+                                   for id in ids if id in attachments)
+
+    def __attachment_update_needed(self, known, value, codec):
+        """ Return true unless value, to be stored with codec,
+            matches the known (length, hash_name, digest,
+            stored_codec) of its attachment
+
+        With a stored_codec, length and digest are couchdb's
+        and of the compressed attachment, so value is
+        compressed to compare. That is only the case for
+        documents we have not read, and is still cheaper
+        than an upload. Should the compressed bytes differ,
+        e.g. with another version of the codec, the value is
+        uploaded again, which is safe.
+
+        """
+        if known is None:
+            return True  # Attachment does not exist yet
+
+        length, hash_name, digest, stored_codec = known
+        if stored_codec is not None:
+            if stored_codec != codec:
+                return True
+            stream = _AttachmentStream(value, _new_hash(hash_name), codec)
+            value_hash = _new_hash(hash_name)
+            stored = 0
+            for chunk in iter(stream.read, b''):
+                value_hash.update(chunk)
+                stored += len(chunk)
+            return stored != length or value_hash.digest() != digest
+
+        if length != len(value):
+            return True  # No need to hash to see it has changed
+
+        value_hash = _new_hash(hash_name)
+        value_hash.update(value)
+        return value_hash.digest() != digest
+
+
+class DicomSQLite(DicomStore):
+    """ A Data Access Object for persisting PyDicom
+        objects in a local directory, with no server
+
+    Headers are stored as documents, in the same formats
+    DicomCouch uses, in an SQLite database with an indexed
+    column for each of QUERY_VIEWS. Binary elements are
+    stored as files named by the hash of their content, so
+    an unchanged binary element is never written twice:
+        path/index.sqlite
+        path/blobs/ab/abcdef0123...
+
+        db = DicomSQLite('/data/archive')
+        db[dcm.SeriesInstanceUID] = dcm
+        dcm = db[dcm.SeriesInstanceUID]
+        headers = db.query(PatientID='123')
+
+    Each write is a transaction of its own, unless made
+    inside a transaction() block; update() writes all of
+    its items in one transaction:
+        with db.transaction():
+            db[key1] = dcm1
+            del db[key2]
+
+    A blob file is removed once the last document using it
+    is deleted or changed and that transaction commits.
+    Blobs written by a transaction that rolls back are
+    left behind, but are reused when the same data is
+    written again.
+    """
+
+    def __init__(self, path, hash_name='blake2b',
+                 doc_format=DICOMJSON_FORMAT, level=SERIES_LEVEL):
+        """ Open, or create, the store in directory path
+
+        hash_name names the hashlib hash used to address
+        blob files, so it must be collision resistant.
+        doc_format and level are as for DicomCouch.
+
+        """
+        super(DicomSQLite, self).__init__()
+        hashlib.new(hash_name)  # Fail now rather than on first save
+        if doc_format not in (LEGACY_FORMAT, DICOMJSON_FORMAT):
+            raise ValueError("Unknown document format '%s'" % doc_format)
+        if level not in LEVEL_KEYWORDS:
+            raise ValueError("Unknown level '%s'" % level)
+        self.level = level
+        self._hash_name = hash_name
+        self._doc_format = doc_format
+        self._path = path
+        self._blob_dir = os.path.join(path, 'blobs')
+        if not os.path.isdir(self._blob_dir):
+            os.makedirs(self._blob_dir)
+        # Autocommit mode, we BEGIN and COMMIT transactions ourselves
+        self._conn = sqlite3.connect(os.path.join(path, 'index.sqlite'),
+                                     timeout=SQLITE_TIMEOUT,
+                                     isolation_level=None)
+        self._depth = 0
+        self._orphans = set()
+        self.__create_tables()
+
+    def __create_tables(self):
+        """ Create the tables and indexes, if they do not exist """
+        columns = ''.join(', %s TEXT' % keyword for keyword in QUERY_VIEWS)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS documents (key TEXT PRIMARY KEY, '
+            'rev INTEGER NOT NULL, doc TEXT NOT NULL%s)' % columns)
+        self.__add_query_columns()
+        for keyword in QUERY_VIEWS:
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS documents_%s '
+                'ON documents (%s)' % (keyword, keyword))
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS attachments (key TEXT NOT NULL, '
+            'id TEXT NOT NULL, digest TEXT NOT NULL, '
+            'length INTEGER NOT NULL, PRIMARY KEY (key, id))')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS attachments_digest '
+                           'ON attachments (digest)')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS checkpoints (name TEXT PRIMARY KEY, '
+            'seq TEXT NOT NULL)')
+
+    def __add_query_columns(self):
+        """ Add and fill in columns for keywords added to
+            QUERY_VIEWS since the store was created """
+        columns = [row[1] for row in
+                   self._conn.execute('PRAGMA table_info(documents)')]
+        missing = [keyword for keyword in QUERY_VIEWS
+                   if keyword not in columns]
+        if not missing:
+            return
+        with self.transaction():
+            for keyword in missing:
+                self._conn.execute('ALTER TABLE documents ADD COLUMN '
+                                   '%s TEXT' % keyword)
+            rows = self._conn.execute('SELECT key, doc FROM documents')
+            for key, doc in rows.fetchall():
+                dcm = _doc2pydicom(json.loads(doc))[0]
+                self._conn.execute(
+                    'UPDATE documents SET %s WHERE key = ?' % ', '.join(
+                        '%s = ?' % keyword for keyword in missing),
+                    [_query_value(dcm, keyword) for keyword in missing] +
+                    [key])
+
+    def __str__(self):
+        """ Return the string representation of the store """
+        return self._path
+
+    def __repr__(self):
+        """ Return the canonical string representation
+            of the store """
+        return '<%s %r>' % (type(self).__name__, self._path)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ Group writes into one transaction
+
+        Transactions nest; only the outermost one commits,
+        or rolls back if an exception is raised.
+
+        The outermost one takes SQLite's write lock as it
+        begins, waiting up to SQLITE_TIMEOUT seconds for other
+        writers, e.g. other threads of import_archive(). A
+        deferred transaction would only ask for the lock on its
+        first write, after reading, and SQLite fails such an
+        upgrade at once rather than wait while another
+        connection writes.
+
+        """
+        if self._depth == 0:
+            self._conn.execute('BEGIN IMMEDIATE')
+        self._depth += 1
         try:
-            address = int(item)
-        except ValueError:
-            address = pydicom.tag.Tag(__str2tag(item))
-        current_node = current_node[address]
-    tag = __str2tag(tagstack[-1])
-    vr = pydicom.datadict.dictionary_VR(tag)
-    current_node[tag] = pydicom.dataelem.DataElement(tag, vr, value)
+            yield self
+        except BaseException:
+            self._depth -= 1
+            if self._depth == 0:
+                self._conn.execute('ROLLBACK')
+                self._orphans.clear()
+            raise
+        self._depth -= 1
+        if self._depth == 0:
+            self._conn.execute('COMMIT')
+            self.__remove_orphans()
+
+    def __getitem__(self, key):
+        """ Retrieve the DICOM object stored under key """
+        row = self._conn.execute('SELECT doc FROM documents WHERE key = ?',
+                                 (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        dcm, str2tag = _doc2pydicom(json.loads(row[0]))
+        for id, digest in self._conn.execute(
+                'SELECT id, digest FROM attachments WHERE key = ?', (key,)):
+            with open(self.__blob_path(digest), 'rb') as blob:
+                _add_element(dcm, id.split(':'), blob.read(), str2tag)
+        _set_meta_info_dcm(dcm)
+        return dcm
 
+    def __setitem__(self, key, dcm):
+        """ Write the supplied DICOM object under key """
+        with self.transaction():
+            self.__write(key, dcm)
+
+    def __delitem__(self, key):
+        """ Delete the DICOM object stored under key """
+        with self.transaction():
+            self.__drop_attachments(key)
+            cursor = self._conn.execute('DELETE FROM documents WHERE key = ?',
+                                        (key,))
+            if cursor.rowcount == 0:
+                raise KeyError(key)
+
+    def update(self, items):
+        """ Write many DICOM objects in a single transaction """
+        if hasattr(items, 'items'):
+            items = items.items()
+        with self.transaction():
+            for key, dcm in items:
+                self.__write(key, dcm)
+
+    def query(self, **criteria):
+        """ Return header-only datasets matching all criteria
+
+        Criteria are as for DicomCouch.query(). All of them
+        are answered from the indexed columns.
 
-def _tagstack2id(tagstack):
-    """ Convert a list of tags to a unique
-        (within document) attachment id """
-    return string.join([str(tag) for tag in tagstack], ':')
+        """
+        where, params = _sql_where(criteria)
+        rows = self._conn.execute('SELECT doc FROM documents WHERE ' + where,
+                                  params)
+        return [_doc2pydicom(json.loads(doc))[0] for doc, in rows]
+
+    def delete_many(self, keys=(), purge=False, **criteria):
+        """ Delete the objects stored under keys and those
+            matching criteria, as for query(), in a single
+            transaction
+
+        Keys that are not stored are ignored. Returns the
+        keys that were deleted. Deleted rows leave no
+        tombstones, so purge is ignored.
+
+        """
+        keys = list(keys)
+        with self.transaction():
+            if criteria:
+                where, params = _sql_where(criteria)
+                keys.extend(key for key, in self._conn.execute(
+                    'SELECT key FROM documents WHERE ' + where, params))
+            deleted = []
+            for key in collections.OrderedDict.fromkeys(keys):
+                self.__drop_attachments(key)
+                if self._conn.execute('DELETE FROM documents WHERE key = ?',
+                                      (key,)).rowcount:
+                    deleted.append(key)
+        return deleted
+
+    def compact(self):
+        """ Rebuild the SQLite database to free unused pages """
+        self._conn.execute('VACUUM')
+
+    def iter_keys(self, page_size=PAGE_SIZE):
+        """ Yield every key in the store, in key order, reading
+            page_size keys per query """
+        sql = 'SELECT key FROM documents %sORDER BY key LIMIT ?'
+        keys = [key for key, in self._conn.execute(sql % '', (page_size,))]
+        while keys:
+            for key in keys:
+                yield key
+            keys = [key for key, in self._conn.execute(
+                sql % 'WHERE key > ? ', (keys[-1], page_size))]
+
+    def count_instances(self, *series_uids):
+        """ Map SeriesInstanceUIDs to the number of instances
+            stored for them, for all series if none are given """
+        sql = 'SELECT SeriesInstanceUID, COUNT(*) FROM documents'
+        if series_uids:
+            sql += ' WHERE SeriesInstanceUID IN (%s)' % ', '.join(
+                '?' * len(series_uids))
+        rows = self._conn.execute(sql + ' GROUP BY SeriesInstanceUID',
+                                  series_uids)
+        return dict((uid, count) for uid, count in rows if uid is not None)
+
+    def put_document(self, key, doc):
+        """ Store a document as DicomCouch writes them, in
+            either format, without its binary elements
+
+        Used to keep a header index of a DicomCouch database,
+        see DicomCouchFollower. In datasets read back from
+        such documents the binary elements that were
+        attachments, PixelData among them, are still there
+        but have the value None.
+
+        """
+        jsn = dict((name, value) for name, value in doc.items()
+                   if not name.startswith('_'))
+        with self.transaction():
+            self.__drop_attachments(key)
+            self.__put_document(key, jsn, _doc2pydicom(jsn)[0])
+
+    def checkpoint(self, name):
+        """ Return the sequence saved for name, or None """
+        row = self._conn.execute('SELECT seq FROM checkpoints WHERE name = ?',
+                                 (name,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set_checkpoint(self, name, seq):
+        """ Save a sequence, e.g. of a changes feed, for name """
+        with self.transaction():
+            self._conn.execute('INSERT OR REPLACE INTO checkpoints '
+                               '(name, seq) VALUES (?, ?)',
+                               (name, json.dumps(seq)))
+
+    def close(self):
+        """ Close the SQLite connection """
+        self._conn.close()
+
+    def __write(self, key, dcm):
+        """ Write one DICOM object, inside a transaction """
+        jsn, binary_elements, ids = _pydicom2doc(dcm, self._doc_format)
+        attachments = []
+        for id, (tagstack, element) in zip(ids, binary_elements):
+            value_hash = hashlib.new(self._hash_name)
+            value_hash.update(element.value)
+            digest = value_hash.hexdigest()
+            self.__write_blob(digest, element.value)
+            attachments.append((key, id, digest, len(element.value)))
+
+        self.__drop_attachments(key)
+        self.__put_document(key, jsn, dcm)
+        self._conn.executemany('INSERT INTO attachments (key, id, digest, '
+                               'length) VALUES (?, ?, ?, ?)', attachments)
+
+    def __put_document(self, key, jsn, dcm):
+        """ Insert or replace the document row of key, inside
+            a transaction """
+        row = self._conn.execute('SELECT rev FROM documents WHERE key = ?',
+                                 (key,)).fetchone()
+        rev = 1 if row is None else row[0] + 1
+        self._conn.execute(
+            'INSERT OR REPLACE INTO documents (key, rev, doc%s) '
+            'VALUES (?, ?, ?%s)' % (
+                ''.join(', %s' % keyword for keyword in QUERY_VIEWS),
+                ', ?' * len(QUERY_VIEWS)),
+            [key, rev, json.dumps(jsn)] +
+            [_query_value(dcm, keyword) for keyword in QUERY_VIEWS])
+
+    def __drop_attachments(self, key):
+        """ Remove the attachment rows of key, remembering their
+            blobs in case nothing else uses them """
+        self._orphans.update(digest for digest, in self._conn.execute(
+            'SELECT digest FROM attachments WHERE key = ?', (key,)))
+        self._conn.execute('DELETE FROM attachments WHERE key = ?', (key,))
+
+    def __remove_orphans(self):
+        """ Remove blob files that committed changes left unused """
+        for digest in self._orphans:
+            if self._conn.execute('SELECT 1 FROM attachments '
+                                  'WHERE digest = ? LIMIT 1',
+                                  (digest,)).fetchone() is None:
+                try:
+                    os.remove(self.__blob_path(digest))
+                except OSError:
+                    pass
+        self._orphans.clear()
+
+    def __blob_path(self, digest):
+        """ Return the file name for a blob """
+        return os.path.join(self._blob_dir, digest[:2], digest)
+
+    def __write_blob(self, digest, value):
+        """ Write value to its blob file, unless it exists already
+
+        The data goes to a temporary file that is renamed into
+        place, so a blob file is never seen half written.
+
+        """
+        path = self.__blob_path(digest)
+        if os.path.exists(path):
+            return
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as blob:
+                blob.write(value)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+class DicomCouchFollower(object):
+    """ Keep a local DicomSQLite index of the headers of the
+        datasets in a DicomCouch database
+
+    The index follows the couch _changes feed, so after the
+    first run only changed documents are transferred, and
+    never their attachments. The feed sequence is saved in
+    the index with each batch of changes, in the same
+    transaction, so a follower can be stopped at any time
+    and picks up where it left off.
+
+        couch = DicomCouch('http://localhost:5984/', 'dbname')
+        index = DicomSQLite('/var/cache/dicom_index')
+        follower = DicomCouchFollower(couch, index)
+        follower.update()
+        headers = index.query(PatientID='123')
+
+    Queries then never reach the server. To keep the index
+    fresh, call update() again or follow() in a thread of
+    its own (SQLite connections belong to the thread that
+    opened them, so open the index in that thread too).
+
+    The index holds the documents, not the attachments, so
+    the datasets it returns, from query() or index[key],
+    are like those DicomCouch.query() returns: binary
+    elements stored as attachments, PixelData among them,
+    are kept with the value None. Only small values stored
+    inline in DICOM JSON documents are there. Read the
+    full dataset from couch.
+    """
+
+    def __init__(self, couch, index, batch_size=PAGE_SIZE, name=None):
+        """ Follow DicomCouch couch into DicomSQLite index
+
+        batch_size changes are read per request and written
+        per transaction. name identifies the database in the
+        index's checkpoints and defaults to its URL.
+
+        """
+        self._couch = couch
+        self._index = index
+        self._batch_size = batch_size
+        self._name = name or couch.url
+
+    def update(self, timeout=None):
+        """ Apply all changes made since the last update
+
+        With timeout, wait up to that many seconds for a
+        change if there are none. Returns the number of
+        changes applied.
+
+        """
+        count = 0
+        while True:
+            since = self._index.checkpoint(self._name) or 0
+            changes, last_seq, more = self._couch._changes_page(
+                since, self._batch_size, timeout)
+            with self._index.transaction():
+                for key, doc in changes:
+                    if doc is None:
+                        self._index.delete_many([key])
+                    else:
+                        self._index.put_document(key, doc)
+                self._index.set_checkpoint(self._name, last_seq)
+            count += len(changes)
+            if not more or timeout is not None:
+                return count
+
+    def follow(self, stop=None, timeout=60):
+        """ Apply changes as they are made, until the
+            threading.Event stop is set
+
+        Each request waits up to timeout seconds for a change,
+        so stop is noticed within that time.
+
+        """
+        self.update()
+        while stop is None or not stop.is_set():
+            self.update(timeout)
+
+
+class _AttachmentStream(object):
+    """ Read-only file-like view of a binary element value
+
+    python-couchdb sends file-like bodies with chunked
+    transfer encoding, calling read() until it gets an
+    empty string. We hand out CHUNK_SIZE slices of the
+    value and update the hash as each one goes past, so
+    the upload needs neither a copy of the value nor a
+    separate hashing pass.
+
+    With a codec the chunks are compressed as they go
+    past. The hash is always of the value itself.
+
+    """
+
+    def __init__(self, value, value_hash, codec=None):
+        self._view = memoryview(value)
+        self._offset = 0
+        self.hash = value_hash
+        self._compressor = _new_compressor(codec)
+
+    def read(self, size=CHUNK_SIZE):
+        if size is None or size < 0:
+            size = len(self._view) - self._offset
+        while True:
+            chunk = self._view[self._offset:self._offset + size].tobytes()
+            self._offset += len(chunk)
+            self.hash.update(chunk)
+            if self._compressor is None:
+                return chunk
+            if not chunk:
+                chunk = self._compressor.flush()
+                self._compressor = None
+                return chunk
+            chunk = self._compressor.compress(chunk)
+            if chunk:  # An empty string would end the upload early
+                return chunk
+
+
+def _pydicom2doc(dcm, doc_format, attachment_uri=None):
+    """ Convert a DICOM object into a document in doc_format
+
+    Returns the tuple (jsn, binary_elements, ids), where ids
+    are the attachment ids for binary_elements. In DICOM JSON
+    documents each BulkDataURI is attachment_uri(id, value),
+    or just the attachment id without attachment_uri.
+
+    """
+    _sync_pixel_data(dcm)
+    if doc_format == DICOMJSON_FORMAT:
+        tag2str = _dicomjson_tag2str
+
+        def bulk_data_uri(tagstack, element):
+            """ Reference the attachment holding the element """
+            id = _tagstack2id(tagstack + [element.tag], tag2str)
+            if attachment_uri is None:
+                return quote(id)
+            return attachment_uri(id, element.value)
+
+        jsn, binary_elements = pydicom2dicomjson(dcm, bulk_data_uri)
+        jsn[DAO_KEY] = {'format': DICOMJSON_FORMAT}
+    else:
+        tag2str = _tag2str
+        jsn, binary_elements, file_meta_binary_elements = pydicom2json(dcm)
+    ids = [_tagstack2id(tagstack + [element.tag], tag2str)
+           for tagstack, element in binary_elements]
+    return jsn, binary_elements, ids
+
+
+def _sync_pixel_data(dcm):
+    """ Store changes made to dcm.pixel_array in PixelData
+
+    Only an array pydicom has already decoded is written back,
+    we never decode pixel data just to store it. Encapsulated
+    pixel data is left alone, as are arrays pydicom has
+    converted to another photometric interpretation or that
+    no longer fit the pixel data.
+
+    """
+    array = getattr(dcm, '_pixel_array', None)
+    if array is None or 'PixelData' not in dcm:
+        return
+    element = dcm['PixelData']
+    if element.is_undefined_length:
+        return  # Encapsulated, and our array is decompressed
+    if str(dcm.get('PhotometricInterpretation', '')).startswith('YBR'):
+        return  # pixel_array may have been converted to RGB
+    if array.nbytes == len(element.value):
+        dcm.PixelData = array.tobytes()
+
+
+def _doc2pydicom(doc):
+    """ Convert a document in either format into a DICOM object
+
+    Returns the tuple (dcm, str2tag), where str2tag converts
+    the tags in the document's attachment ids.
+
+    """
+    if _doc_format(doc) == DICOMJSON_FORMAT:
+        return dicomjson2pydicom(doc), _dicomjson_str2tag
+    return json2pydicom(doc), _str2tag
+
+
+def _check_criteria(criteria):
+    """ Raise ValueError unless all criteria are in QUERY_VIEWS """
+    unknown = [keyword for keyword in criteria
+               if keyword not in QUERY_VIEWS]
+    if unknown or not criteria:
+        raise ValueError("Can only query on %s, not %s" % (
+            ', '.join(QUERY_VIEWS), ', '.join(unknown) or 'nothing'))
+
+
+def _sql_where(criteria):
+    """ Return the SQL condition and parameters for criteria """
+    _check_criteria(criteria)
+    clauses = []
+    params = []
+    for keyword, value in criteria.items():
+        if isinstance(value, tuple):
+            clauses.append('%s BETWEEN ? AND ?' % keyword)
+            params.extend(value)
+        else:
+            clauses.append('%s = ?' % keyword)
+            params.append(value)
+    return ' AND '.join(clauses), params
+
+
+def _query_value(dcm, keyword):
+    """ Return the value we index dcm by for a QUERY_VIEWS keyword """
+    value = dcm.get(keyword)
+    if value is None or value == '':
+        return None
+    return str(value)
+
+
+def _design_views():
+    """ Return the map functions for QUERY_VIEWS and the
+        map/reduce functions for SERIES_VIEW
+
+    Each view emits the attribute value of documents in
+    either of our formats, and nothing for design docs.
+
+    """
+    views = {}
+    for keyword, view in QUERY_VIEWS.items():
+        views[view] = {'map': _view_map_function(keyword)}
+    views[SERIES_VIEW] = {'map': _view_map_function('SeriesInstanceUID'),
+                          'reduce': '_count'}
+    return views
+
+
+def _view_map_function(keyword):
+    """ Return the map function emitting keyword's value """
+    tag = pydicom.tag.Tag(pydicom.datadict.tag_for_keyword(keyword))
+    return _VIEW_MAP_FUNCTION % {'dicomjson': _dicomjson_tag2str(tag),
+                                 'legacy': _tag2str(tag)}
+
+
+def _sort_instances(datasets):
+    """ Sort the datasets of a series by InstanceNumber """
+    return sorted(datasets, key=lambda dcm: int(dcm.get('InstanceNumber')
+                                                or 0))
+
+
+def _matches(dcm, keyword, value):
+    """ Check a dataset attribute against a query criterion """
+    actual = _query_value(dcm, keyword)
+    if actual is None:
+        return False
+    if isinstance(value, tuple):
+        return value[0] <= actual <= value[1]
+    return actual == value
+
+
+def _new_hash(hash_name):
+    """ Return a new hash object for hash_name """
+    if hash_name.startswith('xxh'):
+        if not have_xxhash:
+            raise ImportError("xxhash is not available. "
+                              "See https://pypi.org/project/xxhash/ "
+                              "to download and install")
+        return getattr(xxhash, hash_name)()
+    return hashlib.new(hash_name)
 
 
-def _strip_elements(jsn, elements):
-    """ Remove supplied elements from the dict object
+def _best_codec():
+    """ Return the best codec that is installed """
+    if have_zstandard:
+        return 'zstd'
+    if have_lz4:
+        return 'lz4'
+    return 'zlib'
 
-    We use this with a list of binary elements so that
-    we don't store empty tags in couchdb when we are
-    already storing the binary data as
-    attachments.
+
+def _new_compressor(codec):
+    """ Return a streaming compressor for codec, None for no codec
+
+    Compressors have compress(data) and flush() methods,
+    like zlib's.
+
+    """
+    if codec is None:
+        return None
+    if codec == 'zlib':
+        return zlib.compressobj(1)
+    if codec == 'zstd':
+        if not have_zstandard:
+            raise ImportError("zstandard is not available. "
+                              "See https://pypi.org/project/zstandard/ "
+                              "to download and install")
+        return zstandard.ZstdCompressor().compressobj()
+    if codec == 'lz4':
+        if not have_lz4:
+            raise ImportError("lz4 is not available. "
+                              "See https://pypi.org/project/lz4/ "
+                              "to download and install")
+        return _LZ4Compressor()
+    raise ValueError("Unknown codec '%s'" % codec)
+
+
+def _new_decompressor(codec):
+    """ Return a streaming decompressor for codec, None for no
+        codec. Decompressors have a decompress(data) method. """
+    if codec is None:
+        return None
+    if codec == 'zlib':
+        return zlib.decompressobj()
+    _new_compressor(codec)  # Raise ImportError if not installed
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj()
+    return lz4.frame.LZ4FrameDecompressor()
+
+
+class _LZ4Compressor(object):
+    """ Give lz4.frame.LZ4FrameCompressor zlib's interface """
+
+    def __init__(self):
+        self._compressor = lz4.frame.LZ4FrameCompressor()
+        self._header = self._compressor.begin()
+
+    def compress(self, data):
+        header, self._header = self._header, b''
+        return header + self._compressor.compress(data)
+
+    def flush(self):
+        header, self._header = self._header, b''
+        return header + self._compressor.flush()
+
+
+def _codec_content_type(codec):
+    """ Return the attachment content type for codec """
+    if codec is None:
+        return ATTACHMENT_CONTENT_TYPE
+    return CODEC_CONTENT_TYPES[codec]
+
+
+def _content_type_codec(content_type):
+    """ Return the codec for an attachment content type """
+    for codec, codec_content_type in CODEC_CONTENT_TYPES.items():
+        if content_type == codec_content_type:
+            return codec
+    return None
+
+
+def _blob_id(value):
+    """ Return the id of the blob document for value """
+    return BLOB_PREFIX + hashlib.new(BLOB_HASH, value).hexdigest()
+
+
+def _is_dataset_id(id):
+    """ Return false for the ids of our design and blob documents """
+    return not (id.startswith('_design/') or id.startswith(BLOB_PREFIX))
+
+
+def _doc_blobs(doc):
+    """ Map attachment ids to the blobs a document uses """
+    return doc.get(DAO_KEY, {}).get('blobs', {})
+
+
+def _stub_digests(attachments):
+    """ Map couchdb attachment stubs to (length, 'md5', digest,
+        codec)
+
+    Couchdb reports the digest as 'md5-' followed by the
+    base64 encoded md5 of the attachment. Our attachments
+    are application/octet-stream, which couchdb does not
+    compress, so this is the md5 of the element value, or
+    one of CODEC_CONTENT_TYPES, in which case length and
+    digest are of the value compressed with codec.
+
+    """
+    digests = {}
+    for id, stub in attachments.items():
+        content_type = stub.get('content_type')
+        codec = _content_type_codec(content_type)
+        if content_type != ATTACHMENT_CONTENT_TYPE and codec is None:
+            continue  # Not one of ours
+        algorithm, _, digest = stub.get('digest', '').partition('-')
+        if algorithm == 'md5' and 'length' in stub:
+            digests[id] = (stub['length'], 'md5', base64.b64decode(digest),
+                           codec)
+    return digests
+
+
+def _add_element(dcm, tagstack, value, str2tag=None):
+    """ Add element with tag, vr and value to dcm
+        at location tagstack
+
+    tagstack alternates tags and sequence item indices,
+    tag first, as _tagstack2id writes them. They are told
+    apart by position, as a DICOM JSON tag such as
+    '54000100' is all digits.
+
+    If the element is already there, e.g. as a DICOM
+    JSON BulkDataURI placeholder, its VR is kept.
 
     """
-    for tagstack, element in elements:
-        if len(tagstack) == 0:
-            jsn.pop(element.tag)
+    str2tag = str2tag or _str2tag
+    current_node = dcm
+    for i, item in enumerate(tagstack[:-1]):
+        if i % 2:
+            address = int(item)
         else:
-            current_node = jsn
-            for tag in tagstack:
-                current_node = current_node[tag]
-            current_node.pop(element.tag)
+            address = str2tag(item)
+        current_node = current_node[address]
+    tag = str2tag(tagstack[-1])
+    if tag in current_node:
+        vr = current_node[tag].VR
+    else:
+        vr = _tag2vr(tag)
+    current_node[tag] = pydicom.dataelem.DataElement(tag, vr, value)
+
+
+def _tagstack2id(tagstack, tag2str=None):
+    """ Convert a list of tags to a unique
+        (within document) attachment id """
+    tag2str = tag2str or _tag2str
+    return ':'.join([tag2str(tag) if isinstance(tag, pydicom.tag.BaseTag)
+                     else str(tag) for tag in tagstack])
 
 
 def _set_meta_info_dcm(dcm):
@@ -271,10 +1935,12 @@ def _set_meta_info_dcm(dcm):
     a DataSet from scratch, otherwise we cannot use
     foo.pixel_array or pydicom.dcmwrite(foo).
 
-    This code is lifted from PyDicom.
+    This code is lifted from PyDicom. Like PyDicom we assume
+    Implicit VR Little Endian when there is no file meta.
 
     """
-    TransferSyntax = dcm.file_meta.TransferSyntaxUID
+    TransferSyntax = dcm.file_meta.get('TransferSyntaxUID',
+                                       pydicom.uid.ImplicitVRLittleEndian)
     if TransferSyntax == pydicom.uid.ExplicitVRLittleEndian:
         dcm.is_implicit_vr = False
 
@@ -304,14 +1970,20 @@ def _set_meta_info_dcm(dcm):
         dcm.is_implicit_vr = False
         dcm.is_little_endian = True
 
+    # Documents don't record the length of PixelData, so mark
+    # encapsulated pixel data as PyDicom would have read it
+    if 'PixelData' in dcm and pydicom.uid.UID(TransferSyntax).is_compressed:
+        dcm['PixelData'].is_undefined_length = True
+
 
 def pydicom2json(dcm):
     """ Convert the supplied PyDicom object into a
         json-serializable dict
 
     Binary elements cannot be represented in json
-    so we return these as as separate list of the
-    tuple (tagstack, element), where:
+    so we leave them out of the dict and return them
+    as a separate list of the tuple (tagstack, element),
+    where:
      - element  = pydicom.dataelem.DataElement
      - tagstack = list of tags/sequence IDs that address
                   the element
@@ -322,120 +1994,469 @@ def pydicom2json(dcm):
     the attachment we can then insert it at the
     appropriate point in the tree.
 
+    Private tags are kept. dcm is not changed, so there is
+    no need to copy it first.
+
     """
-    dcm.remove_private_tags()  # No support for now
-    dcm.decode()               # Convert to unicode
     binary_elements = []
-    tagstack = []
-    jsn = dict((key, __jsonify(dcm[key], binary_elements, tagstack))
-               for key in dcm.keys())
+    jsn = _jsonify_dataset(dcm, binary_elements, [])
     file_meta_binary_elements = []
-    jsn['file_meta'] = dict((key, __jsonify(dcm.file_meta[key],
-                            file_meta_binary_elements, tagstack))
-                            for key in dcm.file_meta.keys())
+    jsn['file_meta'] = _jsonify_dataset(dcm.file_meta,
+                                        file_meta_binary_elements, [])
     return jsn, binary_elements, file_meta_binary_elements
 
 
-def __jsonify(element, binary_elements, tagstack):
-    """ Convert key, value to json-serializable types
+def _jsonify_dataset(dataset, binary_elements, tagstack):
+    """ Convert a Dataset to a dict of json-serializable types
 
-    Recursive, so if value is key/value pairs then
-    all children will get converted
+    Recursive, so the items of any sequences
+    get converted too. VRs the DICOM dictionary would not
+    give us back, e.g. for private tags, are kept under
+    VR_KEY, binary elements included.
 
     """
-    value = element.value
-    if element.VR in BINARY_VR_VALUES:
-        binary_elements.append((tagstack[:], element))
-        return ''
-    elif type(value) == list:
-        new_list = [__typemap(listvalue) for listvalue in value]
-        return new_list
-    elif type(value) == pydicom.sequence.Sequence:
-        tagstack.append(element.tag)
-        nested_data = []
-        for i in range(0, len(value)):
-            tagstack.append(i)
-            nested_data.append(
-                dict((subkey, __jsonify(value[i][subkey],
-                                        binary_elements, tagstack))
-                     for subkey in value[i].keys()))
+    jsn = {}
+    vrs = {}
+    for element in dataset:
+        vr = element.VR
+        if vr != _dictionary_vr(element.tag):
+            vrs[_tag2str(element.tag)] = vr
+        if vr in _BINARY_VRS:
+            binary_elements.append((tagstack[:], element))
+            continue
+
+        value = element.value
+        if vr == 'SQ':
+            tagstack.append(element.tag)
+            items = []
+            for i, item in enumerate(value):
+                tagstack.append(i)
+                items.append(_jsonify_dataset(item, binary_elements,
+                                              tagstack))
+                tagstack.pop()
             tagstack.pop()
-        tagstack.pop()
-        return nested_data
-    else:
-        return __typemap(value)
-
-
-def __typemap(value):
-    """ Map PyDicom types that won't serialize
-        to JSON types """
-    if type(value) == pydicom.uid.UID:
-        return uid2str(value)
-    elif isinstance(value, pydicom.tag.BaseTag):
-        return int(value)
-    else:
-        return value
+            value = items
+        elif vr in _JSON_TYPEMAP and value is not None:
+            typemap = _JSON_TYPEMAP[vr]
+            if isinstance(value, _MULTI_VALUE_TYPES):
+                value = [typemap(item) for item in value]
+            else:
+                value = typemap(value)
+        elif isinstance(value, _MULTI_VALUE_TYPES):
+            value = list(value)
+        jsn[_tag2str(element.tag)] = value
+    if vrs:
+        jsn[VR_KEY] = vrs
+    return jsn
 
 
 def json2pydicom(jsn):
     """ Convert the supplied json dict into
         a PyDicom object """
-    dataset = pydicom.dataset.Dataset()
-    # Don't try to convert couch specific tags
-    dicom_keys = [
-        key for key in jsn.keys()
-        if key not in ['_rev', '_id', '_attachments', 'file_meta']
-    ]
-    for key in dicom_keys:
-        dataset.add(__dicomify(key, jsn[key]))
-    file_meta = pydicom.dataset.Dataset()
-    for key in jsn['file_meta']:
-        file_meta.add(__dicomify(key, jsn['file_meta'][key]))
-    dataset.file_meta = file_meta
+    dataset = _dicomify_dataset(jsn)
+    dataset.file_meta = _dicomify_dataset(jsn['file_meta'], _FileMetaDataset)
     return dataset
 
 
-def __dicomify(key, value):
-    """ Convert a json key, value to a PyDicom DataElement """
-    tag = __str2tag(key)
+def _dicomify_dataset(jsn, dataset_class=pydicom.dataset.Dataset):
+    """ Convert a json dict to a Dataset of DataElement objects
 
-    # 0 tag implies group length (filreader.py pydicom)
-    if tag.element == 0:
-        vr = 'UL'
-    else:
-        vr = pydicom.datadict.dictionary_VR(tag)
+    Only keys that look like tags are converted, so couch
+    specific keys (_id, _rev, _attachments) and file_meta
+    are skipped. VRs are looked up in the dictionary unless
+    the document kept them, as older documents did not.
+    Binary elements with a kept VR get a placeholder with
+    no value, which their attachment fills in.
+
+    """
+    dataset = dataset_class()
+    vrs = jsn.get(VR_KEY, {})
+    for key, vr in vrs.items():
+        if key not in jsn:
+            tag = _str2tag(key)
+            dataset.add(pydicom.dataelem.DataElement(
+                tag, _VR_ALIASES.get(vr, vr), None))
+    for key, value in jsn.items():
+        if key[:1] != '(':
+            continue
+        tag = _str2tag(key)
+        vr = vrs.get(key) or _tag2vr(tag)
+        vr = _VR_ALIASES.get(vr, vr)
+        if vr in _DICOMIFY_TYPEMAP:
+            vr, value = _DICOMIFY_TYPEMAP[vr](value)
+        dataset.add(_data_element(tag, vr, value))
+    return dataset
+
+
+def _dicomify_sequence(value):
+    """ Convert a json list of dicts to a Sequence """
+    return 'SQ', pydicom.sequence.Sequence([_dicomify_dataset(item)
+                                            for item in value])
 
-    if vr == 'OW/OB':  # Always write pixel data as bytes
-        vr = 'OB'      # rather than words
 
-    if vr == 'US or SS':    # US or SS is up to us as the data is already
-        if value < 0:       # decoded. We therefore choose US, unless we
-            vr = 'SS'       # need a signed value.
+def _dicomify_us_or_ss(value):
+    """ Pick a VR for 'US or SS' elements
+
+    US or SS is up to us as the data is already decoded.
+    We therefore choose US, unless we need a signed value.
+
+    """
+    values = value if isinstance(value, list) else [value]
+    if any(item is not None and item < 0 for item in values):
+        return 'SS', value
+    return 'US', value
+
+
+def _tag2str(tag):
+    """ Convert a Tag into the string we use as a json key
+
+    This is the '(gggg, eeee)' form that older PyDicom
+    versions gave for str(tag). We build it ourselves so
+    keys and attachment ids don't change with PyDicom.
+
+    """
+    try:
+        return _TAG_STRINGS[tag]
+    except KeyError:
+        key = '(%04x, %04x)' % (tag >> 16, tag & 0xffff)
+        _TAG_STRINGS[tag] = key
+        return key
+
+
+def _str2tag(key):
+    """ Convert string representation of a tag into a Tag """
+    try:
+        return _STRING_TAGS[key]
+    except KeyError:
+        tag = pydicom.tag.Tag(int(key[1:5], 16), int(key[-5:-1], 16))
+        _STRING_TAGS[key] = tag
+        return tag
+
+
+def _tag2vr(tag):
+    """ Return the VR to use when converting tag from json """
+    try:
+        return _TAG_VRS[tag]
+    except KeyError:
+        vr = _dictionary_vr(tag)
+        if vr is None:
+            vr = pydicom.datadict.dictionary_VR(tag)  # Raises KeyError
+        vr = _VR_ALIASES.get(vr, vr)
+        _TAG_VRS[tag] = vr
+        return vr
+
+
+def _dictionary_vr(tag):
+    """ Return the VR of tag in the DICOM dictionary,
+        or None for tags it doesn't know """
+    try:
+        return _DICTIONARY_VRS[tag]
+    except KeyError:
+        # 0 tag implies group length (filreader.py pydicom)
+        if tag.element == 0:
+            vr = 'UL'
         else:
-            vr = 'US'
-
-    if vr == 'SQ':  # We have a sequence of datasets, so we recurse
-        seq_list = [__make_dataset([__dicomify(subkey, listvalue[subkey])
-                                    for subkey in listvalue.keys()])
-                    for listvalue in value
-                    ]
-        seq = pydicom.sequence.Sequence(seq_list)
-        return pydicom.dataelem.DataElement(tag, vr, seq)
-    else:
+            try:
+                vr = pydicom.datadict.dictionary_VR(tag)
+            except KeyError:
+                vr = None
+        _DICTIONARY_VRS[tag] = vr
+        return vr
+
+
+def _ds2json(value):
+    """ Return a DS value as a json number, or unchanged if
+        it is not a number, e.g. an invalid string pydicom
+        kept as it was read """
+    if isinstance(value, (int, float, decimal.Decimal)):
+        return float(value)
+    return value
+
+
+def _is2json(value):
+    """ Return an IS value as a json number, or unchanged if
+        it is not a number, as for _ds2json """
+    if isinstance(value, int):
+        return int(value)
+    return value
+
+
+def _data_element(tag, vr, value):
+    """ Create a DataElement from a json value
+
+    IS and DS values pydicom can't convert are kept as the
+    strings they are, as pydicom does when reading a file.
+
+    """
+    try:
         return pydicom.dataelem.DataElement(tag, vr, value)
+    except ValueError:
+        if vr not in ('DS', 'IS'):
+            raise
+        if isinstance(value, list):
+            value = pydicom.multival.MultiValue(str, value)
+        return pydicom.dataelem.DataElement(tag, vr, value,
+                                            already_converted=True)
+
+
+# Lookup tables for the json <-> pydicom conversion. Every
+# dataset uses much the same few hundred tags, so the caches
+# mean a tag string is parsed, and a VR looked up in the
+# dictionary, once per tag rather than once per element.
+_TAG_STRINGS = {}
+_STRING_TAGS = {}
+_TAG_VRS = {}
+_DICTIONARY_VRS = {}
+
+# Binary elements, under the VR names used by both old and
+# current PyDicom versions
+_BINARY_VRS = frozenset(BINARY_VR_VALUES + [
+    'OB or OW', 'US or SS or OW', 'OD', 'OF', 'OL', 'OV', 'UN'])
+
+_MULTI_VALUE_TYPES = (list, tuple, pydicom.multival.MultiValue)
+
+# Types that won't serialize to json, by VR
+_JSON_TYPEMAP = {
+    'AT': int,
+    'DS': _ds2json,
+    'IS': _is2json,
+    'PN': str,
+}
+
+# Always write pixel data as bytes rather than words
+_VR_ALIASES = {
+    'OW/OB': 'OB',
+    'OB or OW': 'OB',
+    'US or SS or OW': 'OB',
+}
+
+# Elements whose json value (and perhaps VR) need converting
+_DICOMIFY_TYPEMAP = {
+    'SQ': _dicomify_sequence,
+    'US or SS': _dicomify_us_or_ss,
+}
+
+_FileMetaDataset = getattr(pydicom.dataset, 'FileMetaDataset',
+                           pydicom.dataset.Dataset)
+
+
+def pydicom2dicomjson(dcm, bulk_data_uri=None,
+                      bulk_data_threshold=BULK_DATA_THRESHOLD):
+    """ Convert the supplied PyDicom object into a
+        DICOM JSON Model (PS3.18 F.2) dict
+
+    Unlike pydicom2json every element keeps its VR and
+    private tags are kept, so converting back needs no
+    dictionary lookups. The file meta information is
+    stored the same way under the 'file_meta' key.
+
+    Binary values longer than bulk_data_threshold bytes
+    are not included. They are referenced by the URI that
+    bulk_data_uri(tagstack, element) returns and also
+    returned as a list of (tagstack, element) tuples, as
+    for pydicom2json. Without bulk_data_uri all binary
+    values are stored inline.
+
+    The dataset is not modified.
+
+    """
+    if bulk_data_uri is None:
+        bulk_data_threshold = None
+    binary_elements = []
+    jsn = _dicomjson_dataset(dcm, dcm, binary_elements, [], bulk_data_uri,
+                             bulk_data_threshold)
+    file_meta = getattr(dcm, 'file_meta', pydicom.dataset.Dataset())
+    jsn['file_meta'] = _dicomjson_dataset(file_meta, dcm, [], [], None, None)
+    return jsn, binary_elements
+
+
+def _dicomjson_dataset(dataset, root, binary_elements, tagstack,
+                       bulk_data_uri, bulk_data_threshold):
+    """ Convert a Dataset to a DICOM JSON dict, recursing into
+        sequences """
+    jsn = {}
+    for element in dataset:
+        vr = element.VR
+        if vr in _AMBIGUOUS_VRS:
+            vr = _resolve_ambiguous_vr(element, root)
+        value = element.value
+        attribute = {'vr': vr}
+        if vr == 'SQ':
+            tagstack.append(element.tag)
+            items = []
+            for i, item in enumerate(value):
+                tagstack.append(i)
+                items.append(_dicomjson_dataset(item, root, binary_elements,
+                                                tagstack, bulk_data_uri,
+                                                bulk_data_threshold))
+                tagstack.pop()
+            tagstack.pop()
+            if items:
+                attribute['Value'] = items
+        elif vr in _DICOMJSON_BINARY_VRS:
+            if not value:
+                pass
+            elif (bulk_data_threshold is not None and
+                    len(value) > bulk_data_threshold):
+                binary_elements.append((tagstack[:], element))
+                attribute['BulkDataURI'] = bulk_data_uri(tagstack, element)
+            else:
+                attribute['InlineBinary'] = \
+                    base64.b64encode(value).decode('ascii')
+        elif value is not None and value != '':
+            if not isinstance(value, _MULTI_VALUE_TYPES):
+                value = [value]
+            typemap = _DICOMJSON_TYPEMAP.get(vr)
+            if typemap is not None:
+                value = [typemap(item) if item != '' else None
+                         for item in value]
+            else:
+                value = [item if item != '' else None for item in value]
+            attribute['Value'] = value
+        jsn[_dicomjson_tag2str(element.tag)] = attribute
+    return jsn
+
+
+def _resolve_ambiguous_vr(element, root):
+    """ Return the VR element would be written with
+
+    PyDicom leaves VRs such as 'US or SS' ambiguous when
+    reading implicit VR files, but DICOM JSON needs a
+    real VR. We let PyDicom work it out from the rest of
+    the dataset, on a copy so the dataset is unchanged.
 
+    """
+    try:
+        from pydicom.filewriter import correct_ambiguous_vr_element
+        resolved = correct_ambiguous_vr_element(
+            copy.copy(element), root, getattr(root, 'is_little_endian',
+                                              True))
+        if resolved.VR not in _AMBIGUOUS_VRS:
+            return resolved.VR
+    except (AttributeError, ImportError, ValueError):
+        pass
+    if isinstance(element.value, bytes):
+        return 'OW' if 'OW' in element.VR else 'OB'
+    return 'US'
+
+
+def dicomjson2pydicom(jsn):
+    """ Convert the supplied DICOM JSON Model dict into
+        a PyDicom object
+
+    Elements given by BulkDataURI are added with an empty
+    value, to be filled in from their attachments.
 
-def __make_dataset(data_elements):
-    """ Create a Dataset from a list of DataElement objects """
-    dataset = pydicom.dataset.Dataset()
-    for element in data_elements:
-        dataset.add(element)
+    """
+    dataset = _dicomify_dicomjson(jsn)
+    dataset.file_meta = _dicomify_dicomjson(jsn.get('file_meta', {}),
+                                            _FileMetaDataset)
     return dataset
 
 
-def __str2tag(key):
-    """ Convert string representation of a tag into a Tag """
-    return pydicom.tag.Tag((int(key[1:5], 16), int(key[7:-1], 16)))
+def _dicomify_dicomjson(jsn, dataset_class=pydicom.dataset.Dataset):
+    """ Convert a DICOM JSON dict to a Dataset
+
+    Keys other than tags, such as couch specific keys
+    and file_meta, are skipped.
+
+    """
+    dataset = dataset_class()
+    for key, attribute in jsn.items():
+        if len(key) != 8 or key[0] == '_':
+            continue
+        tag = _dicomjson_str2tag(key)
+        vr = attribute['vr']
+        if 'Value' in attribute:
+            value = attribute['Value']
+            if vr == 'SQ':
+                value = pydicom.sequence.Sequence(
+                    [_dicomify_dicomjson(item) for item in value])
+            else:
+                typemap = _DICOMIFY_DICOMJSON_TYPEMAP.get(vr)
+                if typemap is not None:
+                    value = [typemap(item) if item is not None else ''
+                             for item in value]
+                if len(value) == 1:
+                    value = value[0]
+        elif 'InlineBinary' in attribute:
+            value = base64.b64decode(attribute['InlineBinary'])
+        elif vr == 'SQ':
+            value = pydicom.sequence.Sequence()
+        elif vr in _DICOMJSON_TEXT_VRS:
+            value = ''
+        else:
+            value = None
+        dataset.add(_data_element(tag, vr, value))
+    return dataset
+
+
+def _dicomjson_tag2str(tag):
+    """ Convert a Tag into a DICOM JSON key, e.g. '7FE00010' """
+    try:
+        return _DICOMJSON_TAG_STRINGS[tag]
+    except KeyError:
+        key = '%08X' % tag
+        _DICOMJSON_TAG_STRINGS[tag] = key
+        return key
+
+
+def _dicomjson_str2tag(key):
+    """ Convert a DICOM JSON key into a Tag """
+    try:
+        return _DICOMJSON_STRING_TAGS[key]
+    except KeyError:
+        tag = pydicom.tag.Tag(int(key, 16))
+        _DICOMJSON_STRING_TAGS[key] = tag
+        return tag
+
+
+def _person_name2dicomjson(value):
+    """ Split a PN value into its DICOM JSON component groups """
+    groups = str(value).split('=')
+    return dict((name, group) for name, group in
+                zip(('Alphabetic', 'Ideographic', 'Phonetic'), groups)
+                if group)
+
+
+def _dicomjson2person_name(value):
+    """ Join DICOM JSON PN component groups into a PN value """
+    groups = [value.get(name, '') for name in
+              ('Alphabetic', 'Ideographic', 'Phonetic')]
+    return '='.join(groups).rstrip('=')
+
+
+_DICOMJSON_TAG_STRINGS = {}
+_DICOMJSON_STRING_TAGS = {}
+
+_AMBIGUOUS_VRS = frozenset(['OW/OB', 'OB or OW', 'US or SS',
+                            'US or SS or OW', 'US or OW'])
+
+_DICOMJSON_BINARY_VRS = frozenset(['OB', 'OD', 'OF', 'OL', 'OV', 'OW',
+                                   'UN'])
+
+_DICOMJSON_TEXT_VRS = frozenset(['AE', 'AS', 'CS', 'DA', 'DT', 'LO', 'LT',
+                                 'PN', 'SH', 'ST', 'TM', 'UC', 'UI', 'UR',
+                                 'UT'])
+
+# Values that need converting to the DICOM JSON types, by VR
+_DICOMJSON_TYPEMAP = {
+    'AT': _dicomjson_tag2str,
+    'DS': _ds2json,
+    'IS': _is2json,
+    'PN': _person_name2dicomjson,
+}
+
+# And back again
+_DICOMIFY_DICOMJSON_TYPEMAP = {
+    'AT': _dicomjson_str2tag,
+    'PN': _dicomjson2person_name,
+}
+
+
+def _doc_format(doc):
+    """ Return the format a couch document was stored in """
+    return doc.get(DAO_KEY, {}).get('format', LEGACY_FORMAT)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+"""
+dicom_dao_archive
+
+Export a dicom_dao store to a zip or tar archive of DICOM Part 10
+files, or import such an archive into a store.
+
+Exports stream: the store is read a page of documents at a time
+and each dataset is written to the archive before the next one
+is read, so memory use does not grow with the size of the store.
+Each file in the archive is named after the key of its dataset.
+
+Imports read the archive one file at a time and write batches of
+datasets with DicomStore.update(), a single _bulk_docs request
+per batch for DicomCouch, from several threads at once. Only a
+few batches are held in memory at a time.
+
+The archive format follows the file name: .zip, .tar, .tar.gz,
+.tgz, .tar.bz2 or .tar.xz. Use - to write a tar stream to stdout
+or read one from stdin.
+
+run with
+dicom_dao_archive.py export --couch http://127.0.0.1:5984 backup.zip
+dicom_dao_archive.py import --sqlite /data/archive backup.zip --workers 1
+dicom_dao_archive.py export --sqlite /data/archive - | ssh host ...
+
+Files are written with pydicom 3's enforce_file_format. Older
+versions of pydicom write them with write_like_original=False,
+which also adds the file meta information where it is missing.
+
+"""
+#
+# This file is released under the pydicom license.
+#    See the file LICENSE included with the pydicom distribution, also
+#    available at https://github.com/pydicom/pydicom
+#
+
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import os
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+from urllib.parse import quote, unquote
+
+import couchdb
+import pydicom
+
+import dicom_dao
+
+SUFFIX = '.dcm'
+TAR_MODES = [('.tar.gz', 'gz'), ('.tgz', 'gz'), ('.tar.bz2', 'bz2'),
+             ('.tar.xz', 'xz'), ('.tar', '')]
+
+# dcmwrite() takes enforce_file_format from pydicom 3 on
+_HAVE_ENFORCE_FILE_FORMAT = int(pydicom.__version__.split('.')[0]) >= 3
+
+
+def member_name(key):
+    """ Return the archive file name for a key """
+    return quote(key, safe='') + SUFFIX
+
+
+def member_key(name):
+    """ Return the key for an archive file name """
+    name = os.path.basename(name)
+    if name.endswith(SUFFIX):
+        name = name[:-len(SUFFIX)]
+    return unquote(name)
+
+
+def dataset_bytes(dcm):
+    """ Return dcm as a DICOM Part 10 file
+
+    Datasets stored without a transfer syntax are written
+    as Implicit VR Little Endian, as they were read.
+
+    """
+    buf = io.BytesIO()
+    no_syntax = 'TransferSyntaxUID' not in getattr(dcm, 'file_meta', {})
+    if not _HAVE_ENFORCE_FILE_FORMAT:
+        if no_syntax:
+            dcm.is_implicit_VR = True
+            dcm.is_little_endian = True
+        pydicom.dcmwrite(buf, dcm, write_like_original=False)
+        return buf.getvalue()
+    options = {}
+    if no_syntax:
+        options = {'implicit_vr': True, 'little_endian': True}
+    pydicom.dcmwrite(buf, dcm, enforce_file_format=True, **options)
+    return buf.getvalue()
+
+
+def archive_kind(path):
+    """ Return 'zip', or the tar compression ('' for none) """
+    if path == '-':
+        return ''
+    if path.endswith('.zip'):
+        return 'zip'
+    for suffix, compression in TAR_MODES:
+        if path.endswith(suffix):
+            return compression
+    raise ValueError("Unknown archive format for %s" % path)
+
+
+def export_archive(store, path, page_size=dicom_dao.PAGE_SIZE):
+    """ Write every dataset in store to the archive at path
+
+    Returns the number of datasets written.
+
+    """
+    kind = archive_kind(path)
+    count = 0
+    if kind == 'zip':
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for key, dcm in store.iter_items(page_size):
+                archive.writestr(member_name(key), dataset_bytes(dcm))
+                count += 1
+        return count
+
+    if path == '-':
+        archive = tarfile.open(fileobj=sys.stdout.buffer, mode='w|')
+    else:
+        archive = tarfile.open(path, 'w:' + kind)
+    with archive:
+        for key, dcm in store.iter_items(page_size):
+            data = dataset_bytes(dcm)
+            info = tarfile.TarInfo(member_name(key))
+            info.size = len(data)
+            info.mtime = time.time()
+            archive.addfile(info, io.BytesIO(data))
+            count += 1
+    return count
+
+
+def read_archive(path):
+    """ Yield (name, bytes) for each file in the archive at path """
+    kind = archive_kind(path)
+    if kind == 'zip':
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    yield info.filename, archive.read(info)
+        return
+
+    if path == '-':
+        archive = tarfile.open(fileobj=sys.stdin.buffer, mode='r|*')
+    else:
+        archive = tarfile.open(path, 'r:*')
+    with archive:
+        for info in archive:
+            if info.isfile():
+                yield info.name, archive.extractfile(info).read()
+
+
+def import_archive(store_factory, path, batch_size=50, workers=4,
+                   key_from_dataset=False):
+    """ Write every DICOM file in the archive at path to a store
+
+    store_factory() is called once in each worker thread to
+    open the store it writes to. Files are keyed by their name
+    in the archive, as export_archive() writes them, or with
+    key_from_dataset by DicomStore.key() of their dataset.
+
+    Returns the number of datasets written.
+
+    """
+    local = threading.local()
+
+    def write_batch(batch):
+        """ Write a batch with this thread's store """
+        if not hasattr(local, 'store'):
+            local.store = store_factory()
+        local.store.update(batch)
+        return len(batch)
+
+    count = 0
+    pending = set()
+    batch = []
+    key_store = store_factory() if key_from_dataset else None
+    try:
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            for name, data in read_archive(path):
+                dcm = pydicom.dcmread(io.BytesIO(data), force=True)
+                if key_from_dataset:
+                    key = key_store.key(dcm)
+                else:
+                    key = member_key(name)
+                batch.append((key, dcm))
+                if len(batch) < batch_size:
+                    continue
+                pending.add(executor.submit(write_batch, batch))
+                batch = []
+                # Keep memory bounded by not reading too far ahead
+                while len(pending) >= 2 * workers:
+                    done, pending = concurrent.futures.wait(
+                        pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    count += sum(future.result() for future in done)
+            if batch:
+                pending.add(executor.submit(write_batch, batch))
+            count += sum(future.result() for future in
+                         concurrent.futures.as_completed(pending))
+    finally:
+        if key_store is not None:
+            key_store.close()
+    return count
+
+
+def store_factory(args):
+    """ Return a function opening the store args name """
+    if args.sqlite:
+        return lambda: dicom_dao.DicomSQLite(args.sqlite, level=args.level)
+    if args.couch:
+        return lambda: dicom_dao.DicomCouch(args.couch, args.couch_db,
+                                            doc_format=args.doc_format,
+                                            level=args.level)
+    raise ValueError("Give a store with --couch or --sqlite")
+
+
+def parse_args(argv=None):
+    """Argument parser for dicom_dao_archive"""
+    parser = argparse.ArgumentParser(
+        description="Export or import dicom_dao stores as archives "
+                    "of DICOM files")
+    parser.add_argument("command",
+                        choices=['export', 'import'],
+                        help="Export the store to the archive, or import "
+                             "the archive into the store")
+    parser.add_argument("archive",
+                        help="zip or tar archive, - for a tar stream on "
+                             "stdout or stdin")
+    parser.add_argument("--couch",
+                        dest='couch',
+                        type=str,
+                        help="CouchDB server URL")
+    parser.add_argument("--couch-db",
+                        dest='couch_db',
+                        type=str,
+                        default='dicom',
+                        help="CouchDB database name (default dicom)")
+    parser.add_argument("--sqlite",
+                        dest='sqlite',
+                        type=str,
+                        help="DicomSQLite directory")
+    parser.add_argument("--doc-format",
+                        dest='doc_format',
+                        choices=[dicom_dao.LEGACY_FORMAT,
+                                 dicom_dao.DICOMJSON_FORMAT],
+                        default=dicom_dao.LEGACY_FORMAT,
+                        help="DicomCouch document format for imports "
+                             "(default legacy)")
+    parser.add_argument("--level",
+                        dest='level',
+                        choices=sorted(dicom_dao.LEVEL_KEYWORDS),
+                        default=dicom_dao.SERIES_LEVEL,
+                        help="Store level (default series)")
+    parser.add_argument("--page-size",
+                        dest='page_size',
+                        type=int,
+                        default=dicom_dao.PAGE_SIZE,
+                        help="Documents read per request when exporting "
+                             "(default %d)" % dicom_dao.PAGE_SIZE)
+    parser.add_argument("--batch-size",
+                        dest='batch_size',
+                        type=int,
+                        default=50,
+                        help="Datasets per bulk write when importing "
+                             "(default 50)")
+    parser.add_argument("--workers",
+                        dest='workers',
+                        type=int,
+                        default=4,
+                        help="Threads writing batches when importing "
+                             "(default 4)")
+    parser.add_argument("--key-from-dataset",
+                        dest='key_from_dataset',
+                        action='store_true',
+                        help="Key imported datasets by their UID for the "
+                             "store level instead of their file name")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """main for dicom_dao_archive"""
+    if argv is None:
+        argv = sys.argv
+    args = parse_args(argv[1:])
+    start = time.perf_counter()
+    try:
+        factory = store_factory(args)
+        if args.command == 'export':
+            with contextlib.closing(factory()) as store:
+                count = export_archive(store, args.archive, args.page_size)
+        else:
+            count = import_archive(factory, args.archive, args.batch_size,
+                                   args.workers, args.key_from_dataset)
+    except (ValueError, OSError, couchdb.HTTPError) as e:
+        print("dicom_dao_archive: %s" % e, file=sys.stderr)
+        return 1
+    seconds = time.perf_counter() - start
+    print("%sed %d datasets in %.1f s"
+          % (args.command.capitalize(), count, seconds), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
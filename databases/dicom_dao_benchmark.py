@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+"""
+dicom_dao_benchmark
+
+Measure the throughput of dicom_dao, reported in datasets/sec
+and bytes/sec.
+
+The conversion benchmark times pydicom2json and json2pydicom,
+the round trip every DicomCouch read and write goes through,
+over a corpus of DICOM files. Binary elements are left out of
+the json documents (they become attachments), so the numbers
+are for the header conversion alone.
+
+The store benchmark times whole datasets, binary elements
+included, through a DicomStore: put one at a time, rewritten
+unchanged in bulk with update(), read by key and deleted one at
+a time. Datasets are grouped by size, so the cost of headers and
+of binary data can be told apart. DicomSQLite is benchmarked in
+a temporary directory unless --sqlite names one; DicomCouch is
+benchmarked too when --couch gives a server URL, or against the
+in-process stand-in of dicom_dao_fakecouch with --fake-couch.
+The stand-in also reports the HTTP requests each operation
+takes, which should not grow unnoticed.
+
+run with
+dicom_dao_benchmark.py --input-dir /path/to/corpus
+dicom_dao_benchmark.py CT.dcm MR.dcm RTSTRUCT.dcm --repeat 500
+dicom_dao_benchmark.py --couch http://127.0.0.1:5984 --store-repeat 20
+dicom_dao_benchmark.py --fake-couch --latency 1 --bandwidth 100
+
+Without any files the CT, MR and RTSTRUCT test files that ship
+with pydicom are used.
+
+"""
+#
+# This file is released under the pydicom license.
+#    See the file LICENSE included with the pydicom distribution, also
+#    available at https://github.com/pydicom/pydicom
+#
+
+import argparse
+import collections
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+
+import pydicom
+
+import dicom_dao
+import dicom_dao_fakecouch
+
+DEFAULT_TESTFILES = ['CT_small.dcm', 'MR_small.dcm', 'rtstruct.dcm']
+STORE_OPERATIONS = ('put', 'update', 'get', 'delete')
+
+
+def find_files(input_dir):
+    """ Return the paths of all files below input_dir """
+    for root, dirs, files in os.walk(input_dir):
+        for basename in sorted(files):
+            yield os.path.join(root, basename)
+
+
+def read_corpus(paths):
+    """ Read the DICOM files in paths, skipping anything unreadable """
+    datasets = []
+    for path in paths:
+        try:
+            datasets.append(pydicom.dcmread(path, force=True))
+        except Exception as e:
+            print("Skipping %s: %s" % (path, e))
+    return datasets
+
+
+def benchmark_conversion(datasets, repeat):
+    """ Time pydicom2json and json2pydicom over datasets
+
+    Returns a dict mapping each Modality, and 'all', to the
+    tuple (datasets, pydicom2json seconds, json2pydicom seconds).
+
+    """
+    totals = collections.defaultdict(lambda: [0, 0.0, 0.0])
+    for dcm in datasets:
+        modality = dcm.get('Modality', 'unknown')
+        jsn = json.loads(json.dumps(dicom_dao.pydicom2json(dcm)[0]))
+
+        start = time.perf_counter()
+        for i in range(repeat):
+            dicom_dao.pydicom2json(dcm)
+        to_json = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(repeat):
+            dicom_dao.json2pydicom(jsn)
+        from_json = time.perf_counter() - start
+
+        for key in (modality, 'all'):
+            totals[key][0] += repeat
+            totals[key][1] += to_json
+            totals[key][2] += from_json
+    return dict((key, tuple(value)) for key, value in totals.items())
+
+
+def print_results(title, results):
+    """ Print a table of datasets/sec per result row """
+    print(title)
+    print("%-10s %10s %20s %20s" % ('', 'datasets',
+                                    'pydicom2json /sec', 'json2pydicom /sec'))
+    for key in sorted(results, key=lambda key: (key == 'all', key)):
+        count, to_json, from_json = results[key]
+        print("%-10s %10d %20.1f %20.1f" % (key, count, count / to_json,
+                                            count / from_json))
+
+
+def dataset_size(dcm):
+    """ Return the bytes a store holds for dcm: its json
+        header and the values of its binary elements """
+    jsn, binary_elements, file_meta_binary_elements = \
+        dicom_dao.pydicom2json(dcm)
+    return len(json.dumps(jsn)) + sum(
+        len(element.value or b'') for tagstack, element in
+        binary_elements + file_meta_binary_elements)
+
+
+def size_class(size):
+    """ Return a label for the power of 4 KB above size """
+    limit = 4
+    while size > limit * 1024:
+        limit *= 4
+    if limit < 1024:
+        return '<%d KB' % limit
+    return '<%d MB' % (limit // 1024)
+
+
+def benchmark_store(store, datasets, repeat, counts=None):
+    """ Time writing, reading and deleting datasets through
+        a DicomStore
+
+    Datasets are keyed with DicomStore.key(), so they must
+    differ in their SeriesInstanceUID (or SOPInstanceUID for
+    an instance level store). Each repeat puts them one at a
+    time, writes them again unchanged with one update(),
+    reads them by key and deletes them one at a time. counts
+    is a collections.Counter of the requests the store
+    makes, if it can be had.
+
+    Returns a dict mapping each operation to the tuple
+    (datasets, bytes, seconds, requests).
+
+    """
+    items = [(store.key(dcm), dcm) for dcm in datasets]
+    nbytes = sum(dataset_size(dcm) for dcm in datasets)
+    counts = counts if counts is not None else collections.Counter()
+
+    def put():
+        for key, dcm in items:
+            store[key] = dcm
+
+    def update():
+        store.update(items)
+
+    def get():
+        for key, dcm in items:
+            store[key]
+
+    def delete():
+        for key, dcm in items:
+            del store[key]
+
+    results = dict((operation, [0, 0, 0.0, 0])
+                   for operation in STORE_OPERATIONS)
+    for i in range(repeat):
+        for operation, run in zip(STORE_OPERATIONS,
+                                  (put, update, get, delete)):
+            requests = sum(counts.values())
+            start = time.perf_counter()
+            run()
+            seconds = time.perf_counter() - start
+            result = results[operation]
+            result[0] += len(items)
+            result[1] += nbytes
+            result[2] += seconds
+            result[3] += sum(counts.values()) - requests
+    return dict((operation, tuple(result))
+                for operation, result in results.items())
+
+
+def benchmark_store_sizes(store, datasets, repeat, counts=None):
+    """ Run benchmark_store for each size class of datasets
+
+    Returns a dict mapping each size class, and 'all', to
+    the results of benchmark_store.
+
+    """
+    classes = collections.defaultdict(list)
+    for dcm in datasets:
+        classes[size_class(dataset_size(dcm))].append(dcm)
+    results = {}
+    for label, members in classes.items():
+        results[label] = benchmark_store(store, members, repeat, counts)
+    if len(classes) > 1:
+        results['all'] = benchmark_store(store, datasets, repeat, counts)
+    return results
+
+
+def print_store_results(title, results, requests=False):
+    """ Print tables of datasets/sec and MB/sec per store
+        operation and size class, and requests per dataset """
+    print(title)
+    header = '%-10s %-8s %10s %16s %12s' + (' %20s' if requests else '')
+    row = '%-10s %-8s %10d %16.1f %12.2f' + (' %20.2f' if requests else '')
+    print(header % (('', '', 'datasets', 'datasets /sec', 'MB /sec')
+                    + (('requests /dataset',) if requests else ())))
+    for label in sorted(results, key=lambda label: (
+            label == 'all', 'KB' not in label, len(label), label)):
+        for operation in STORE_OPERATIONS:
+            count, nbytes, seconds, request_count = results[label][operation]
+            values = (label, operation, count, count / seconds,
+                      nbytes / seconds / 1e6)
+            if requests:
+                values += (request_count / count,)
+            print(row % values)
+
+
+def parse_args(argv=None):
+    """Argument parser for dicom_dao_benchmark"""
+    parser = argparse.ArgumentParser(
+        description="Benchmark dicom_dao dataset throughput")
+    parser.add_argument("files",
+                        nargs='*',
+                        help="DICOM files to use as the corpus")
+    parser.add_argument("-i", "--input-dir",
+                        dest='input_dir',
+                        type=str,
+                        help="Directory of DICOM files to use as the corpus")
+    parser.add_argument("-r", "--repeat",
+                        dest='repeat',
+                        type=int,
+                        default=200,
+                        help="Conversions per dataset (default 200)")
+    parser.add_argument("--store-repeat",
+                        dest='store_repeat',
+                        type=int,
+                        default=10,
+                        help="Store round trips per dataset (default 10)")
+    parser.add_argument("--sqlite",
+                        dest='sqlite',
+                        type=str,
+                        help="Directory for the DicomSQLite store "
+                             "(default a temporary directory)")
+    parser.add_argument("--couch",
+                        dest='couch',
+                        type=str,
+                        help="CouchDB server URL to benchmark DicomCouch "
+                             "against")
+    parser.add_argument("--couch-db",
+                        dest='couch_db',
+                        type=str,
+                        default='dicom_dao_benchmark',
+                        help="CouchDB database name "
+                             "(default dicom_dao_benchmark)")
+    parser.add_argument("--fake-couch",
+                        dest='fake_couch',
+                        action='store_true',
+                        help="Benchmark DicomCouch against an in-process "
+                             "stand-in for CouchDB")
+    parser.add_argument("--latency",
+                        dest='latency',
+                        type=float,
+                        default=0.0,
+                        help="Milliseconds the stand-in adds to every "
+                             "request (default 0)")
+    parser.add_argument("--bandwidth",
+                        dest='bandwidth',
+                        type=float,
+                        help="Bandwidth of the stand-in in MB/sec "
+                             "(default unlimited)")
+    parser.add_argument("--couch-cache",
+                        dest='couch_cache',
+                        type=int,
+                        default=0,
+                        help="DicomCouch read cache size in MB (default 0)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """main for dicom_dao_benchmark"""
+    if argv is None:
+        argv = sys.argv
+    args = parse_args(argv[1:])
+    paths = list(args.files)
+    if args.input_dir:
+        paths.extend(find_files(args.input_dir))
+    if not paths:
+        from pydicom.data import get_testdata_file
+        paths = [get_testdata_file(name) for name in DEFAULT_TESTFILES]
+
+    datasets = read_corpus(paths)
+    if not datasets:
+        print("No DICOM files to benchmark")
+        return 1
+    print("Corpus: %d datasets, %d repeats each\n"
+          % (len(datasets), args.repeat))
+    print_results("json conversion",
+                  benchmark_conversion(datasets, args.repeat))
+
+    sqlite_dir = args.sqlite or tempfile.mkdtemp(prefix='dicom_dao_')
+    try:
+        store = dicom_dao.DicomSQLite(sqlite_dir)
+        print()
+        print_store_results("DicomSQLite %s" % sqlite_dir,
+                            benchmark_store_sizes(store, datasets,
+                                                  args.store_repeat))
+        store.close()
+    finally:
+        if not args.sqlite:
+            shutil.rmtree(sqlite_dir)
+
+    if args.couch:
+        store = dicom_dao.DicomCouch(args.couch, args.couch_db,
+                                     cache_size=args.couch_cache << 20)
+        print()
+        print_store_results("DicomCouch %s/%s" % (args.couch, args.couch_db),
+                            benchmark_store_sizes(store, datasets,
+                                                  args.store_repeat))
+    if args.fake_couch:
+        server = dicom_dao_fakecouch.FakeCouch(
+            latency=args.latency / 1000.0,
+            bandwidth=args.bandwidth and args.bandwidth * 1e6)
+        try:
+            store = dicom_dao.DicomCouch(server.url, args.couch_db,
+                                         cache_size=args.couch_cache << 20)
+            print()
+            print_store_results(
+                "DicomCouch stand-in, %g ms latency, %s MB/sec"
+                % (args.latency, args.bandwidth or 'unlimited'),
+                benchmark_store_sizes(store, datasets, args.store_repeat,
+                                      server.counts),
+                requests=True)
+        finally:
+            server.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
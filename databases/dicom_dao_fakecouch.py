@@ -0,0 +1,592 @@
+#!/usr/bin/env python
+"""
+dicom_dao_fakecouch
+
+An in-process stand-in for a CouchDB server, enough of one to run
+dicom_dao.DicomCouch against, for benchmarks and experiments on
+machines without CouchDB.
+
+Documents, attachments (with md5 digests as CouchDB reports them),
+_all_docs, _bulk_docs, _changes, _purge and views are supported.
+Views can't run JavaScript, so the map functions dicom_dao installs
+are emulated in Python, as is the _count reduce. Everything is
+kept in memory and lost when the server stops.
+
+Each request can be slowed by a fixed latency and by the time its
+bytes take at a given bandwidth, so round trips cost what they
+would over a network. The server counts the requests it serves by
+method in FakeCouch.counts.
+
+    server = FakeCouch(latency=0.001, bandwidth=100e6)
+    db = dicom_dao.DicomCouch(server.url, 'dbname')
+    ...
+    print(server.counts)
+    server.close()
+
+run with
+dicom_dao_fakecouch.py --port 5984 --latency 2
+
+"""
+#
+# This file is released under the pydicom license.
+#    See the file LICENSE included with the pydicom distribution, also
+#    available at https://github.com/pydicom/pydicom
+#
+
+import argparse
+import base64
+import collections
+import hashlib
+import json
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+import pydicom
+
+import dicom_dao
+
+
+class FakeCouch(object):
+    """ A fake CouchDB server running in a thread of its own """
+
+    def __init__(self, port=0, latency=0.0, bandwidth=None):
+        """ Start serving on localhost
+
+        port 0 picks a free port. latency (seconds) is added to
+        every request, and with bandwidth (bytes/sec) the time
+        to send the request and response bodies too.
+
+        """
+        self.databases = {}
+        self.counts = collections.Counter()
+        self.lock = threading.Condition(threading.RLock())
+        handler = type('Handler', (_Handler,), {
+            'server_state': self, 'latency': latency,
+            'bandwidth': bandwidth})
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', port), handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def url(self):
+        """ The URL of the server """
+        return 'http://127.0.0.1:%d/' % self._httpd.server_address[1]
+
+    def close(self):
+        """ Stop serving """
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+class _Database(object):
+    """ The documents of a database, by id
+
+    Each document is a dict of its rev, body (without _
+    keys), attachments (name to dict of content_type, data,
+    digest and revpos), whether it is deleted, and the seq
+    of its last change.
+    """
+
+    def __init__(self):
+        self.docs = {}
+        self.seq = 0
+
+    def write(self, id, doc):
+        """ Store doc under id unless it conflicts
+
+        Returns the tuple (rev, error), one of them None.
+
+        """
+        current = self.docs.get(id)
+        rev = doc.get('_rev')
+        if current is not None and rev != current['rev'] and \
+                (not current['deleted'] or rev is not None):
+            return None, ('conflict', 'Document update conflict.')
+        generation = _generation(current) + 1
+        attachments = {}
+        for name, stub in (doc.get('_attachments') or {}).items():
+            if stub.get('stub'):
+                if current is None or name not in current['attachments']:
+                    return None, ('missing_stub', name)
+                attachments[name] = current['attachments'][name]
+            else:
+                attachments[name] = _attachment(
+                    base64.b64decode(stub.get('data', '')),
+                    stub.get('content_type', 'application/octet-stream'),
+                    generation)
+        deleted = bool(doc.get('_deleted'))
+        body = dict((key, value) for key, value in doc.items()
+                    if not key.startswith('_'))
+        return self.store(id, generation, {} if deleted else body,
+                          {} if deleted else attachments, deleted), None
+
+    def store(self, id, generation, body, attachments, deleted=False):
+        """ Store a new revision of id and return its rev """
+        rev = '%d-%s' % (generation, uuid.uuid4().hex)
+        self.seq += 1
+        self.docs[id] = {'rev': rev, 'body': body,
+                         'attachments': attachments, 'deleted': deleted,
+                         'seq': self.seq}
+        return rev
+
+    def render(self, id, attachments=False):
+        """ Return document id as CouchDB would send it """
+        current = self.docs[id]
+        doc = dict(current['body'])
+        doc['_id'] = id
+        doc['_rev'] = current['rev']
+        if current['attachments']:
+            doc['_attachments'] = {}
+            for name, attachment in current['attachments'].items():
+                stub = {'content_type': attachment['content_type'],
+                        'revpos': attachment['revpos'],
+                        'digest': attachment['digest'],
+                        'length': len(attachment['data'])}
+                if attachments:
+                    stub['data'] = base64.b64encode(
+                        attachment['data']).decode('ascii')
+                else:
+                    stub['stub'] = True
+                doc['_attachments'][name] = stub
+        return doc
+
+    def live_ids(self):
+        """ Return the ids of documents not deleted, sorted """
+        return sorted(id for id, current in self.docs.items()
+                      if not current['deleted'])
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """ Serve the CouchDB HTTP API from a FakeCouch """
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # Or small responses wait for ACKs
+    server_state = None
+    latency = 0.0
+    bandwidth = None
+
+    def log_message(self, *args):
+        """ Don't log every request to stderr """
+
+    def do_GET(self):
+        """ Handle every method the same way """
+        url = urlsplit(self.path)
+        path = [unquote(part) for part in url.path.split('/') if part]
+        query = dict(parse_qsl(url.query))
+        body = self._read_body()
+        self._delay(len(body))
+        state = self.server_state
+        with state.lock:
+            state.counts[self.command] += 1
+            self._dispatch(state, path, query, body)
+        # Outside the lock, so slow responses overlap
+        status, body, headers = self._response
+        self._delay(len(body))
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    do_HEAD = do_PUT = do_POST = do_DELETE = do_COPY = do_GET
+
+    def _read_body(self):
+        """ Return the request body, chunked or not """
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if not size:
+                    self.rfile.readline()
+                    return bytes(body)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _delay(self, size):
+        """ Take as long as the request would over the network """
+        delay = self.latency
+        if self.bandwidth:
+            delay += float(size) / self.bandwidth
+        if delay:
+            time.sleep(delay)
+
+    def _send(self, status, body=b'', content_type='application/json',
+              headers=None):
+        """ Set the response, json unless body is bytes """
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        headers = dict(headers or {})
+        headers['Content-Type'] = content_type
+        headers['Content-Length'] = str(len(body))
+        self._response = (status, body, headers)
+
+    def _error(self, status, error, reason=''):
+        """ Send a CouchDB error response """
+        self._send(status, {'error': error, 'reason': reason})
+
+    def _dispatch(self, state, path, query, body):
+        """ Route a request by its path """
+        if not path:
+            return self._send(200, {'couchdb': 'Welcome',
+                                    'version': '2.3.1'})
+        if len(path) == 1:
+            return self._database(state, path[0])
+        db = state.databases.get(path[0])
+        if db is None:
+            return self._error(404, 'not_found', 'Database does not exist.')
+        path = path[1:]
+        if path[0] == '_design' and len(path) > 1:
+            path = ['_design/' + path[1]] + path[2:]
+        if path[0] == '_all_docs':
+            return self._all_docs(db, query, body)
+        if path[0] == '_bulk_docs':
+            return self._bulk_docs(state, db, body)
+        if path[0] == '_changes':
+            return self._changes(state, db, query)
+        if path[0] == '_purge':
+            return self._purge(db, body)
+        if path[0] in ('_compact', '_view_cleanup', '_ensure_full_commit'):
+            return self._send(202, {'ok': True})
+        if path[0].startswith('_design/') and len(path) == 3 and \
+                path[1] == '_view':
+            return self._view(db, path[0], path[2], query, body)
+        if len(path) == 1:
+            return self._document(state, db, path[0], query, body)
+        return self._attachment(state, db, path[0], '/'.join(path[1:]),
+                                query, body)
+
+    def _database(self, state, name):
+        """ Create, delete or describe a database """
+        if self.command in ('GET', 'HEAD'):
+            if name not in state.databases:
+                return self._error(404, 'not_found',
+                                   'Database does not exist.')
+            db = state.databases[name]
+            return self._send(200, {'db_name': name,
+                                    'update_seq': db.seq,
+                                    'doc_count': len(db.live_ids())})
+        if self.command == 'PUT':
+            if name in state.databases:
+                return self._error(412, 'file_exists',
+                                   'The database could not be created.')
+            state.databases[name] = _Database()
+            return self._send(201, {'ok': True})
+        if self.command == 'DELETE':
+            if state.databases.pop(name, None) is None:
+                return self._error(404, 'not_found', 'missing')
+            return self._send(200, {'ok': True})
+        return self._error(405, 'method_not_allowed')
+
+    def _document(self, state, db, id, query, body):
+        """ Read, write or delete a document """
+        current = db.docs.get(id)
+        if self.command in ('GET', 'HEAD'):
+            if current is None or current['deleted']:
+                return self._error(404, 'not_found',
+                                   'deleted' if current else 'missing')
+            if query.get('rev', current['rev']) != current['rev']:
+                return self._error(404, 'not_found', 'missing')
+            return self._send(
+                200, db.render(id, query.get('attachments') == 'true'),
+                headers={'ETag': '"%s"' % current['rev']})
+        if self.command in ('PUT', 'POST'):
+            doc = json.loads(body)
+            if self.command == 'POST':
+                id = doc.get('_id') or uuid.uuid4().hex
+            elif 'rev' in query:
+                doc['_rev'] = query['rev']
+            rev, error = db.write(id, doc)
+        elif self.command == 'DELETE':
+            if current is None or current['deleted']:
+                return self._error(404, 'not_found', 'missing')
+            rev, error = db.write(id, {'_rev': query.get('rev'),
+                                       '_deleted': True})
+        else:
+            return self._error(405, 'method_not_allowed')
+        if error:
+            return self._error(409, *error)
+        state.lock.notify_all()
+        return self._send(200 if self.command == 'DELETE' else 201,
+                          {'ok': True, 'id': id, 'rev': rev},
+                          headers={'ETag': '"%s"' % rev})
+
+    def _attachment(self, state, db, id, name, query, body):
+        """ Read, write or delete an attachment """
+        current = db.docs.get(id)
+        live = current is not None and not current['deleted']
+        if self.command in ('GET', 'HEAD'):
+            if not live or name not in current['attachments']:
+                return self._error(404, 'not_found', 'missing')
+            attachment = current['attachments'][name]
+            return self._send(200, attachment['data'],
+                              attachment['content_type'],
+                              {'ETag': '"%s"' % attachment['digest']})
+        if live and query.get('rev') != current['rev']:
+            return self._error(409, 'conflict', 'Document update conflict.')
+        attachments = dict(current['attachments']) if live else {}
+        generation = _generation(current) + 1
+        if self.command == 'PUT':
+            attachments[name] = _attachment(
+                body, self.headers.get('Content-Type',
+                                       'application/octet-stream'),
+                generation)
+        elif self.command == 'DELETE':
+            if attachments.pop(name, None) is None:
+                return self._error(404, 'not_found', 'missing')
+        else:
+            return self._error(405, 'method_not_allowed')
+        rev = db.store(id, generation, current['body'] if live else {},
+                       attachments)
+        state.lock.notify_all()
+        return self._send(201 if self.command == 'PUT' else 200,
+                          {'ok': True, 'id': id, 'rev': rev})
+
+    def _all_docs(self, db, query, body):
+        """ List documents by id, or those with the given keys """
+        keys = json.loads(body).get('keys') if body else None
+        if 'keys' in query:
+            keys = json.loads(query['keys'])
+        include_docs = query.get('include_docs') == 'true'
+        attachments = query.get('attachments') == 'true'
+        rows = []
+        if keys is None:
+            ids = db.live_ids()
+            if 'startkey' in query:
+                startkey = json.loads(query['startkey'])
+                ids = [id for id in ids if id >= startkey]
+            if 'endkey' in query:
+                endkey = json.loads(query['endkey'])
+                ids = [id for id in ids if id <= endkey]
+            ids = _page(ids, query)
+        else:
+            ids = keys
+        for id in ids:
+            current = db.docs.get(id)
+            if current is None:
+                rows.append({'key': id, 'error': 'not_found'})
+                continue
+            row = {'id': id, 'key': id, 'value': {'rev': current['rev']}}
+            if current['deleted']:
+                row['value']['deleted'] = True
+                row['doc'] = None
+            elif include_docs:
+                row['doc'] = db.render(id, attachments)
+            rows.append(row)
+        return self._send(200, {'total_rows': len(db.live_ids()),
+                                'offset': 0, 'rows': rows})
+
+    def _bulk_docs(self, state, db, body):
+        """ Write many documents """
+        results = []
+        for doc in json.loads(body)['docs']:
+            id = doc.get('_id') or uuid.uuid4().hex
+            rev, error = db.write(id, doc)
+            if error:
+                results.append({'id': id, 'error': error[0],
+                                'reason': error[1]})
+            else:
+                results.append({'ok': True, 'id': id, 'rev': rev})
+        state.lock.notify_all()
+        return self._send(201, results)
+
+    def _changes(self, state, db, query):
+        """ List changes since a sequence, oldest first
+
+        A longpoll feed waits up to its timeout for a change.
+
+        """
+        since = int(str(query.get('since', 0)).split('-')[0] or 0)
+        if query.get('feed') == 'longpoll' and db.seq <= since:
+            state.lock.wait(int(query.get('timeout', 60000)) / 1000.0)
+        changes = sorted((current['seq'], id, current)
+                         for id, current in db.docs.items()
+                         if current['seq'] > since)
+        if 'limit' in query:
+            changes = changes[:int(query['limit'])]
+        results = []
+        for seq, id, current in changes:
+            result = {'seq': seq, 'id': id,
+                      'changes': [{'rev': current['rev']}]}
+            if current['deleted']:
+                result['deleted'] = True
+            if query.get('include_docs') == 'true':
+                result['doc'] = db.render(id)
+                if current['deleted']:
+                    result['doc']['_deleted'] = True
+            results.append(result)
+        last_seq = changes[-1][0] if changes else since
+        return self._send(200, {'results': results, 'last_seq': last_seq})
+
+    def _purge(self, db, body):
+        """ Remove revisions, tombstones included, for good """
+        purged = {}
+        for id, revs in json.loads(body).items():
+            current = db.docs.get(id)
+            if current is not None and current['rev'] in revs:
+                del db.docs[id]
+                purged[id] = revs
+        return self._send(201, {'purge_seq': None, 'purged': purged})
+
+    def _view(self, db, design_id, name, query, body):
+        """ Query a view, emulating its map and reduce functions """
+        design = db.docs.get(design_id)
+        views = design['body'].get('views', {}) if design else {}
+        if name not in views:
+            return self._error(404, 'not_found', 'missing_named_view')
+        map_function = MAP_FUNCTIONS.get(views[name]['map'])
+        reduce_function = views[name].get('reduce')
+        if map_function is None or reduce_function not in (None, '_count'):
+            return self._error(400, 'unsupported',
+                               'Only dicom_dao views are emulated')
+
+        rows = []
+        for id in db.live_ids():
+            if id.startswith('_design/'):
+                continue
+            for key, value in map_function(db.render(id)):
+                rows.append({'id': id, 'key': key, 'value': value})
+        rows.sort(key=lambda row: (_collation_key(row['key']), row['id']))
+        keys = json.loads(body).get('keys') if body else None
+        if 'key' in query:
+            keys = [json.loads(query['key'])]
+        if keys is not None:
+            rows = [row for row in rows if row['key'] in keys]
+        if 'startkey' in query:
+            startkey = _collation_key(json.loads(query['startkey']))
+            rows = [row for row in rows
+                    if _collation_key(row['key']) >= startkey]
+        if 'endkey' in query:
+            endkey = _collation_key(json.loads(query['endkey']))
+            rows = [row for row in rows
+                    if _collation_key(row['key']) <= endkey]
+
+        if reduce_function and query.get('reduce') != 'false':
+            counts = collections.OrderedDict()
+            for row in rows:
+                key = row['key'] if query.get('group') == 'true' else None
+                counts[json.dumps(key)] = counts.get(json.dumps(key), 0) + 1
+            return self._send(200, {'rows': [
+                {'key': json.loads(key), 'value': count}
+                for key, count in counts.items()]})
+        total_rows = len(rows)
+        rows = _page(rows, query)
+        if query.get('include_docs') == 'true':
+            for row in rows:
+                row['doc'] = db.render(row['id'],
+                                       query.get('attachments') == 'true')
+        return self._send(200, {'total_rows': total_rows, 'offset': 0,
+                                'rows': rows})
+
+
+def _generation(current):
+    """ Return the generation of a document's rev, 0 if none """
+    return int(current['rev'].split('-')[0]) if current else 0
+
+
+def _attachment(data, content_type, revpos):
+    """ Return an attachment with CouchDB's md5 digest """
+    digest = base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+    return {'content_type': content_type, 'data': data,
+            'digest': 'md5-' + digest, 'revpos': revpos}
+
+
+def _page(rows, query):
+    """ Apply skip and limit to rows """
+    rows = rows[int(query.get('skip', 0)):]
+    if 'limit' in query:
+        rows = rows[:int(query['limit'])]
+    return rows
+
+
+def _collation_key(key):
+    """ Order view keys of mixed types as CouchDB does:
+        null, booleans, numbers, strings, arrays, objects """
+    if key is None:
+        return (0,)
+    if isinstance(key, bool):
+        return (1, key)
+    if isinstance(key, (int, float)):
+        return (2, key)
+    if isinstance(key, str):
+        return (3, key)
+    if isinstance(key, list):
+        return (4, [_collation_key(item) for item in key])
+    return (5, json.dumps(key, sort_keys=True))
+
+
+def _emulate_map_function(keyword):
+    """ Return a Python version of dicom_dao's map function
+        for keyword, see dicom_dao._VIEW_MAP_FUNCTION """
+    tag = pydicom.tag.Tag(pydicom.datadict.tag_for_keyword(keyword))
+    dicomjson_key = dicom_dao._dicomjson_tag2str(tag)
+    legacy_key = dicom_dao._tag2str(tag)
+
+    def map_function(doc):
+        """ Emit the keyword's value of doc, in either format """
+        value = doc.get(dicomjson_key)
+        if value:
+            value = (value.get('Value') or [None])[0]
+        else:
+            value = doc.get(legacy_key)
+        if value is None or value == '':
+            return []
+        return [(value, None)]
+    return map_function
+
+
+# The JavaScript map functions dicom_dao installs, and their
+# Python equivalents
+MAP_FUNCTIONS = dict(
+    (dicom_dao._view_map_function(keyword), _emulate_map_function(keyword))
+    for keyword in list(dicom_dao.QUERY_VIEWS) + ['SeriesInstanceUID'])
+
+
+def parse_args(argv=None):
+    """Argument parser for dicom_dao_fakecouch"""
+    parser = argparse.ArgumentParser(
+        description="Serve an in-memory stand-in for CouchDB")
+    parser.add_argument("--port",
+                        dest='port',
+                        type=int,
+                        default=5984,
+                        help="Port to listen on (default 5984)")
+    parser.add_argument("--latency",
+                        dest='latency',
+                        type=float,
+                        default=0.0,
+                        help="Milliseconds added to every request "
+                             "(default 0)")
+    parser.add_argument("--bandwidth",
+                        dest='bandwidth',
+                        type=float,
+                        help="Bandwidth in MB/sec (default unlimited)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """main for dicom_dao_fakecouch"""
+    if argv is None:
+        argv = sys.argv
+    args = parse_args(argv[1:])
+    server = FakeCouch(args.port, args.latency / 1000.0,
+                       args.bandwidth and args.bandwidth * 1e6)
+    print("Serving on %s, ^C to stop" % server.url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
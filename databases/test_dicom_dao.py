@@ -0,0 +1,436 @@
+"""
+Regression tests for dicom_dao, against an in-process FakeCouch
+(see dicom_dao_fakecouch.py) and temporary DicomSQLite stores.
+
+run with
+python -m pytest test_dicom_dao.py
+
+"""
+#
+# This file is released under the pydicom license.
+#    See the file LICENSE included with the pydicom distribution, also
+#    available at https://github.com/pydicom/pydicom
+#
+
+import itertools
+import sqlite3
+import warnings
+
+import couchdb
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+from pydicom.uid import generate_uid
+
+import dicom_dao
+import dicom_dao_archive
+import dicom_dao_fakecouch
+
+FORMATS = [dicom_dao.LEGACY_FORMAT, dicom_dao.DICOMJSON_FORMAT]
+
+_db_names = ('db%d' % i for i in itertools.count())
+
+
+def read_testfile(name):
+    """ Read one of pydicom's test files, without downloading """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # e.g. badVR.dcm's invalid values
+        return pydicom.dcmread(get_testdata_file(name, download=False))
+
+
+def assert_same_dataset(expected, actual):
+    """ Check actual has every element of expected, with the
+        same value """
+    for element in expected:
+        assert element.tag in actual, element.tag
+        value = actual[element.tag].value
+        if element.VR == 'SQ':
+            assert len(value) == len(element.value), element.tag
+            for expected_item, actual_item in zip(element.value, value):
+                assert_same_dataset(expected_item, actual_item)
+        elif element.value in (None, '', b''):
+            assert value in (None, '', b''), element.tag
+        else:
+            assert value == element.value, element.tag
+
+
+@pytest.fixture(scope='module')
+def fake_couch():
+    server = dicom_dao_fakecouch.FakeCouch()
+    yield server
+    server.close()
+
+
+@pytest.fixture(params=['couch', 'sqlite'])
+def store_factory(request, tmp_path):
+    """ Return a function making stores of the parameter's kind,
+        taking DicomCouch/DicomSQLite keyword arguments """
+    if request.param == 'sqlite':
+        return lambda **options: dicom_dao.DicomSQLite(str(tmp_path),
+                                                       **options)
+    server = request.getfixturevalue('fake_couch')
+    name = next(_db_names)
+    return lambda **options: dicom_dao.DicomCouch(server.url, name,
+                                                  **options)
+
+
+@pytest.mark.parametrize('doc_format', FORMATS)
+def test_invalid_number_strings_round_trip(store_factory, doc_format):
+    dcm = read_testfile('badVR.dcm')
+    assert dcm.NumberOfFrames == '1A'  # Kept as a str by pydicom
+    store_factory(doc_format=doc_format)['key'] = dcm
+    read = store_factory(doc_format=doc_format)['key']
+    assert read.NumberOfFrames == '1A'
+    assert_same_dataset(dcm, read)
+
+
+@pytest.mark.parametrize('options', [
+    {}, {'codec': 'zlib'}, {'dedup': True}, {'cache_size': 1 << 24},
+    {'level': dicom_dao.INSTANCE_LEVEL}])
+@pytest.mark.parametrize('doc_format', FORMATS)
+def test_sequence_binary_elements_round_trip(fake_couch, doc_format,
+                                             options):
+    # The binary elements are in WaveformSequence, (5400,0100),
+    # which is all digits as a DICOM JSON tag
+    dcm = read_testfile('waveform_ecg.dcm')
+    name = next(_db_names)
+    db = dicom_dao.DicomCouch(fake_couch.url, name, doc_format=doc_format,
+                              **options)
+    db['key'] = dcm
+    read = dicom_dao.DicomCouch(fake_couch.url, name, doc_format=doc_format,
+                                **options)['key']
+    assert_same_dataset(dcm, read)
+
+
+@pytest.mark.parametrize('doc_format', FORMATS)
+def test_sqlite_sequence_binary_elements_round_trip(tmp_path, doc_format):
+    dcm = read_testfile('waveform_ecg.dcm')
+    dicom_dao.DicomSQLite(str(tmp_path), doc_format=doc_format)['key'] = dcm
+    read = dicom_dao.DicomSQLite(str(tmp_path), doc_format=doc_format)['key']
+    assert_same_dataset(dcm, read)
+
+
+@pytest.mark.parametrize('options', [
+    {}, {'hash_name': 'blake2b'}, {'codec': 'zlib'}, {'dedup': True},
+    {'doc_format': 'dicomjson'}])
+def test_streamed_attachments_round_trip(fake_couch, options):
+    # Larger than CHUNK_SIZE, so it is sent and read in several chunks
+    dcm = read_testfile('CT_small.dcm')
+    value = bytes(range(256)) * (dicom_dao.CHUNK_SIZE * 5 // 2 // 256)
+    dcm.add_new(0x00420011, 'OB', value)
+    name = next(_db_names)
+    dicom_dao.DicomCouch(fake_couch.url, name, **options)['key'] = dcm
+    db = dicom_dao.DicomCouch(fake_couch.url, name, **options)
+    read = db['key']
+    assert read[0x00420011].value == value
+    assert_same_dataset(dcm, read)
+
+    # The digests taken while streaming spot the changed value
+    value = value[:-1] + b'\0'
+    read[0x00420011].value = value
+    fake_couch.counts.clear()
+    db['key'] = read
+    assert fake_couch.counts['PUT'] == 1
+    read = dicom_dao.DicomCouch(fake_couch.url, name, **options)['key']
+    assert read[0x00420011].value == value
+
+
+@pytest.mark.parametrize('options', [
+    {}, {'codec': 'zlib'}, {'dedup': True}, {'doc_format': 'dicomjson'}])
+def test_empty_binary_element_round_trip(fake_couch, options):
+    dcm = read_testfile('CT_small.dcm')
+    dcm.add_new(0x00420011, 'OB', b'')  # Type 2 EncapsulatedDocument
+    name = next(_db_names)
+    dicom_dao.DicomCouch(fake_couch.url, name, **options)['key'] = dcm
+    read = dicom_dao.DicomCouch(fake_couch.url, name, **options)['key']
+    assert not read[0x00420011].value
+    assert_same_dataset(dcm, read)
+
+
+@pytest.mark.parametrize('options', [{}, {'dedup': True},
+                                     {'doc_format': 'dicomjson'}])
+def test_bulk_write_with_a_conflict_completes_the_others(
+        fake_couch, options):
+    dcm = read_testfile('CT_small.dcm')
+    name = next(_db_names)
+    db = dicom_dao.DicomCouch(fake_couch.url, name, **options)
+    stale = dicom_dao.DicomCouch(fake_couch.url, name, **options)
+    db['k1'] = dcm
+    stale['k1']
+    db['k1'] = dcm  # stale now has an old revision of k1
+
+    with pytest.raises(dicom_dao.WriteConflict) as conflict:
+        stale.update([('k1', dcm), ('k2', dcm)])
+    assert list(conflict.value.errors) == ['k1']
+    read = dicom_dao.DicomCouch(fake_couch.url, name, **options)['k2']
+    assert read.PixelData == dcm.PixelData
+
+    # The conflict is forgotten, so writing again succeeds
+    stale['k1'] = dcm
+    db.delete_many(['k1', 'k2'])
+    assert list(dicom_dao.DicomCouch(fake_couch.url, name).iter_keys()) == []
+    blobs = [id for id in fake_couch.databases[name].live_ids()
+             if id.startswith(dicom_dao.BLOB_PREFIX)]
+    assert blobs == []
+
+
+def test_deleting_a_missing_key_raises_key_error(store_factory):
+    db = store_factory()
+    db['key'] = read_testfile('CT_small.dcm')
+    del db['key']
+    with pytest.raises(KeyError):
+        del db['key']
+    assert db.delete_many(['key']) == []
+
+
+@pytest.mark.parametrize('purge', [False, True])
+def test_delete_many_takes_purge(store_factory, purge):
+    dcm = read_testfile('CT_small.dcm')
+    db = store_factory()
+    db.update([('k1', dcm), ('k2', dcm)])
+    assert db.delete_many(['k1'], purge=purge) == ['k1']
+    assert db.delete_many(purge=purge, PatientID=dcm.PatientID) == ['k2']
+    assert list(db.iter_keys()) == []
+
+
+@pytest.mark.parametrize('codec', [None, 'zlib'])
+def test_unchanged_attachments_are_not_uploaded_again(fake_couch, codec):
+    dcm = read_testfile('CT_small.dcm')
+    name = next(_db_names)
+    dicom_dao.DicomCouch(fake_couch.url, name, codec=codec)['key'] = dcm
+
+    # Neither a DAO that hasn't read the dataset, nor one that has
+    for read in (False, True):
+        db = dicom_dao.DicomCouch(fake_couch.url, name, codec=codec)
+        if read:
+            dcm = db['key']
+        fake_couch.counts.clear()
+        db['key'] = dcm
+        assert fake_couch.counts['PUT'] == 0
+        fake_couch.counts.clear()
+        db['key'] = dcm  # The stubs written last time will do too
+        assert fake_couch.counts['PUT'] == 0
+
+    # A changed value is uploaded, and read back
+    dcm.PixelData = bytes(len(dcm.PixelData))
+    db['key'] = dcm
+    read = dicom_dao.DicomCouch(fake_couch.url, name)['key']
+    assert read.PixelData == dcm.PixelData
+    stubs = fake_couch.databases[name].render('key')['_attachments']
+    assert stubs['(7fe0, 0010)']['content_type'] == \
+        dicom_dao._codec_content_type(codec)
+
+
+def test_multi_worker_sqlite_import(tmp_path):
+    dcm = read_testfile('CT_small.dcm')
+    source = dicom_dao.DicomSQLite(str(tmp_path / 'source'),
+                                   level=dicom_dao.INSTANCE_LEVEL)
+    with source.transaction():
+        for i in range(200):
+            dcm.SOPInstanceUID = generate_uid()
+            source['k%d' % i] = dcm
+    archive = str(tmp_path / 'archive.zip')
+    assert dicom_dao_archive.export_archive(source, archive) == 200
+
+    path = str(tmp_path / 'imported')
+    count = dicom_dao_archive.import_archive(
+        lambda: dicom_dao.DicomSQLite(path, level=dicom_dao.INSTANCE_LEVEL),
+        archive, batch_size=5, workers=4)
+    assert count == 200
+    imported = dicom_dao.DicomSQLite(path, level=dicom_dao.INSTANCE_LEVEL)
+    assert sorted(imported.iter_keys()) == sorted(source.iter_keys())
+    assert imported['k0'].PixelData == dcm.PixelData
+
+
+def test_follower_stops_at_the_end_of_opaque_sequences(fake_couch, tmp_path):
+    dcm = read_testfile('CT_small.dcm')
+    couch = dicom_dao.DicomCouch(fake_couch.url, next(_db_names), dedup=True)
+    couch.update(('k%d' % i, dcm) for i in range(7))
+    del couch['k0']
+
+    # Like CouchDB 2+, send a different last_seq for every request,
+    # even when nothing has changed
+    feed = couch._db.changes
+    requests = []
+
+    def opaque_changes(since=0, **options):
+        requests.append(since)
+        assert len(requests) < 20, 'Paging never stopped'
+        result = feed(since=int(str(since).split('-')[0]), **options)
+        result['last_seq'] = '%s-g1AAAA%d' % (
+            result['last_seq'], len(requests))
+        return result
+    couch._db.changes = opaque_changes
+
+    index = dicom_dao.DicomSQLite(str(tmp_path))
+    follower = dicom_dao.DicomCouchFollower(couch, index, batch_size=3)
+    assert follower.update() == 7  # k0 only as deleted
+    assert sorted(index.iter_keys()) == ['k%d' % i for i in range(1, 7)]
+    assert follower.update() == 0
+    couch['k0'] = dcm
+    assert follower.update() == 1
+    assert 'k0' in index.iter_keys()
+
+    # Headers only: binary elements are there, without values
+    header = index['k0']
+    assert header.PatientName == dcm.PatientName
+    assert 'PixelData' in header and header.PixelData is None
+    assert index.query(PatientID=dcm.PatientID)[0].PixelData is None
+
+
+def test_dedup_reference_counts(fake_couch):
+    dcm = read_testfile('CT_small.dcm')
+    name = next(_db_names)
+
+    def blob_refs():
+        """ Return the reference count of each blob by id """
+        blobs = fake_couch.databases[name]
+        return {id: blobs.render(id)[dicom_dao.DAO_KEY]['refs']
+                for id in blobs.live_ids()
+                if id.startswith(dicom_dao.BLOB_PREFIX)}
+
+    db = dicom_dao.DicomCouch(fake_couch.url, name, dedup=True)
+    db['k1'] = dcm
+    fake_couch.counts.clear()
+    db['k2'] = dcm  # Adds references, but uploads nothing
+    assert fake_couch.counts['PUT'] == 0
+    pixel_blob = dicom_dao._blob_id(dcm.PixelData)
+    assert set(blob_refs().values()) == {2}
+    assert pixel_blob in blob_refs()
+
+    del db['k1']
+    assert set(blob_refs().values()) == {1}
+    changed = read_testfile('CT_small.dcm')
+    changed.PixelData = bytes(len(changed.PixelData))
+    db['k2'] = changed  # Releases the old pixel data's blob
+    refs = blob_refs()
+    assert pixel_blob not in refs
+    assert refs[dicom_dao._blob_id(changed.PixelData)] == 1
+    del db['k2']
+    assert blob_refs() == {}
+
+
+def test_cache_invalidation(fake_couch):
+    dcm = read_testfile('CT_small.dcm')
+    name = next(_db_names)
+    writer = dicom_dao.DicomCouch(fake_couch.url, name)
+    writer['key'] = dcm
+    cached = dicom_dao.DicomCouch(fake_couch.url, name, cache_size=1 << 24)
+    cached['key']
+
+    # Unchanged, a read costs one HEAD request
+    fake_couch.counts.clear()
+    read = cached['key']
+    assert dict(fake_couch.counts) == {'HEAD': 1}
+    assert read.PixelData == dcm.PixelData
+    read.PatientName = 'Changed^Copy'  # Doesn't change the cache
+    assert cached['key'].PatientName == dcm.PatientName
+
+    # Changed by another DAO, or by this one, it is read again
+    dcm.PatientName = 'Changed^Writer'
+    writer['key'] = dcm
+    assert cached['key'].PatientName == 'Changed^Writer'
+    dcm.PatientName = 'Changed^Cached'
+    cached['key'] = dcm
+    assert cached['key'].PatientName == 'Changed^Cached'
+    del writer['key']
+    with pytest.raises(couchdb.ResourceNotFound):
+        cached['key']
+
+
+def test_write_behind_is_flushed_before_reading(fake_couch):
+    dcm = read_testfile('CT_small.dcm')
+    name = next(_db_names)
+    db = dicom_dao.DicomCouch(fake_couch.url, name, cache_size=1 << 24,
+                              write_behind=10)
+    db['key'] = dcm
+    assert fake_couch.databases[name].live_ids() == []
+    dcm.PatientName = 'Changed^Queued'
+    db['key'] = dcm
+    assert db['key'].PatientName == 'Changed^Queued'
+    assert fake_couch.databases[name].live_ids() == ['key']
+
+
+@pytest.mark.parametrize('options', [
+    {}, {'dedup': True}, {'doc_format': 'dicomjson'}])
+def test_compressed_attachments_round_trip(fake_couch, options):
+    dcm = read_testfile('CT_small.dcm')
+    jpeg = read_testfile('SC_rgb_jpeg_dcmtk.dcm')
+    name = next(_db_names)
+    db = dicom_dao.DicomCouch(fake_couch.url, name, codec='auto', **options)
+    db.update([('ct', dcm), ('jpeg', jpeg)])
+
+    # Read whatever the reader's codec, the codec is in the content type
+    for codec in (None, 'auto'):
+        reader = dicom_dao.DicomCouch(fake_couch.url, name, codec=codec,
+                                      **options)
+        assert_same_dataset(dcm, reader['ct'])
+        read = reader['jpeg']
+        assert read.PixelData == jpeg.PixelData
+        assert read['PixelData'].is_undefined_length
+    reader['jpeg'] = read  # Still stored as it is, see below
+
+    def stub(key, value):
+        """ Return the stub of the attachment holding value """
+        if options.get('dedup'):
+            key, id = dicom_dao._blob_id(value), dicom_dao.BLOB_ATTACHMENT
+        else:
+            id = '(7fe0, 0010)' if 'doc_format' not in options else \
+                fake_couch.databases[name].render(key)['7FE00010'][
+                    'BulkDataURI'].rsplit('/', 1)[1]
+        return fake_couch.databases[name].render(key)['_attachments'][id]
+
+    ct_stub = stub('ct', dcm.PixelData)
+    assert ct_stub['content_type'] == dicom_dao._codec_content_type(
+        dicom_dao._best_codec())
+    assert ct_stub['length'] < len(dcm.PixelData)
+    # Encapsulated pixel data is stored as it is
+    jpeg_stub = stub('jpeg', jpeg.PixelData)
+    assert jpeg_stub['content_type'] == dicom_dao.ATTACHMENT_CONTENT_TYPE
+    assert jpeg_stub['length'] == len(jpeg.PixelData)
+
+
+def test_sqlite_blob_files_are_shared(tmp_path):
+    dcm = read_testfile('CT_small.dcm')
+    db = dicom_dao.DicomSQLite(str(tmp_path))
+
+    def blob_files():
+        return sorted(path.name for path in (tmp_path / 'blobs').rglob('*')
+                      if path.is_file())
+
+    db['k1'] = dcm
+    files = blob_files()
+    db['k2'] = dcm
+    assert blob_files() == files
+    del db['k1']
+    assert blob_files() == files
+    del db['k2']
+    assert blob_files() == []
+
+
+def test_archive_errors_go_to_stderr(tmp_path, capsys):
+    argv = ['dicom_dao_archive.py', 'export', '--sqlite', str(tmp_path),
+            str(tmp_path / 'archive.rar')]
+    assert dicom_dao_archive.main(argv) == 1
+    out, err = capsys.readouterr()
+    assert out == '' and 'Unknown archive format' in err
+
+
+def test_import_closes_the_key_store(tmp_path):
+    dcm = read_testfile('CT_small.dcm')
+    source = dicom_dao.DicomSQLite(str(tmp_path / 'source'))
+    source['key'] = dcm
+    archive = str(tmp_path / 'archive.zip')
+    dicom_dao_archive.export_archive(source, archive)
+
+    stores = []
+
+    def factory():
+        stores.append(dicom_dao.DicomSQLite(str(tmp_path / 'imported')))
+        return stores[-1]
+    assert dicom_dao_archive.import_archive(factory, archive, workers=1,
+                                            key_from_dataset=True) == 1
+    with pytest.raises(sqlite3.ProgrammingError):  # Closed
+        stores[0].count_instances()
+    imported = dicom_dao.DicomSQLite(str(tmp_path / 'imported'))
+    assert list(imported.iter_keys()) == [dcm.SeriesInstanceUID]
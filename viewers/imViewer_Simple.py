@@ -2,15 +2,30 @@
 # imViewer-Simple.py
 #
 #    An example program that opens uncompressed DICOM images and
-# converts them via numPy and PIL to be viewed in wxWidgets GUI
-# apps.  The conversion is currently:
+# converts them via numPy to be viewed in wxWidgets GUI apps.
+# The conversion is:
 #
-#    pydicom->NumPy->PIL->wxPython.Image->wxPython.Bitmap
+#    pydicom->NumPy->wxPython.Bitmap
 #
-# Gruesome but it mostly works.  Surely there is at least one
-# of these steps that could be eliminated (probably PIL) but
-# haven't tried that yet and I may want some of the PIL manipulation
-# functions.
+# The pixel data is windowed into 8-bit grey values with a lookup
+# table (see pydicom_windowing.py), expanded into an RGB buffer
+# that is kept from one image to the next, and handed straight to
+# wx.Bitmap.FromBuffer(), so the only whole-image copies are the
+# windowing, the grey to RGB expansion and wx's own.  PIL and
+# wx.Image are no longer involved.
+#
+#    Drag with the left mouse button to change window (left/right)
+# and level (up/down), with the right or middle button to pan, and
+# use the mouse wheel to zoom.  Double-click to reset the view.  The
+# decoded pixels are kept while the image is shown, only the part
+# in view is windowed, and redraws are throttled to REFRESH_MS, so
+# none of this reads or decodes the file again.
+#
+#    Files are read, decoded and prepared for display on a worker
+# thread, READ_CHUNK bytes at a time with the progress shown in the
+# status bar, so the window stays responsive when opening large
+# files from network shares.  Opening another file supersedes a
+# load still going, and Esc cancels it.
 #
 #    This won't handle RLE, embedded JPEG-Lossy, JPEG-lossless,
 # JPEG2000, old ACR/NEMA files, or anything wierd.  Also doesn't
@@ -29,21 +44,37 @@
 # Updated by Aditya Panchal: Oct. 9, 2018
 # ===================================================================
 
+import io
+import os
+import threading
+
 import pydicom
 import wx
 
-have_PIL = True
-try:
-    import PIL.Image
-except ImportError:
-    have_PIL = False
-
 have_numpy = True
 try:
     import numpy as np
 except ImportError:
     have_numpy = False
 
+# pydicom_windowing needs numpy too. It is imported on its own, so
+# that an error in it is reported, not taken for missing numpy
+if have_numpy:
+    import pydicom_windowing
+
+# Milliseconds between redraws while dragging or zooming
+REFRESH_MS = 16
+
+ZOOM_STEP = 1.25
+MIN_ZOOM = 1 / 16.0
+MAX_ZOOM = 32.0
+
+# Characters of an element shown in the tree
+MAX_TEXT_LENGTH = 200
+
+# Bytes read from a file between progress reports
+READ_CHUNK = 1 << 20
+
 # ----------------------------------------------------------------
 #  Initialize image capabilities.
 # ----------------------------------------------------------------
@@ -59,6 +90,20 @@ def MsgDlg(window, string, caption='OFAImage', style=wx.YES_NO | wx.CANCEL):
     return result
 
 
+def element_text(data_element):
+    """Return the tree text for data_element, at most MAX_TEXT_LENGTH
+       characters.  Sequences show their number of items rather than
+       their contents."""
+    if data_element.VR == "SQ":
+        count = len(data_element.value)
+        return "%s %s: %d item%s" % (data_element.tag, data_element.name,
+                                     count, "" if count == 1 else "s")
+    text = str(data_element)
+    if len(text) > MAX_TEXT_LENGTH:
+        text = text[:MAX_TEXT_LENGTH - 3] + "..."
+    return text
+
+
 class ImFrame(wx.Frame):
     """Class for main window."""
 
@@ -85,12 +130,16 @@ class ImFrame(wx.Frame):
         menu = wx.Menu()
         item = menu.Append(wx.ID_ANY, '&Open...\tCtrl+O', 'Open file for editing')
         self.Bind(wx.EVT_MENU, self.OnFileOpen, item)
+        item = menu.Append(wx.ID_ANY, '&Cancel Loading\tEsc',
+                           'Stop opening the file')
+        self.Bind(wx.EVT_MENU, self.OnCancelLoad, item)
         item = menu.Append(wx.ID_ANY, 'E&xit', 'Exit Program')
         self.Bind(wx.EVT_MENU, self.OnFileExit, item)
         self.mainmenu.Append(menu, '&File')
 
         # Attach the menu bar to the window.
         self.SetMenuBar(self.mainmenu)
+        self.CreateStatusBar()
 
         # --------------------------------------------------------
         # Set up the main splitter window.
@@ -103,6 +152,7 @@ class ImFrame(wx.Frame):
         # -------------------------------------------------------------
         dsstyle = wx.TR_LINES_AT_ROOT | wx.TR_HAS_BUTTONS
         self.dsTreeView = wx.TreeCtrl(self.mainSplitter, style=dsstyle)
+        self.dsTreeView.Bind(wx.EVT_TREE_ITEM_EXPANDING, self.OnTreeExpanding)
 
         # --------------------------------------------------------
         # Create the ImageView on the right pane.
@@ -115,6 +165,16 @@ class ImFrame(wx.Frame):
 
         self.imView.Bind(wx.EVT_SIZE, self.OnSize)
 
+        self.imView.Bind(wx.EVT_LEFT_DOWN, self.OnMouseDown)
+        self.imView.Bind(wx.EVT_RIGHT_DOWN, self.OnMouseDown)
+        self.imView.Bind(wx.EVT_MIDDLE_DOWN, self.OnMouseDown)
+        self.imView.Bind(wx.EVT_MOTION, self.OnMouseMotion)
+        self.imView.Bind(wx.EVT_MOUSEWHEEL, self.OnMouseWheel)
+        self.imView.Bind(wx.EVT_LEFT_DCLICK, self.OnResetView)
+
+        self.refreshTimer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnRefreshTimer, self.refreshTimer)
+
         # --------------------------------------------------------
         # Install the splitter panes.
         # --------------------------------------------------------
@@ -128,6 +188,19 @@ class ImFrame(wx.Frame):
         self.foldersRoot = False
         self.loadCentered = True
         self.bitmap = None
+        self.bitmapPos = (0, 0)
+        self.greyBuffer = None
+        self.rgbBuffer = None
+        self.imageFile = ""
+        self.dataset = None
+        self.pixels = None
+        self.window = None
+        self.level = None
+        self.zoom = 1.0
+        self.centre = (0.0, 0.0)
+        self.dragFrom = None
+        self.loadId = 0
+        self.loading = False
         self.Show(True)
 
     def OnFileExit(self, event):
@@ -137,7 +210,7 @@ class ImFrame(wx.Frame):
 
     def OnSize(self, event):
         """Window 'size' event."""
-        self.Refresh()
+        self.request_render()
 
     def OnEraseBackground(self, event):
         """Window 'erase background' event."""
@@ -145,30 +218,47 @@ class ImFrame(wx.Frame):
 
     def populateTree(self, ds):
         """ Populate the tree in the left window with the [desired]
-        dataset values"""
+        dataset values.  Only the top level is added; sequences
+        get their items when they are first expanded."""
         if not self.dcmdsRoot:
             self.dcmdsRoot = self.dsTreeView.AddRoot(text="DICOM Objects")
         else:
             self.dsTreeView.DeleteChildren(self.dcmdsRoot)
         self.recurse_tree(ds, self.dcmdsRoot)
-        self.dsTreeView.ExpandAll()
+        self.dsTreeView.Expand(self.dcmdsRoot)
 
     def recurse_tree(self, ds, parent, hide=False):
         """ order the dicom tags """
         for data_element in ds:
-            if isinstance(data_element.value, str):
-                text = str(data_element)
-                ip = self.dsTreeView.AppendItem(parent, text=text)
-            else:
-                ip = self.dsTreeView.AppendItem(parent, text=str(data_element))
-
-            if data_element.VR == "SQ":
-                for i, ds in enumerate(data_element.value):
-                    item_describe = data_element.name.replace(" Sequence", "")
-                    item_text = "%s %d" % (item_describe, i + 1)
-                    rjust = item_text.rjust(128)
-                    parentNodeID = self.dsTreeView.AppendItem(ip, text=rjust)
-                    self.recurse_tree(ds, parentNodeID)
+            ip = self.dsTreeView.AppendItem(parent,
+                                            text=element_text(data_element))
+            if data_element.VR == "SQ" and data_element.value:
+                self.add_placeholder(ip, data_element)
+
+    def add_placeholder(self, item, value):
+        """ Give item an empty child, so it can be expanded, and
+        the sequence or dataset value to fill it with then """
+        self.dsTreeView.SetItemData(item, value)
+        self.dsTreeView.AppendItem(item, text="")
+
+    def OnTreeExpanding(self, event):
+        """ Add the items of a sequence, or the elements of an
+        item, the first time it is expanded """
+        item = event.GetItem()
+        value = self.dsTreeView.GetItemData(item)
+        if value is None:
+            return
+        self.dsTreeView.SetItemData(item, None)
+        self.dsTreeView.DeleteChildren(item)
+        if isinstance(value, pydicom.DataElement):
+            item_describe = value.name.replace(" Sequence", "")
+            for i, ds in enumerate(value.value):
+                item_text = "%s %d" % (item_describe, i + 1)
+                parentNodeID = self.dsTreeView.AppendItem(item,
+                                                          text=item_text)
+                self.add_placeholder(parentNodeID, ds)
+        else:
+            self.recurse_tree(value, item)
 
     # --- Most of what is important happens below this line ---------------------
 
@@ -180,7 +270,14 @@ class ImFrame(wx.Frame):
             fullPath = dlg.GetPath()
             imageFile = dlg.GetFilename()
             # checkDICMHeader()
-            self.show_file(imageFile, fullPath)
+            self.load_file(imageFile, fullPath)
+
+    def OnCancelLoad(self, event):
+        """Stops opening a file."""
+        if self.loading:
+            self.loadId += 1
+            self.loading = False
+            self.SetStatusText("Cancelled")
 
     def OnPaint(self, event):
         """Window 'paint' event."""
@@ -193,131 +290,318 @@ class ImFrame(wx.Frame):
         dc.SetBrush(wx.Brush("GREY", wx.CROSSDIAG_HATCH))
         windowsize = self.imView.GetSize()
         dc.DrawRectangle(0, 0, windowsize[0], windowsize[1])
-        bmpX0 = 0
-        bmpY0 = 0
         if self.bitmap is not None:
-            if self.loadCentered:
-                bmpX0 = (windowsize[0] - self.bitmap.Width) / 2
-                bmpY0 = (windowsize[1] - self.bitmap.Height) / 2
-            dc.DrawBitmap(self.bitmap, bmpX0, bmpY0, False)
+            dc.DrawBitmap(self.bitmap, self.bitmapPos[0], self.bitmapPos[1],
+                          False)
 
-    # ------------------------------------------------------------
-    #  ImFrame.ConvertWXToPIL()
-    #  Expropriated from Andrea Gavana's
-    #  ShapedButton.py in the wxPython dist
-    # ------------------------------------------------------------
-    def ConvertWXToPIL(self, bmp):
-        """ Convert wx.Image Into PIL Image. """
-        width = bmp.GetWidth()
-        height = bmp.GetHeight()
-        im = wx.EmptyImage(width, height)
-        im.fromarray("RGBA", (width, height), bmp.GetData())
-        return im
+    def OnMouseDown(self, event):
+        """Start dragging."""
+        self.dragFrom = event.GetPosition()
+        event.Skip()
+
+    def OnMouseMotion(self, event):
+        """Change window/level with the left button, pan otherwise."""
+        if self.pixels is None or self.dragFrom is None:
+            return
+        if not event.Dragging():
+            self.dragFrom = None
+            return
+        pos = event.GetPosition()
+        dx = pos.x - self.dragFrom.x
+        dy = pos.y - self.dragFrom.y
+        self.dragFrom = pos
+        if event.LeftIsDown():
+            if self.colour:
+                return
+            if self.window is None:
+                self.window, self.level = 256.0, 128.0
+            self.window = max(1.0, self.window + dx * self.wlStep)
+            self.level += dy * self.wlStep
+        elif event.RightIsDown() or event.MiddleIsDown():
+            self.centre = (self.centre[0] - dx / self.zoom,
+                           self.centre[1] - dy / self.zoom)
+        self.request_render()
+
+    def OnMouseWheel(self, event):
+        """Zoom in or out, keeping the point under the mouse still."""
+        if self.pixels is None:
+            return
+        if event.GetWheelRotation() > 0:
+            zoom = min(self.zoom * ZOOM_STEP, MAX_ZOOM)
+        else:
+            zoom = max(self.zoom / ZOOM_STEP, MIN_ZOOM)
+        pos = event.GetPosition()
+        width, height = self.imView.GetClientSize()
+        dx = pos.x - width / 2.0
+        dy = pos.y - height / 2.0
+        self.centre = (self.centre[0] + dx / self.zoom - dx / zoom,
+                       self.centre[1] + dy / self.zoom - dy / zoom)
+        self.zoom = zoom
+        self.request_render()
+
+    def OnResetView(self, event):
+        """Back to the dataset's window/level, unzoomed."""
+        self.reset_view()
+        self.render()
+
+    def OnRefreshTimer(self, event):
+        """Redraw after changes to the view."""
+        self.render()
+
+    def request_render(self):
+        """Redraw the view in REFRESH_MS, however many changes
+           come in before then."""
+        if not self.refreshTimer.IsRunning():
+            self.refreshTimer.StartOnce(REFRESH_MS)
+
+    def reset_view(self):
+        """Show the image 1:1 with the dataset's window/level."""
+        self.window, self.level = self.defaultWindow
+        self.zoom = 1.0
+        rows, cols = self.pixels.shape[:2]
+        if self.loadCentered:
+            self.centre = (cols / 2.0, rows / 2.0)
+        else:
+            width, height = self.imView.GetClientSize()
+            self.centre = (width / 2.0, height / 2.0)
+
+    def visible_indices(self, length, size, centre):
+        """Return the first pixel of the view along an axis of
+           size pixels, and the image indices shown from there on,
+           for an image axis of length pixels."""
+        screen = np.arange(size) + 0.5 - size / 2.0
+        index = np.floor(centre + screen / self.zoom).astype(np.intp)
+        shown = np.flatnonzero((index >= 0) & (index < length))
+        if not len(shown):
+            return 0, index[:0]
+        return shown[0], index[shown[0]:shown[-1] + 1]
+
+    def render(self):
+        """Make self.bitmap of the part of the image in view."""
+        if self.pixels is None:
+            return
+        width, height = self.imView.GetClientSize()
+        rows, cols = self.pixels.shape[:2]
+        top, rowIndex = self.visible_indices(rows, height, self.centre[1])
+        left, colIndex = self.visible_indices(cols, width, self.centre[0])
+        if not len(rowIndex) or not len(colIndex):
+            self.bitmap = None
+        else:
+            if self.zoom == 1:
+                view = self.pixels[rowIndex[0]:rowIndex[-1] + 1,
+                                   colIndex[0]:colIndex[-1] + 1]
+            else:
+                view = self.pixels[np.ix_(rowIndex, colIndex)]
+            self.bitmap = self.ConvertArrayToWX(self.window_view(view))
+            self.bitmapPos = (int(left), int(top))
+        title = "%s  %d%%" % (self.imageFile, round(self.zoom * 100))
+        if self.window is not None:
+            title += "  W %g L %g" % (round(self.window), round(self.level))
+        self.SetTitle(title)
+        self.imView.Refresh(False)
 
     # ------------------------------------------------------------
-    #  ImFrame.ConvertPILToWX()
-    #  Expropriated from Andrea Gavana's
-    #  ShapedButton.py in the wxPython dist
+    #  ImFrame.ConvertArrayToWX()
     # ------------------------------------------------------------
-    def ConvertPILToWX(self, pil, alpha=True):
-        """ Convert PIL Image Into wx.Image. """
-        if alpha:
-            image = wx.Image(pil.size[0], pil.size[1], clear=True)
-            image.SetData(pil.convert("RGB").tobytes())
-            image.SetAlpha(pil.convert("RGBA").tobytes()[3::4])
+    def ConvertArrayToWX(self, image):
+        """ Convert a uint8 array of grey values or RGB triplets
+        into wx.Bitmap, through an RGB buffer reused while the
+        image size stays the same."""
+        height, width = image.shape[:2]
+        if (self.rgbBuffer is None or
+                self.rgbBuffer.shape[:2] != (height, width)):
+            self.rgbBuffer = np.empty((height, width, 3), np.uint8)
+        if image.ndim == 2:
+            self.rgbBuffer[...] = image[..., np.newaxis]
         else:
-            image = wx.Image(pil.size[0], pil.size[1], clear=True)
-            new_image = pil.convert('RGB')
-            data = new_image.tobytes()
-            image.SetData(data)
-        return image
+            self.rgbBuffer[...] = image
+        return wx.Bitmap.FromBuffer(width, height, self.rgbBuffer)
 
-    def get_LUT_value(self, data, window, level):
+    def get_LUT_value(self, data, window, level, bits_stored=None,
+                      signed=None):
         """Apply the RGB Look-Up Table for the given
-           data and window/level value."""
+           data and window/level value, see pydicom_windowing."""
         if not have_numpy:
             raise ImportError("Numpy is not available. "
                               "See http://numpy.scipy.org/ "
                               "to download and install")
 
-        win = window
-        lvl = level
-
-        e = [
-            0, 255,
-            lambda data: ((data - (lvl - 0.5)) / (win - 1) + 0.5) * (255 - 0)
-        ]
-        return np.piecewise(data, [
-            data <= (lvl - 0.5 - (win - 1) / 2),
-            data > (lvl - 0.5 + (win - 1) / 2)
-        ], e)
+        return pydicom_windowing.apply_window(data, window, level,
+                                              bits_stored, signed)
 
     # -----------------------------------------------------------
-    # ImFrame.loadPIL_LUT(dataset)
-    # Display an image using the Python Imaging Library (PIL)
+    # ImFrame.load_image(dataset)
+    # Keep the pixels of a dataset to window as they are shown
     # -----------------------------------------------------------
-    def loadPIL_LUT(self, dataset):
-        if not have_PIL:
-            raise ImportError("Python Imaging Library is not available."
-                              " See http://www.pythonware.com/products/pil/"
-                              " to download and install")
-        if 'PixelData' not in dataset:
-            raise TypeError("Cannot show image -- "
-                            "DICOM dataset does not have pixel data")
-
-        # can only apply LUT if these values exist
-        if ('WindowWidth' not in dataset) or ('WindowCenter' not in dataset):
-            bits = dataset.BitsAllocated
-            samples = dataset.SamplesPerPixel
-            if bits == 8 and samples == 1:
-                mode = "L"
-            elif bits == 8 and samples == 3:
-                mode = "RGB"
-            # not sure about this -- PIL source says is
-            # 'experimental' and no documentation.
-            elif bits == 16:
-                # Also, should bytes swap depending
-                # on endian of file and system??
-                mode = "I;16"
-            else:
-                msg = "Don't know PIL mode for %d BitsAllocated" % (bits)
-                msg += " and %d SamplesPerPixel" % (samples)
-                raise TypeError(msg)
-            size = (dataset.Columns, dataset.Rows)
-
-            # Recommended to specify all details by
-            # http://www.pythonware.com/library/pil/handbook/image.htm
-            im = PIL.Image.frombuffer(mode, size, dataset.PixelData, "raw",
-                                      mode, 0, 1)
-        else:
-            ew = dataset['WindowWidth']
-            ec = dataset['WindowCenter']
-            ww = int(ew.value[0] if ew.VM > 1 else ew.value)
-            wc = int(ec.value[0] if ec.VM > 1 else ec.value)
-            image = self.get_LUT_value(dataset.pixel_array, ww, wc)
-
-            # Convert mode to L since LUT has only 256 values:
-            # http://www.pythonware.com/library/pil/handbook/image.htm
-            im = PIL.Image.fromarray(image).convert('L')
-        return im
+    def load_image(self, dataset, image=None):
+        """Keep the image of dataset, decoded once, with the
+           window/level it is shown with first.  image is what
+           prepare_image() returns for dataset, if it has been
+           called already."""
+        if image is None:
+            image = prepare_image(dataset)
+        self.dataset = dataset
+        (self.pixels, self.colour, self.rescale, self.defaultWindow,
+         self.wlStep) = image
+        self.reset_view()
+
+    def window_view(self, view):
+        """Window/level view, part of the image, into uint8 values."""
+        if self.colour or self.window is None:
+            return view
+        if self.greyBuffer is None or self.greyBuffer.shape != view.shape:
+            self.greyBuffer = np.empty(view.shape, np.uint8)
+        return pydicom_windowing.apply_window(
+            view, self.window, self.level, self.dataset.get('BitsStored'),
+            self.dataset.get('PixelRepresentation', 0) == 1,
+            self.rescale[0], self.rescale[1], out=self.greyBuffer)
 
     def show_file(self, imageFile, fullPath):
         """ Load the DICOM file, make sure it contains at least one
-        image, and set it up for display by OnPaint().  ** be
-        careful not to pass a unicode string to read_file or it will
-        give you 'fp object does not have a defer_size attribute,
-        or some such."""
-        ds = pydicom.dcmread(str(fullPath))
+        image, and set it up for display by OnPaint().  This blocks
+        until the file is read, see load_file() for a load in the
+        background."""
+        ds = read_file(fullPath)
 
         # change strings to unicode
         ds.decode()
+        self.show_dataset(imageFile, ds)
+
+    def show_dataset(self, imageFile, ds, image=None):
+        """ Show ds, read from imageFile, in the tree and its image
+        (see load_image()) in the view."""
         self.populateTree(ds)
+        self.imageFile = imageFile
         if 'PixelData' in ds:
-            self.dImage = self.loadPIL_LUT(ds)
-            if self.dImage is not None:
-                tmpImage = self.ConvertPILToWX(self.dImage, False)
-                self.bitmap = wx.Bitmap(tmpImage)
-                self.Refresh()
+            self.load_image(ds, image)
+            self.render()
+        else:
+            self.pixels = None
+            self.bitmap = None
+            self.SetTitle(imageFile)
+            self.imView.Refresh(False)
+
+    def load_file(self, imageFile, fullPath):
+        """ Load the DICOM file on a worker thread and show it when
+        it is ready, unless another load has been started or the
+        load has been cancelled by then."""
+        self.loadId += 1
+        self.loading = True
+        self.SetStatusText("Loading %s" % imageFile)
+        worker = threading.Thread(target=self.load_worker,
+                                  args=(self.loadId, imageFile, fullPath))
+        worker.daemon = True
+        worker.start()
+
+    def load_worker(self, loadId, imageFile, fullPath):
+        """ Read, decode and prepare the file for load_file().  The
+        GUI is only touched through wx.CallAfter()."""
+        def cancelled():
+            return loadId != self.loadId
+
+        def progress(percent):
+            wx.CallAfter(self.load_progress, loadId, imageFile, percent)
+
+        try:
+            ds = read_file(fullPath, progress, cancelled)
+            if ds is None or cancelled():
+                return
+            ds.decode()
+            image = None
+            if 'PixelData' in ds:
+                image = prepare_image(ds)
+        except Exception as e:
+            wx.CallAfter(self.load_failed, loadId, imageFile, e)
+            return
+        wx.CallAfter(self.load_done, loadId, imageFile, ds, image)
+
+    def load_progress(self, loadId, imageFile, percent):
+        """ Show how far loading the file has got."""
+        if loadId == self.loadId:
+            self.SetStatusText("Loading %s: %d%%" % (imageFile, percent))
+
+    def load_done(self, loadId, imageFile, ds, image):
+        """ Show a file load_worker() has read."""
+        if loadId == self.loadId:
+            self.loading = False
+            self.SetStatusText("")
+            self.show_dataset(imageFile, ds, image)
+
+    def load_failed(self, loadId, imageFile, error):
+        """ Report a file load_worker() could not read."""
+        if loadId == self.loadId:
+            self.loading = False
+            self.SetStatusText("")
+            MsgDlg(self, "Cannot open %s:\n%s" % (imageFile, error),
+                   style=wx.OK | wx.ICON_ERROR)
+
+
+def read_file(fullPath, progress=None, cancelled=None):
+    """Read the DICOM file at fullPath, READ_CHUNK bytes at a time,
+       calling progress(percent) whenever the percentage read
+       changes.  Returns None if cancelled() turns True first."""
+    size = os.path.getsize(fullPath)
+    data = io.BytesIO()
+    percent = -1
+    with open(fullPath, 'rb') as f:
+        while True:
+            if cancelled is not None and cancelled():
+                return None
+            chunk = f.read(READ_CHUNK)
+            if not chunk:
+                break
+            data.write(chunk)
+            if progress is not None and size:
+                done = 100 * data.tell() // size
+                if done != percent:
+                    percent = done
+                    progress(percent)
+    data.seek(0)
+    return pydicom.dcmread(data)
+
+
+def prepare_image(dataset):
+    """Return (pixels, colour, rescale, default window, window/level
+       drag step) for showing the image of dataset, see
+       ImFrame.load_image().  This touches no GUI, so it can be
+       called from any thread."""
+    if not have_numpy:
+        raise ImportError("Numpy is not available. "
+                          "See http://numpy.scipy.org/ "
+                          "to download and install")
+    if 'PixelData' not in dataset:
+        raise TypeError("Cannot show image -- "
+                        "DICOM dataset does not have pixel data")
+
+    arr = pydicom_windowing.get_frame_array(dataset)
+    samples = dataset.get('SamplesPerPixel', 1)
+    colour = samples == 3 and arr.dtype == np.uint8
+    if samples != 1 and not colour:
+        msg = "Don't know how to show %d BitsAllocated" % (
+            dataset.BitsAllocated)
+        msg += " and %d SamplesPerPixel" % (samples)
+        raise TypeError(msg)
+
+    rescale = pydicom_windowing.get_rescale(dataset)
+    defaultWindow = (None, None)
+    wlStep = 1.0
+    if not colour:
+        # 8-bit images without a window are shown as they are,
+        # anything else with its window, or one spanning its values,
+        # leaving out any bits above BitsStored
+        values = pydicom_windowing.get_stored_values(
+            arr, dataset.get('BitsStored'),
+            dataset.get('PixelRepresentation', 0) == 1)
+        window = pydicom_windowing.get_window_level(dataset)
+        if window is None and arr.dtype != np.uint8:
+            window = pydicom_windowing.get_value_range_window(values,
+                                                              *rescale)
+        if window is not None:
+            defaultWindow = window
+        # A drag across 512 pixels spans all the values
+        low, high = values.min(), values.max()
+        wlStep = max(1.0, float(high) - float(low)) * abs(rescale[0]) / 512.0
+    return arr, colour, rescale, defaultWindow, wlStep
 
 
 # ------ This is just the initialization of the App  ----
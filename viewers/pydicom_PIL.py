@@ -8,6 +8,10 @@ Usage:
 >>> ds = pydicom.dcmread("filename")
 >>> show_PIL(ds)
 
+Thumbnails of a whole series, as PNG bytes:
+>>> from pydicom.contrib.pydicom_PIL import render_thumbnails
+>>> pngs = render_thumbnails(series, max_size=128, report=True)
+
 Requires Numpy:
     http://numpy.scipy.org/
 
@@ -31,77 +35,181 @@ try:
 except ImportError:
     have_PIL = False
 
+import concurrent.futures
+import io
+import time
+
 try:
     import numpy as np
     have_numpy = True
 except ImportError:
     have_numpy = False
 
+# pydicom_windowing needs numpy too. It is imported on its own, so
+# that an error in it is reported, not taken for missing numpy
+if have_numpy:
+    import pydicom_windowing
 
-def get_LUT_value(data, window, level):
+
+def get_LUT_value(data, window, level, bits_stored=None, signed=None):
     """Apply the RGB Look-Up Table for the given
-       data and window/level value."""
+       data and window/level value.
+
+    Returns uint8 grey values. The table is built once per
+    window, level, bits_stored and signedness (by default
+    those of data's type) and cached, see pydicom_windowing."""
     if not have_numpy:
         raise ImportError("Numpy is not available."
                           "See http://numpy.scipy.org/"
                           "to download and install")
 
-    return np.piecewise(data,
-                        [data <= (level - 0.5 - (window - 1) / 2),
-                         data > (level - 0.5 + (window - 1) / 2)],
-                        [0, 255, lambda data: ((data - (level - 0.5)) /
-                         (window - 1) + 0.5) * (255 - 0)])
+    return pydicom_windowing.apply_window(data, window, level,
+                                          bits_stored, signed)
 
 
-def get_PIL_image(dataset):
-    """Get Image object from Python Imaging Library(PIL)"""
+def get_PIL_image(dataset, frame=0, window=None, level=None):
+    """Get Image object from Python Imaging Library(PIL)
+
+    Only the given frame of a multi-frame dataset is decoded, and
+    uncompressed pixel data is not copied before windowing.
+    With a window and level, from the dataset or given, rescale
+    and window are applied together to give an 8-bit image;
+    otherwise the stored values are shown as they are.
+    """
     if not have_PIL:
         raise ImportError("Python Imaging Library is not available. "
                           "See http://www.pythonware.com/products/pil/ "
                           "to download and install")
+    if not have_numpy:
+        raise ImportError("Numpy is not available."
+                          "See http://numpy.scipy.org/"
+                          "to download and install")
 
     if ('PixelData' not in dataset):
         raise TypeError("Cannot show image -- DICOM dataset does not have "
                         "pixel data")
+    arr = pydicom_windowing.get_frame_array(dataset, frame)
+    samples = dataset.SamplesPerPixel
     # can only apply LUT if these window info exists
-    if ('WindowWidth' not in dataset) or ('WindowCenter' not in dataset):
-        bits = dataset.BitsAllocated
-        samples = dataset.SamplesPerPixel
-        if bits == 8 and samples == 1:
-            mode = "L"
-        elif bits == 8 and samples == 3:
-            mode = "RGB"
-        elif bits == 16:
-            # not sure about this -- PIL source says is 'experimental'
-            # and no documentation. Also, should bytes swap depending
-            # on endian of file and system??
-            mode = "I;16"
-        else:
-            raise TypeError("Don't know PIL mode for %d BitsAllocated "
-                            "and %d SamplesPerPixel" % (bits, samples))
-
-        # PIL size = (width, height)
-        size = (dataset.Columns, dataset.Rows)
-
-        # Recommended to specify all details
-        # by http://www.pythonware.com/library/pil/handbook/image.htm
-        im = PIL.Image.frombuffer(mode, size, dataset.PixelData,
-                                  "raw", mode, 0, 1)
-
-    else:
-        ew = dataset['WindowWidth']
-        ec = dataset['WindowCenter']
-        ww = int(ew.value[0] if ew.VM > 1 else ew.value)
-        wc = int(ec.value[0] if ec.VM > 1 else ec.value)
-        image = get_LUT_value(dataset.pixel_array, ww, wc)
-        # Convert mode to L since LUT has only 256 values:
+    if samples == 1 and (window is not None and level is not None or
+                         pydicom_windowing.get_window_level(dataset)):
+        # Mode L since LUT has only 256 values:
         #   http://www.pythonware.com/library/pil/handbook/image.htm
-        im = PIL.Image.fromarray(image).convert('L')
-
-    return im
-
-
-def show_PIL(dataset):
+        image = pydicom_windowing.apply_dataset_window(dataset, arr,
+                                                       window, level)
+        return PIL.Image.fromarray(image)
+
+    bits = dataset.BitsAllocated
+    if bits == 8 and samples in (1, 3):
+        # L or RGB
+        return PIL.Image.fromarray(np.ascontiguousarray(arr))
+    if bits == 16 and samples == 1:
+        # I;16 (or I;16B as stored) for unsigned values, I for signed
+        # ones, which are sign extended from BitsStored first
+        if dataset.get('PixelRepresentation', 0) == 1:
+            shift = 16 - dataset.BitsStored
+            if shift:
+                arr = (arr << shift) >> shift
+        return PIL.Image.fromarray(np.ascontiguousarray(arr))
+    raise TypeError("Don't know PIL mode for %d BitsAllocated "
+                    "and %d SamplesPerPixel" % (bits, samples))
+
+
+def show_PIL(dataset, frame=0):
     """Display an image using the Python Imaging Library (PIL)"""
-    im = get_PIL_image(dataset)
+    im = get_PIL_image(dataset, frame)
     im.show()
+
+
+def reduce_array(arr, factor, method='mean'):
+    """Shrink the rows and columns of arr by an integer factor.
+
+    method 'mean' averages factor x factor blocks, which keeps
+    the result free of aliasing, 'stride' takes every factor'th
+    pixel, a view that costs nothing. Integer data stays integer
+    (block means are rounded down), so a lookup table can still
+    be applied to it. Rows and columns left over are dropped.
+    """
+    if factor <= 1:
+        return arr
+    if method == 'stride':
+        return arr[::factor, ::factor]
+    if method != 'mean':
+        raise ValueError("Unknown reduction method %r" % method)
+    rows = arr.shape[0] // factor
+    cols = arr.shape[1] // factor
+    blocks = arr[:rows * factor, :cols * factor].reshape(
+        (rows, factor, cols, factor) + arr.shape[2:])
+    if arr.dtype.kind in 'ui':
+        total = blocks.sum(axis=(1, 3), dtype=np.int64)
+        return (total // (factor * factor)).astype(arr.dtype)
+    return blocks.mean(axis=(1, 3))
+
+
+def get_thumbnail_image(dataset, max_size=128, window=None, level=None,
+                        method='mean'):
+    """Get a PIL Image of dataset no larger than max_size pixels square.
+
+    The stored pixel values are reduced before windowing, so only
+    the pixels of the thumbnail pass through the lookup table.
+    window and level default to those of the dataset, or else to
+    the range of its pixel values. Colour samples of more than
+    8 bits are scaled down to their top 8 bits stored. Bits
+    above BitsStored are cleared, or sign extended, before the
+    pixels are averaged.
+    """
+    if not (have_PIL and have_numpy):
+        raise ImportError("Numpy and the Python Imaging Library are "
+                          "needed for thumbnails")
+    if 'PixelData' not in dataset:
+        raise TypeError("Cannot show image -- DICOM dataset does not have "
+                        "pixel data")
+    arr = pydicom_windowing.get_frame_values(dataset)
+    factor = -(-max(arr.shape[:2]) // max_size)  # Round up
+    arr = reduce_array(arr, factor, method)
+    if dataset.get('SamplesPerPixel', 1) != 1:
+        bits_stored = dataset.get('BitsStored', 8)
+        if arr.dtype.itemsize > 1 and bits_stored > 8:
+            arr = arr >> (bits_stored - 8)
+        return PIL.Image.fromarray(np.ascontiguousarray(arr, np.uint8),
+                                   'RGB')
+
+    image = pydicom_windowing.apply_dataset_window(dataset, arr, window,
+                                                   level)
+    return PIL.Image.fromarray(np.ascontiguousarray(image))
+
+
+def render_thumbnails(datasets, max_size=128, format='PNG', window=None,
+                      level=None, method='mean', workers=None, report=False,
+                      **save_options):
+    """Render a thumbnail of each dataset, returning the encoded bytes.
+
+    datasets is a list of datasets or a DicomSeries (see
+    pydicom_series.py). The images are rendered by a pool of
+    workers threads, as decoding, reduction, windowing and
+    encoding mostly release the GIL. format and save_options
+    are passed to PIL.Image.save(), e.g. format='JPEG',
+    quality=85. With report the throughput is printed.
+    The result is in the order of datasets.
+    """
+    # DicomSeries keeps its datasets to itself
+    datasets = list(getattr(datasets, '_datasets', datasets))
+
+    def render(dataset):
+        """Return the encoded thumbnail of dataset"""
+        im = get_thumbnail_image(dataset, max_size, window, level, method)
+        buf = io.BytesIO()
+        im.save(buf, format, **save_options)
+        return buf.getvalue()
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        thumbnails = list(executor.map(render, datasets))
+    seconds = time.perf_counter() - start
+    if report:
+        print("Rendered %d thumbnails in %.2f s, %.1f images/sec, "
+              "%d KB of %s"
+              % (len(thumbnails), seconds, len(thumbnails) / seconds,
+                 sum(len(thumbnail) for thumbnail in thumbnails) // 1024,
+                 format))
+    return thumbnails
@@ -25,10 +25,15 @@ Usage:
 
 >>> df = pydicom.dcmread(filename)
 >>> pydicom_Tkinter.show_image(df)
+
+Scroll through a series (see input-output/pydicom_series.py) with
+the mouse wheel or the arrow, page, home and end keys:
+>>> series = pydicom_series.read_files(directory)[0]
+>>> pydicom_Tkinter.show_series(series)
 """
 
-import tempfile
-import os
+import collections
+import threading
 import tkinter
 
 have_numpy = True
@@ -38,6 +43,11 @@ except ImportError:
     # will not work...
     have_numpy = False
 
+# pydicom_windowing needs numpy too. It is imported on its own, so
+# that an error in it is reported, not taken for missing numpy
+if have_numpy:
+    import pydicom_windowing
+
 
 def get_PGM_bytedata_string(arr):
     """Given a 2D numpy array as input write
@@ -54,19 +64,49 @@ def get_PGM_bytedata_string(arr):
     if len(arr.shape) != 2:
         raise ValueError
 
-    # array.shape is (#rows, #cols) tuple; PGM input needs this reversed
-    col_row_string = ' '.join(reversed([str(x) for x in arr.shape]))
+    # array.shape is (#rows, #cols) tuple; PGM input needs this reversed.
+    # The maximum grey value is that of the LUT, not of the image,
+    # or the image would be stretched again when shown.
+    header = b'P5\n%d %d\n255\n' % (arr.shape[1], arr.shape[0])
+    return header + arr.tobytes()
+
+
+class PGMBuffers(object):
+    """Work buffers for get_PGM_from_numpy_arr, reused across calls
+
+    Keep one around while showing images of the same size, e.g.
+    the slices of a series, and windowing them allocates nothing
+    the size of an image but the PGM bytes handed to Tk.
+    """
+
+    def __init__(self):
+        self.shape = None
+
+    def get(self, shape):
+        """Return a uint8 pixel array of shape
 
-    bytedata_string = '\n'.join(('P5', col_row_string, str(arr.max()),
-                                 arr.tostring()))
-    return bytedata_string
+        The pixels are laid out after a PGM header in self.pgm,
+        so bytes(self.pgm) is the PGM image.
+        """
+        if shape != self.shape:
+            header = b'P5\n%d %d\n255\n' % (shape[1], shape[0])
+            self.pgm = bytearray(header) + bytearray(shape[0] * shape[1])
+            self.pixels = np.frombuffer(self.pgm, np.uint8, offset=len(header))
+            self.pixels = self.pixels.reshape(shape)
+            self.shape = shape
+        return self.pixels
 
 
 def get_PGM_from_numpy_arr(arr,
                            window_center,
                            window_width,
                            lut_min=0,
-                           lut_max=255):
+                           lut_max=255,
+                           slope=1.0,
+                           intercept=0.0,
+                           buffers=None,
+                           bits_stored=None,
+                           signed=None):
     """real-valued numpy input  ->  PGM-image formatted byte string
 
     arr: real-valued numpy array to display as grayscale image
@@ -74,48 +114,40 @@ def get_PGM_from_numpy_arr(arr,
                                  lookup-table range. WC/WW scaling is done
                                  according to DICOM-3 specifications.
     lut_min, lut_max: min/max values of (PGM-) grayscale table: do not change
+    slope, intercept: rescale arr by these first, as for DICOM
+                      RescaleSlope and RescaleIntercept
+    buffers: PGMBuffers to work in, rather than allocating new arrays
+    bits_stored, signed: DICOM BitsStored and PixelRepresentation == 1
+                         of integer arr, see
+                         pydicom_windowing.apply_window()
+
+    The grey values are those of pydicom_windowing.apply_window(),
+    written straight into the buffers' PGM image; arr itself is
+    left unchanged. Returning the image as bytes, which is what
+    tkinter needs, copies it once.
     """
 
-    if np.isreal(arr).sum() != arr.size:
+    if np.iscomplexobj(arr):
         raise ValueError
 
     # currently only support 8-bit colors
     if lut_max != 255:
         raise ValueError
 
-    if arr.dtype != np.float64:
-        arr = arr.astype(np.float64)
-
-    # LUT-specific array scaling
-    # width >= 1 (DICOM standard)
-    window_width = max(1, window_width)
-
-    wc, ww = np.float64(window_center), np.float64(window_width)
-    lut_range = np.float64(lut_max) - lut_min
-
-    minval = wc - 0.5 - (ww - 1.0) / 2.0
-    maxval = wc - 0.5 + (ww - 1.0) / 2.0
-
-    min_mask = (minval >= arr)
-    to_scale = (arr > minval) & (arr < maxval)
-    max_mask = (arr >= maxval)
-
-    if min_mask.any():
-        arr[min_mask] = lut_min
-    if to_scale.any():
-        arr[to_scale] = ((arr[to_scale] - (wc - 0.5)) /
-                         (ww - 1.0) + 0.5) * lut_range + lut_min
-    if max_mask.any():
-        arr[max_mask] = lut_max
-
-    # round to next integer values and convert to unsigned int
-    arr = np.rint(arr).astype(np.uint8)
+    buffers = buffers or PGMBuffers()
+    pixels = buffers.get(arr.shape)
+    pydicom_windowing.apply_window(arr, window_width, window_center,
+                                   bits_stored, signed, slope, intercept,
+                                   out=pixels)
+    if lut_min:
+        pixels[...] = lut_min + pixels * ((lut_max - lut_min) / 255.0)
 
     # return PGM byte-data string
-    return get_PGM_bytedata_string(arr)
+    return bytes(buffers.pgm)
 
 
-def get_tkinter_photoimage_from_pydicom_image(data):
+def get_tkinter_photoimage_from_pydicom_image(data, photo_image=None,
+                                              buffers=None, arr=None):
     """
     Wrap data.pixel_array in a Tkinter PhotoImage instance,
     after conversion into a PGM grayscale image.
@@ -124,64 +156,50 @@ def get_tkinter_photoimage_from_pydicom_image(data):
     installed in the attempt of creating the data.pixel_array.
 
     data:  object returned from pydicom.dcmread()
-    side effect: may leave a temporary .pgm file on disk
+    photo_image: a PhotoImage, e.g. returned by an earlier call,
+                 to update in place rather than creating a new one.
+                 Labels showing it are redrawn with the new image.
+    buffers: PGMBuffers to reuse, see get_PGM_from_numpy_arr()
+    arr: the pixel array of data, if it has been decoded already
     """
 
     # get numpy array as representation of image data
-    arr = data.pixel_array.astype(np.float64)
+    if arr is None:
+        arr = data.pixel_array
 
     # pixel_array seems to be the original, non-rescaled array.
     # If present, window center and width refer to rescaled array
-    # -> do rescaling if possible.
-    if ('RescaleIntercept' in data) and ('RescaleSlope' in data):
-        intercept = data.RescaleIntercept  # single value
-        slope = data.RescaleSlope
-        arr = slope * arr + intercept
-
-    # get default window_center and window_width values
-    wc = (arr.max() + arr.min()) / 2.0
-    ww = arr.max() - arr.min() + 1.0
-
-    # overwrite with specific values from data, if available
-    if ('WindowCenter' in data) and ('WindowWidth' in data):
-        ew = data['WindowWidth']
-        ec = data['WindowCenter']
-        wc = int(ew.value[0] if ew.VM > 1 else ew.value)
-        ww = int(ec.value[0] if ec.VM > 1 else ec.value)
-    else:
-        wc = (arr.max() + arr.min()) / 2.0
-        ww = arr.max() - arr.min() + 1.0
+    # -> rescale as part of windowing.
+    slope, intercept = pydicom_windowing.get_rescale(data)
+    bits_stored = data.get('BitsStored')
+    signed = data.get('PixelRepresentation', 0) == 1
+
+    # use specific window values from data, if available, or else
+    # the range of the rescaled array, without any bits above
+    # BitsStored
+    window = pydicom_windowing.get_window_level(data)
+    if window is None:
+        window = pydicom_windowing.get_value_range_window(
+            pydicom_windowing.get_stored_values(arr, bits_stored, signed),
+            slope, intercept)
+    ww, wc = window
 
     # scale array to account for center, width and PGM grayscale range,
     # and wrap into PGM formatted ((byte-) string
-    pgm = get_PGM_from_numpy_arr(arr, wc, ww)
-
-    # create a PhotoImage
-    # for as yet unidentified reasons the following fails for certain
-    # window center/width values:
-    #         photo_image = Tkinter.PhotoImage(data=pgm, gamma=1.0)
-    #    Error with Python 2.6.2 under Windows XP:
-    #          (self.tk.call(('image', 'create', imgtype, name,) + options)
-    #          _tkinter.TclError: truncated PPM data
-    #    OsX: distorted images
-    # while all seems perfectly OK for other values of center/width or when
-    # the PGM is first written to a temporary file and read again
-
-    # write PGM file into temp dir
-    (os_id, abs_path) = tempfile.mkstemp(suffix='.pgm')
-    with open(abs_path, 'wb') as fd:
-        fd.write(pgm)
-
-    photo_image = tkinter.PhotoImage(file=abs_path, gamma=1.0)
-
-    # close and remove temporary file on disk
-    # os.close is needed under windows for os.remove not to fail
-    try:
-        os.close(os_id)
-        os.remove(abs_path)
-    except Exception:
-        pass  # silently leave file on disk in temp-like directory
-
+    pgm = get_PGM_from_numpy_arr(arr, wc, ww, slope=slope,
+                                 intercept=intercept, buffers=buffers,
+                                 bits_stored=bits_stored, signed=signed)
+
+    # create a PhotoImage straight from the PGM bytes. Passing the
+    # PGM as a str, as Python 2 did, gave "truncated PPM data" errors
+    # and distorted images for some window center/width values; as
+    # bytes it reaches Tk unchanged, so no temporary file is needed.
+    # tkinter passes only bytes to Tcl as binary data (a memoryview
+    # or bytearray would arrive as its repr), hence the copy made
+    # by get_PGM_from_numpy_arr().
+    if photo_image is None:
+        return tkinter.PhotoImage(data=pgm, format='PPM', gamma=1.0)
+    photo_image.configure(data=pgm, format='PPM', gamma=1.0)
     return photo_image
 
 
@@ -193,8 +211,6 @@ def show_image(data, block=True, master=None):
     block: if True run Tk mainloop() to show the image
     master: use with block==False and an existing
     Tk widget as parent widget
-
-    side effects: may leave a temporary .pgm file on disk
     """
     frame = tkinter.Frame(master=master, background='#000')
     if 'SeriesDescription' in data and 'InstanceNumber' in data:
@@ -213,3 +229,186 @@ def show_image(data, block=True, master=None):
 
     if block:
         frame.mainloop()
+
+
+class SliceCache(object):
+    """A bounded, thread-safe cache of decoded slices by index
+
+    The least recently used slice is dropped to make room.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._slices = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, index):
+        with self._lock:
+            return index in self._slices
+
+    def get(self, index):
+        """Return the slice at index, or None"""
+        with self._lock:
+            arr = self._slices.get(index)
+            if arr is not None:
+                self._slices.move_to_end(index)
+            return arr
+
+    def put(self, index, arr):
+        """Add the slice at index"""
+        with self._lock:
+            self._slices[index] = arr
+            self._slices.move_to_end(index)
+            while len(self._slices) > self.size:
+                self._slices.popitem(last=False)
+
+
+class StackViewer(object):
+    """
+    Minimal Tkinter GUI to scroll through the slices of a series
+
+    Slices are decoded one at a time as they are shown, never the
+    whole volume. While one is on screen a background thread
+    decodes the next few in the direction of travel (and the one
+    before) into a bounded SliceCache, so moving on only has to
+    window an array that is ready. Pixel data read on demand from
+    the files (as pydicom_series.read_files() leaves it) is let go
+    again once decoded, so memory use is bounded by the cache,
+    whatever the length of the series.
+
+    series: a DicomSeries, or a list of datasets in slice order
+    master: an existing Tk widget as parent widget, or None
+    cache_size: number of decoded slices kept
+    prefetch: number of slices decoded ahead
+    """
+
+    def __init__(self, series, master=None, cache_size=32, prefetch=4):
+        # DicomSeries keeps its datasets to itself
+        self.datasets = list(getattr(series, '_datasets', series))
+        if not self.datasets:
+            raise ValueError("No slices to show")
+        self.cache = SliceCache(max(cache_size, prefetch + 2))
+        self.prefetch = prefetch
+        self.index = 0
+        self._direction = 1
+        self._deferred = [self._deferred_pixel_data(ds)
+                          for ds in self.datasets]
+        self._buffers = PGMBuffers()
+        self._photo_image = None
+        self._decode_lock = threading.Lock()
+        self._wanted = []
+        self._wanted_changed = threading.Condition()
+        self._stopped = False
+
+        self.frame = tkinter.Frame(master=master, background='#000')
+        self.label = tkinter.Label(self.frame, background='#000')
+        self.label.grid()
+        self.frame.grid()
+        top = self.frame.winfo_toplevel()
+        top.bind('<MouseWheel>', self._on_wheel)
+        top.bind('<Button-4>', lambda event: self.step(-1))
+        top.bind('<Button-5>', lambda event: self.step(1))
+        for key, step in (('<Up>', -1), ('<Down>', 1), ('<Prior>', -10),
+                          ('<Next>', 10), ('<Home>', -len(self.datasets)),
+                          ('<End>', len(self.datasets))):
+            top.bind(key, lambda event, step=step: self.step(step))
+        self.frame.bind('<Destroy>', lambda event: self.close())
+
+        self._thread = threading.Thread(target=self._prefetch_loop)
+        self._thread.daemon = True
+        self._thread.start()
+        self.show(0)
+
+    @staticmethod
+    def _deferred_pixel_data(ds):
+        """Return the PixelData element of ds if it is still to be
+           read from file, to put back after decoding"""
+        if 'PixelData' not in ds:
+            return None
+        raw = ds.get_item('PixelData', keep_deferred=True)
+        return raw if getattr(raw, 'value', True) is None else None
+
+    def decode(self, index):
+        """Return the pixel array of slice index, decoding it if
+           it isn't cached"""
+        arr = self.cache.get(index)
+        if arr is not None:
+            return arr
+        with self._decode_lock:
+            arr = self.cache.get(index)
+            if arr is None:
+                ds = self.datasets[index]
+                arr = pydicom_windowing.get_frame_values(ds)
+                if self._deferred[index] is not None:
+                    # Own the pixels and let the file's bytes go
+                    if not arr.flags.owndata:
+                        arr = np.array(arr)
+                    ds['PixelData'] = self._deferred[index]
+                self.cache.put(index, arr)
+        return arr
+
+    def show(self, index):
+        """Show slice index"""
+        self.index = max(0, min(index, len(self.datasets) - 1))
+        ds = self.datasets[self.index]
+        self._photo_image = get_tkinter_photoimage_from_pydicom_image(
+            ds, self._photo_image, self._buffers, self.decode(self.index))
+        self.label.configure(image=self._photo_image)
+        self.frame.master.title('Img: %d/%d' % (self.index + 1,
+                                                len(self.datasets)))
+        self._request_prefetch()
+
+    def step(self, step):
+        """Show the slice step slices on"""
+        if step:
+            self._direction = 1 if step > 0 else -1
+        self.show(self.index + step)
+
+    def close(self):
+        """Stop prefetching"""
+        with self._wanted_changed:
+            self._stopped = True
+            self._wanted_changed.notify()
+
+    def _on_wheel(self, event):
+        """Scroll a slice per wheel notch"""
+        self.step(-1 if event.delta > 0 else 1)
+
+    def _request_prefetch(self):
+        """Ask for the slices around the current one to be decoded,
+           nearest first, replacing any earlier request"""
+        ahead = [self.index + self._direction * i
+                 for i in range(1, self.prefetch + 1)]
+        wanted = [index for index in ahead + [self.index - self._direction]
+                  if 0 <= index < len(self.datasets)]
+        with self._wanted_changed:
+            self._wanted = wanted
+            self._wanted_changed.notify()
+
+    def _prefetch_loop(self):
+        """Decode the wanted slices, until closed"""
+        while True:
+            with self._wanted_changed:
+                while not self._wanted and not self._stopped:
+                    self._wanted_changed.wait()
+                if self._stopped:
+                    return
+                index = self._wanted.pop(0)
+            if index not in self.cache:
+                self.decode(index)
+
+
+def show_series(series, block=True, master=None, cache_size=32):
+    """
+    Get minimal Tkinter GUI to scroll through a series
+
+    series: a DicomSeries, or a list of datasets in slice order
+    block: if True run Tk mainloop() to show the images
+    master: use with block==False and an existing
+    Tk widget as parent widget
+    cache_size: number of decoded slices kept, see StackViewer
+    """
+    viewer = StackViewer(series, master, cache_size)
+    if block:
+        viewer.frame.mainloop()
+    return viewer
@@ -0,0 +1,288 @@
+# pydicom_windowing.py
+
+"""Window/level DICOM pixel data to 8-bit grey values with lookup tables
+
+Shared by the viewers in this directory. Rather than evaluating the
+DICOM linear VOI function for every pixel, an 8-bit lookup table is
+built once for each combination of window, level, BitsStored,
+signedness and rescale slope/intercept, covering every value a
+stored pixel can take, and applied with a single np.take(). The
+tables are kept in a small LRU cache, so going back and forth
+between window settings, or rendering a whole series with one
+setting, builds each table only once.
+
+Usage:
+>>> import pydicom
+>>> import pydicom_windowing
+>>> ds = pydicom.dcmread("filename")
+>>> window, level = pydicom_windowing.get_window_level(ds)
+>>> grey = pydicom_windowing.apply_window(ds.pixel_array, window, level,
+...                                        ds.BitsStored,
+...                                        ds.PixelRepresentation == 1)
+
+get_frame_array() gives a single frame of uncompressed pixel data
+as a read-only view of PixelData, without decoding the rest:
+>>> frame = pydicom_windowing.get_frame_array(ds, 10)
+>>> grey = pydicom_windowing.apply_dataset_window(ds, frame)
+
+The lookup tables ignore the bits above BitsStored. Anything else
+working on the values, e.g. averaging them or taking their range,
+needs them cleared or sign extended first, see get_frame_values().
+
+Requires Numpy:
+    http://numpy.scipy.org/
+
+"""
+# This file is part of pydicom, released under an MIT license.
+#    See the file LICENSE included with this distribution, also
+#    available at https://github.com/pydicom/pydicom
+
+import functools
+
+import numpy as np
+import pydicom
+
+# Lookup tables kept, at most 64 KB each
+LUT_CACHE_SIZE = 64
+
+# Stored values wider than this are windowed without a table
+MAX_LUT_BITS = 16
+
+# Pixels looked up at a time; np.take() makes a copy of this many
+# indices, rather than of the whole image
+TAKE_BLOCK_SIZE = 16384
+
+
+def get_window_level(dataset):
+    """Return the first (WindowWidth, WindowCenter) of dataset,
+       or None if it has none."""
+    if ('WindowWidth' not in dataset) or ('WindowCenter' not in dataset):
+        return None
+    ew = dataset['WindowWidth']
+    ec = dataset['WindowCenter']
+    ww = float(ew.value[0] if ew.VM > 1 else ew.value)
+    wc = float(ec.value[0] if ec.VM > 1 else ec.value)
+    return ww, wc
+
+
+def get_rescale(dataset):
+    """Return (RescaleSlope, RescaleIntercept) of dataset, (1, 0)
+       if it has none."""
+    slope = dataset.get('RescaleSlope', 1)
+    intercept = dataset.get('RescaleIntercept', 0)
+    return (float(1 if slope in (None, '') else slope),
+            float(0 if intercept in (None, '') else intercept))
+
+
+def get_frame_array(dataset, frame=0):
+    """Return one frame of dataset's pixel data as a numpy array.
+
+    Uncompressed pixel data is not decoded: the result is a
+    read-only view of the frame's bytes in PixelData, in their
+    byte order and with the sign given by PixelRepresentation.
+    Bits above BitsStored are left as they are, see
+    apply_window(). Rows x columns, with a last axis of samples
+    for colour images. Compressed (or 1-bit) pixel data is
+    decoded by pydicom, one frame only where pydicom can.
+    """
+    frames = int(dataset.get('NumberOfFrames', 1) or 1)
+    if not 0 <= frame < frames:
+        raise IndexError("Frame %d of %d" % (frame, frames))
+    element = dataset['PixelData']
+    bits = dataset.BitsAllocated
+    if element.is_undefined_length or bits not in (8, 16, 32, 64):
+        return _decoded_frame(dataset, frame, frames)
+
+    rows, columns = dataset.Rows, dataset.Columns
+    samples = dataset.get('SamplesPerPixel', 1)
+    kind = 'i' if dataset.get('PixelRepresentation', 0) == 1 else 'u'
+    meta = getattr(dataset, 'file_meta', {})
+    syntax = meta.get('TransferSyntaxUID', pydicom.uid.ImplicitVRLittleEndian)
+    order = '>' if syntax == pydicom.uid.ExplicitVRBigEndian else '<'
+    dtype = np.dtype('%s%s%d' % (order, kind, bits // 8))
+    count = rows * columns * samples
+    arr = np.frombuffer(element.value, dtype, count,
+                        frame * count * dtype.itemsize)
+    if samples == 1:
+        return arr.reshape(rows, columns)
+    if dataset.get('PlanarConfiguration', 0) == 1:
+        return arr.reshape(samples, rows, columns).transpose(1, 2, 0)
+    return arr.reshape(rows, columns, samples)
+
+
+def get_frame_values(dataset, frame=0):
+    """Return one frame of dataset's pixel values as a numpy array.
+
+    Like get_frame_array(), but with the bits above BitsStored
+    cleared, or for signed data sign extended, as pixel_array
+    has them, see get_stored_values(). Use these values where
+    they are added up or compared, e.g. for their range.
+    """
+    return get_stored_values(get_frame_array(dataset, frame),
+                             dataset.get('BitsStored'),
+                             dataset.get('PixelRepresentation', 0) == 1)
+
+
+def get_stored_values(arr, bits_stored=None, signed=None):
+    """Return the values of arr's low bits_stored bits.
+
+    The bits above bits_stored, which may hold overlays or
+    anything else, are cleared, or for signed data replaced
+    by copies of the sign bit. signed defaults to that of
+    arr's type. arr is returned as it is when it has no bits
+    above bits_stored, otherwise a new array.
+    """
+    if arr.dtype.kind not in 'ui':
+        return arr
+    width = 8 * arr.dtype.itemsize
+    if bits_stored is None or bits_stored >= width:
+        return arr
+    if signed is None:
+        signed = arr.dtype.kind == 'i'
+    if not signed:
+        return np.bitwise_and(arr, (1 << bits_stored) - 1)
+    if arr.dtype.kind == 'u':
+        arr = arr.view(arr.dtype.str.replace('u', 'i'))
+    shift = width - bits_stored
+    values = np.left_shift(arr, shift)
+    np.right_shift(values, shift, out=values)
+    return values
+
+
+def _decoded_frame(dataset, frame, frames):
+    """Return frame of dataset as pydicom decodes it"""
+    pixels = getattr(pydicom, 'pixels', None)
+    if hasattr(pixels, 'pixel_array'):
+        return pixels.pixel_array(dataset, index=frame)
+    arr = dataset.pixel_array
+    return arr[frame] if frames > 1 else arr
+
+
+def apply_dataset_window(dataset, arr, window=None, level=None, out=None):
+    """Window/level arr, pixel data of dataset, into uint8 grey values.
+
+    The rescale and VOI of the dataset are applied in a single
+    pass through one lookup table. window and level override the
+    dataset's, and default to the range of arr's values if the
+    dataset has none, taken without the bits above BitsStored.
+    """
+    slope, intercept = get_rescale(dataset)
+    bits_stored = dataset.get('BitsStored')
+    signed = dataset.get('PixelRepresentation', 0) == 1
+    if window is None or level is None:
+        window_level = get_window_level(dataset)
+        if window_level is None:
+            window_level = get_value_range_window(
+                get_stored_values(arr, bits_stored, signed), slope,
+                intercept)
+        window, level = window_level
+    return apply_window(arr, window, level, bits_stored, signed,
+                        slope, intercept, out)
+
+
+def get_value_range_window(arr, slope=1.0, intercept=0.0):
+    """Return the (window, level) spanning the rescaled values of arr"""
+    low = float(arr.min()) * slope + intercept
+    high = float(arr.max()) * slope + intercept
+    low, high = min(low, high), max(low, high)
+    return high - low + 1, (high + low + 1) / 2.0
+
+
+@functools.lru_cache(maxsize=LUT_CACHE_SIZE)
+def get_LUT(window, level, bits_stored, signed, slope=1.0, intercept=0.0):
+    """Return the uint8 lookup table for stored pixel values.
+
+    The table has 2 ** bits_stored entries, indexed by the stored
+    value modulo that size, so negative values of signed data
+    index it from the end as np.take(..., mode='wrap') does.
+    The result is read only, as it is shared between callers.
+    """
+    size = 1 << bits_stored
+    values = np.arange(size, dtype=np.float64)
+    if signed:
+        values[size // 2:] -= size
+    lut = _linear_window(values, window, level, slope, intercept)
+    lut.flags.writeable = False
+    return lut
+
+
+@functools.lru_cache(maxsize=LUT_CACHE_SIZE)
+def _get_wide_LUT(window, level, bits_stored, signed, slope, intercept,
+                  width):
+    """Return get_LUT()'s table repeated to 2 ** width entries, to
+       be indexed by the unsigned width-bit values of the pixels"""
+    lut = np.tile(get_LUT(window, level, bits_stored, signed, slope,
+                          intercept), 1 << (width - bits_stored))
+    lut.flags.writeable = False
+    return lut
+
+
+def apply_window(arr, window, level, bits_stored=None, signed=None,
+                 slope=1.0, intercept=0.0, out=None):
+    """Window/level arr into a uint8 array of grey values.
+
+    arr holds stored pixel values, which are rescaled with slope
+    and intercept before window and level (in rescaled units)
+    are applied, as DICOM PS3.3 C.11.2.1.2 describes for LINEAR
+    VOI. bits_stored and signed default to those of the array's
+    integer type; bits above bits_stored are ignored. Arrays of
+    floats, or of integers too wide for a lookup table, are
+    windowed directly. out, a uint8 array of arr's shape, saves
+    allocating the result; with it, integer arrays of up to 16
+    bits are windowed without allocating anything the size of
+    the image.
+    """
+    if arr.dtype.kind in 'ui':
+        width = 8 * arr.dtype.itemsize
+        if bits_stored is None:
+            bits_stored = width
+        if signed is None:
+            signed = arr.dtype.kind == 'i'
+        if bits_stored <= MAX_LUT_BITS:
+            table = (float(window), float(level), int(bits_stored),
+                     bool(signed), float(slope), float(intercept))
+            if not bits_stored <= width <= MAX_LUT_BITS:
+                return _take(get_LUT(*table), arr, 'wrap', out)
+            # Every index is in the table, and wraps as it should
+            lut = _get_wide_LUT(*table, width=width)
+            return _take(lut, arr.view(arr.dtype.str.replace('i', 'u')),
+                         'clip', out)
+    grey = _linear_window(arr, window, level, slope, intercept)
+    if out is None:
+        return grey
+    out[...] = grey
+    return out
+
+
+def _take(lut, indices, mode, out=None):
+    """Return np.take(lut, indices, mode=mode, out=out), taken
+       TAKE_BLOCK_SIZE pixels at a time"""
+    if out is None:
+        out = np.empty(indices.shape, np.uint8)
+    if indices.ndim < 2:
+        return np.take(lut, indices, mode=mode, out=out)
+    step = max(1, TAKE_BLOCK_SIZE // max(1, indices[0].size))
+    for start in range(0, len(indices), step):
+        np.take(lut, indices[start:start + step], mode=mode,
+                out=out[start:start + step])
+    return out
+
+
+def _linear_window(values, window, level, slope, intercept):
+    """Apply the DICOM linear VOI function to values, returning uint8.
+
+    Below level - 0.5 - (window - 1) / 2 values are black, above
+    level - 0.5 + (window - 1) / 2 white, and linear in between,
+    so the linear function clipped to 0-255.
+    """
+    window = max(float(window), 1.0)
+    grey = np.multiply(values, slope, dtype=np.float64)
+    grey += intercept - (level - 0.5)
+    if window == 1.0:
+        # A step at level - 0.5
+        return np.where(grey > 0, 255, 0).astype(np.uint8)
+    grey /= window - 1
+    grey += 0.5
+    grey *= 255.0
+    np.clip(grey, 0, 255, out=grey)
+    return grey.astype(np.uint8)
@@ -0,0 +1,36 @@
+"""
+Tests for imViewer_Simple's image preparation, which touches no
+GUI. wxPython has to be installed, but no display is needed.
+
+run with
+python -m pytest test_imViewer_Simple.py
+
+"""
+# This file is part of pydicom, released under an MIT license.
+#    See the file LICENSE included with this distribution, also
+#    available at https://github.com/pydicom/pydicom
+
+import numpy as np
+import pytest
+
+from test_pydicom_windowing import make_dataset
+
+pytest.importorskip('wx')
+import imViewer_Simple  # noqa: E402
+
+
+@pytest.mark.parametrize('signed', [False, True])
+def test_prepare_image_ignores_bits_above_bits_stored(signed):
+    if signed:
+        values = np.array([[-2048, -1000], [0, 2047]], np.int16)
+        stored = values & 0xfff  # Not sign extended
+    else:
+        values = np.array([[0, 1000], [2000, 4095]], np.uint16)
+        stored = values | 0xf000  # e.g. overlay bits
+    ds = make_dataset(stored.astype(values.dtype)[np.newaxis], 12, signed)
+    ds.RescaleSlope, ds.RescaleIntercept = 2, -10
+    arr, colour, rescale, window, step = imViewer_Simple.prepare_image(ds)
+    low, high = int(values.min()), int(values.max())
+    assert not colour and rescale == (2, -10)
+    assert window == (2 * (high - low) + 1, low + high - 10 + 0.5)
+    assert step == 2 * (high - low) / 512.0
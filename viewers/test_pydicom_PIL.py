@@ -0,0 +1,77 @@
+"""
+Tests for pydicom_PIL's image and thumbnail functions. No display
+is needed.
+
+run with
+python -m pytest test_pydicom_PIL.py
+
+"""
+# This file is part of pydicom, released under an MIT license.
+#    See the file LICENSE included with this distribution, also
+#    available at https://github.com/pydicom/pydicom
+
+import numpy as np
+import pytest
+
+import pydicom_PIL
+from test_pydicom_windowing import make_dataset
+
+
+def test_reduce_array_mean():
+    arr = np.arange(7 * 9, dtype=np.uint16).reshape(7, 9)
+    reduced = pydicom_PIL.reduce_array(arr, 3)
+    # Leftover rows and columns are dropped
+    assert reduced.shape == (2, 3) and reduced.dtype == np.uint16
+    assert reduced[0, 0] == arr[:3, :3].mean()
+    assert reduced[1, 2] == arr[3:6, 6:9].mean()
+
+
+def test_reduce_array_rounds_integer_means_down():
+    arr = np.array([[0, 1], [1, 1]], np.int16)
+    assert pydicom_PIL.reduce_array(arr, 2)[0, 0] == 0
+    arr = -arr
+    assert pydicom_PIL.reduce_array(arr, 2)[0, 0] == -1
+    assert pydicom_PIL.reduce_array(arr.astype(float), 2)[0, 0] == -0.75
+
+
+def test_reduce_array_stride():
+    arr = np.arange(7 * 9).reshape(7, 9)
+    reduced = pydicom_PIL.reduce_array(arr, 3, 'stride')
+    assert np.array_equal(reduced, arr[::3, ::3])
+    assert np.shares_memory(reduced, arr)
+
+
+def test_reduce_array_keeps_samples():
+    arr = np.arange(4 * 4 * 3, dtype=np.uint8).reshape(4, 4, 3)
+    reduced = pydicom_PIL.reduce_array(arr, 2)
+    assert reduced.shape == (2, 2, 3)
+    assert np.array_equal(reduced[0, 0], arr[:2, :2].reshape(4, 3).mean(0)
+                          .astype(np.uint8))
+
+
+def test_reduce_array_factor_one_and_unknown_method():
+    arr = np.zeros((4, 4))
+    assert pydicom_PIL.reduce_array(arr, 1) is arr
+    with pytest.raises(ValueError):
+        pydicom_PIL.reduce_array(arr, 2, 'median')
+
+
+@pytest.mark.parametrize('method', ['mean', 'stride'])
+def test_thumbnail_of_data_with_bits_above_bits_stored(method):
+    # 12-bit signed values, not sign extended, and the same values
+    # sign extended as pydicom's pixel_array has them
+    values = np.tile(np.arange(-2048, 2048, 16, dtype=np.int16), (64, 1))
+    dirty = make_dataset((values & 0xfff)[np.newaxis], 12, True)
+    clean = make_dataset(values[np.newaxis], 12, True)
+    expected = np.asarray(pydicom_PIL.get_thumbnail_image(clean, 32,
+                                                          method=method))
+    image = pydicom_PIL.get_thumbnail_image(dirty, 32, method=method)
+    assert np.array_equal(np.asarray(image), expected)
+    # The range of the values, so a ramp from black to white
+    assert expected.min() == 0 and expected.max() >= 254
+    # Unsigned, the overlay bits are ignored
+    dirty = make_dataset((values & 0xfff | 0x5000)[np.newaxis], 12)
+    clean = make_dataset((values & 0xfff)[np.newaxis], 12)
+    assert np.array_equal(
+        np.asarray(pydicom_PIL.get_thumbnail_image(dirty, 32, method=method)),
+        np.asarray(pydicom_PIL.get_thumbnail_image(clean, 32, method=method)))
@@ -0,0 +1,148 @@
+"""
+Tests for the PGM images pydicom_Tkinter hands to Tk. No display
+is needed.
+
+run with
+python -m pytest test_pydicom_Tkinter.py
+
+"""
+# This file is part of pydicom, released under an MIT license.
+#    See the file LICENSE included with this distribution, also
+#    available at https://github.com/pydicom/pydicom
+
+import threading
+import tracemalloc
+
+import numpy as np
+import pytest
+
+import pydicom_Tkinter
+import pydicom_windowing
+from test_pydicom_windowing import linear_window, make_dataset
+
+
+def split_pgm(pgm):
+    """ Return (header, pixels) of a PGM image of 8-bit pixels """
+    fields = bytes(pgm).split(b'\n', 3)
+    assert fields[0] == b'P5' and fields[2] == b'255'
+    columns, rows = map(int, fields[1].split())
+    pixels = np.frombuffer(fields[3], np.uint8)
+    assert pixels.size == rows * columns
+    return b'\n'.join(fields[:3]) + b'\n', pixels.reshape(rows, columns)
+
+
+def test_get_PGM_bytedata_string():
+    arr = np.arange(6, dtype=np.uint8).reshape(2, 3)
+    pgm = pydicom_Tkinter.get_PGM_bytedata_string(arr)
+    header, pixels = split_pgm(pgm)
+    assert header == b'P5\n3 2\n255\n'
+    assert np.array_equal(pixels, arr)
+    with pytest.raises(ValueError):
+        pydicom_Tkinter.get_PGM_bytedata_string(arr.astype(np.uint16))
+
+
+def test_get_PGM_from_numpy_arr():
+    arr = np.array([[-1000, -50, 40], [130, 1000, 3000]], np.int16)
+    arr.flags.writeable = False  # It is left unchanged
+    header, pixels = split_pgm(
+        pydicom_Tkinter.get_PGM_from_numpy_arr(arr, 40, 81))
+    assert header == b'P5\n3 2\n255\n'
+    assert list(pixels.ravel()) == [0, 0, 129, 255, 255, 255]
+
+
+@pytest.mark.parametrize('window, level', [(400, 40), (1, 0), (4096, 1000),
+                                           (2.5, -3)])
+def test_get_PGM_from_numpy_arr_matches_apply_window(window, level):
+    arr = np.arange(-2048, 2048, 8, dtype=np.int16).reshape(4, -1)
+    expected = pydicom_windowing.apply_window(arr, window, level, slope=1.5,
+                                              intercept=-20)
+    for values in (arr, arr.astype(np.float64)):
+        pgm = pydicom_Tkinter.get_PGM_from_numpy_arr(
+            values, level, window, slope=1.5, intercept=-20)
+        assert type(pgm) is bytes
+        assert np.array_equal(split_pgm(pgm)[1], expected)
+    # 12-bit values, not sign extended
+    pgm = pydicom_Tkinter.get_PGM_from_numpy_arr(
+        (arr & 0xfff).astype(np.int16), level, window, slope=1.5,
+        intercept=-20, bits_stored=12, signed=True)
+    assert np.array_equal(split_pgm(pgm)[1], expected)
+
+
+def test_get_PGM_from_numpy_arr_rescales():
+    arr = np.array([[0, 100]], np.uint16)
+    pgm = pydicom_Tkinter.get_PGM_from_numpy_arr(arr, 0, 1, slope=2,
+                                                 intercept=-100)
+    # Window width 1 is a step at the level
+    assert list(split_pgm(pgm)[1].ravel()) == [0, 255]
+
+
+def test_PGM_buffers_are_reused():
+    buffers = pydicom_Tkinter.PGMBuffers()
+    first = np.zeros((4, 5), np.uint8)
+    pgm = pydicom_Tkinter.get_PGM_from_numpy_arr(first, 0, 10,
+                                                 buffers=buffers)
+    pixels = buffers.pixels
+    second = np.full((4, 5), 100, np.uint8)
+    pgm2 = pydicom_Tkinter.get_PGM_from_numpy_arr(second, 0, 10,
+                                                  buffers=buffers)
+    assert buffers.pixels is pixels
+    assert split_pgm(pgm)[0] == split_pgm(pgm2)[0] == b'P5\n5 4\n255\n'
+    assert split_pgm(pgm2)[1].min() == 255
+    # A new size gets new buffers
+    pydicom_Tkinter.get_PGM_from_numpy_arr(np.zeros((2, 2)), 0, 10,
+                                           buffers=buffers)
+    assert buffers.pixels.shape == (2, 2)
+
+
+def test_PGM_is_copied_once():
+    arr = np.tile(np.arange(-1024, 3072, dtype=np.int16), (256, 1))
+    buffers = pydicom_Tkinter.PGMBuffers()
+    pydicom_Tkinter.get_PGM_from_numpy_arr(arr, 40, 400, buffers=buffers)
+    tracemalloc.start()
+    pgm = pydicom_Tkinter.get_PGM_from_numpy_arr(arr, 40, 400,
+                                                 buffers=buffers)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    # The bytes handed back, and no more than a fraction of another
+    assert len(pgm) < peak < 1.5 * len(pgm)
+
+
+class FakePhotoImage(object):
+    """ Stands in for tkinter.PhotoImage, keeping the PGM it gets """
+
+    def __init__(self, data, format, gamma):
+        self.data = data
+
+
+def stack_viewer(datasets):
+    """ Return a StackViewer of datasets that can decode, without Tk """
+    viewer = pydicom_Tkinter.StackViewer.__new__(pydicom_Tkinter.StackViewer)
+    viewer.datasets = datasets
+    viewer.cache = pydicom_Tkinter.SliceCache(4)
+    viewer._deferred = [None] * len(datasets)
+    viewer._decode_lock = threading.Lock()
+    return viewer
+
+
+def test_stack_viewer_shows_12_bit_signed_data(monkeypatch):
+    monkeypatch.setattr(pydicom_Tkinter.tkinter, 'PhotoImage',
+                        FakePhotoImage)
+    values = np.array([[-2048, -1000, -1], [0, 1500, 2047]], np.int16)
+    # 12-bit two's complement, not sign extended to 16 bits
+    ds = make_dataset((values & 0xfff)[np.newaxis], 12, True)
+    ds.NumberOfFrames = 1
+    expected = pydicom_Tkinter.get_tkinter_photoimage_from_pydicom_image(
+        ds, arr=values).data
+    # The whole range, black to white
+    assert np.array_equal(split_pgm(expected)[1],
+                          linear_window(values, 4096, 0))
+    assert pydicom_Tkinter.get_tkinter_photoimage_from_pydicom_image(
+        ds).data == expected
+    arr = stack_viewer([ds]).decode(0)
+    assert np.array_equal(arr, values)
+    assert pydicom_Tkinter.get_tkinter_photoimage_from_pydicom_image(
+        ds, arr=arr).data == expected
+    # Raw stored values are windowed the same
+    raw = pydicom_windowing.get_frame_array(ds)
+    assert pydicom_Tkinter.get_tkinter_photoimage_from_pydicom_image(
+        ds, arr=raw).data == expected
@@ -0,0 +1,238 @@
+"""
+Tests for pydicom_windowing, on small datasets made up in memory
+and on pydicom's test files. No display is needed.
+
+run with
+python -m pytest test_pydicom_windowing.py
+
+"""
+# This file is part of pydicom, released under an MIT license.
+#    See the file LICENSE included with this distribution, also
+#    available at https://github.com/pydicom/pydicom
+
+import tracemalloc
+
+import numpy as np
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+from pydicom.dataset import Dataset, FileMetaDataset
+
+import pydicom_windowing
+
+
+def make_dataset(frames, bits_stored=None, signed=False, samples=1,
+                 syntax=pydicom.uid.ExplicitVRLittleEndian):
+    """ Return a dataset with frames, an array of (frames,) rows,
+        columns (, samples), as its pixel data """
+    frames = np.asarray(frames)
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = syntax
+    ds.NumberOfFrames = frames.shape[0]
+    ds.Rows, ds.Columns = frames.shape[1:3]
+    ds.SamplesPerPixel = samples
+    ds.PhotometricInterpretation = 'MONOCHROME2' if samples == 1 else 'RGB'
+    if samples > 1:
+        ds.PlanarConfiguration = 0
+    ds.BitsAllocated = 8 * frames.dtype.itemsize
+    ds.BitsStored = bits_stored or ds.BitsAllocated
+    ds.HighBit = ds.BitsStored - 1
+    ds.PixelRepresentation = 1 if signed else 0
+    order = '>' if syntax == pydicom.uid.ExplicitVRBigEndian else '<'
+    ds.PixelData = frames.astype(frames.dtype.newbyteorder(order)).tobytes()
+    return ds
+
+
+def linear_window(values, window, level, slope=1.0, intercept=0.0):
+    """ The DICOM LINEAR VOI function (PS3.3 C.11.2.1.2), value by
+        value, truncated to 8 bits """
+    grey = []
+    for value in np.ravel(values):
+        x = float(value) * slope + intercept
+        if window <= 1:
+            grey.append(255 if x > level - 0.5 else 0)
+            continue
+        y = ((x - (level - 0.5)) / (window - 1) + 0.5) * 255
+        grey.append(int(min(max(y, 0), 255)))
+    return np.array(grey, np.uint8).reshape(np.shape(values))
+
+
+def test_get_LUT_covers_every_stored_value():
+    lut = pydicom_windowing.get_LUT(256.0, 128.0, 8, False)
+    assert lut.shape == (256,) and lut.dtype == np.uint8
+    assert not lut.flags.writeable
+    assert np.array_equal(lut, linear_window(np.arange(256), 256, 128))
+    # Tables are cached
+    assert pydicom_windowing.get_LUT(256.0, 128.0, 8, False) is lut
+
+
+def test_get_LUT_puts_negative_values_last():
+    lut = pydicom_windowing.get_LUT(400.0, 40.0, 12, True, 1.0, -10.0)
+    values = np.r_[np.arange(2048), np.arange(-2048, 0)]
+    assert np.array_equal(lut, linear_window(values, 400, 40, 1.0, -10.0))
+
+
+@pytest.mark.parametrize('window, level', [(400, 40), (1, 0), (4096, 1000),
+                                           (2.5, -3)])
+def test_apply_window_matches_the_DICOM_function(window, level):
+    arr = np.arange(-1024, 3072, 7, dtype=np.int16).reshape(2, -1)
+    expected = linear_window(arr, window, level, 1.5, -20)
+    grey = pydicom_windowing.apply_window(arr, window, level, slope=1.5,
+                                          intercept=-20)
+    assert np.array_equal(grey, expected)
+    # Floats are windowed directly, to the same result
+    grey = pydicom_windowing.apply_window(arr.astype(np.float32), window,
+                                          level, slope=1.5, intercept=-20)
+    assert np.array_equal(grey, expected)
+
+
+def test_apply_window_ignores_bits_above_bits_stored():
+    values = np.array([0, 1, 2047, 4095], np.uint16)
+    expected = linear_window(values, 4096, 2048)
+    dirty = values | np.uint16(0xf000)  # e.g. overlay bits
+    grey = pydicom_windowing.apply_window(dirty, 4096, 2048, 12, False)
+    assert np.array_equal(grey, expected)
+
+
+def test_apply_window_sign_extends_signed_values():
+    values = np.array([-2048, -1000, -1, 0, 1500, 2047], np.int16)
+    expected = linear_window(values, 2500, 250)
+    # 12-bit two's complement, not sign extended to 16 bits
+    stored = (values & 0xfff).astype(np.int16)
+    for arr in (values, stored):
+        grey = pydicom_windowing.apply_window(arr, 2500, 250, 12, True)
+        assert np.array_equal(grey, expected)
+
+
+def test_apply_window_writes_to_out():
+    arr = np.arange(16, dtype=np.uint8).reshape(4, 4)
+    out = np.empty(arr.shape, np.uint8)
+    assert pydicom_windowing.apply_window(arr, 16, 8, out=out) is out
+    assert np.array_equal(out, linear_window(arr, 16, 8))
+
+
+@pytest.mark.parametrize('dtype', ['<i2', '>i2', '<u2', '<i4'])
+def test_apply_window_on_views_spanning_blocks(dtype, monkeypatch):
+    monkeypatch.setattr(pydicom_windowing, 'TAKE_BLOCK_SIZE', 50)
+    values = np.arange(-2048, 2048, dtype=np.int32).reshape(64, 64)
+    arr = (values & 0xfff).astype(dtype)[3:60:2, 50:1:-3]
+    out = np.empty(arr.shape, np.uint8)
+    grey = pydicom_windowing.apply_window(arr, 1000, 100, 12,
+                                          dtype[1] == 'i', out=out)
+    assert grey is out
+    expected = values[3:60:2, 50:1:-3]
+    if dtype[1] == 'u':
+        expected = expected & 0xfff
+    assert np.array_equal(grey, linear_window(expected, 1000, 100))
+
+
+def test_apply_window_does_not_copy_the_image():
+    arr = np.arange(-1024, 3072, dtype=np.int16).reshape(64, 64)
+    arr = np.tile(arr, (8, 8))
+    out = np.empty(arr.shape, np.uint8)
+    pydicom_windowing.apply_window(arr, 400, 40, 12, True, out=out)
+    tracemalloc.start()
+    pydicom_windowing.apply_window(arr, 400, 40, 12, True, out=out)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert peak < out.nbytes
+
+
+def test_get_value_range_window():
+    arr = np.array([10, 20, 15])
+    assert pydicom_windowing.get_value_range_window(arr) == (11, 15.5)
+    assert pydicom_windowing.get_value_range_window(arr, 2, -5) == \
+        (21, 25.5)
+    # A negative slope swaps the ends
+    assert pydicom_windowing.get_value_range_window(arr, -1) == (11, -14.5)
+
+
+@pytest.mark.parametrize('syntax', [pydicom.uid.ExplicitVRLittleEndian,
+                                    pydicom.uid.ExplicitVRBigEndian])
+@pytest.mark.parametrize('signed', [False, True])
+def test_get_frame_array_multi_frame(syntax, signed):
+    dtype = np.int16 if signed else np.uint16
+    frames = np.arange(3 * 4 * 5, dtype=dtype).reshape(3, 4, 5) - 20 * signed
+    ds = make_dataset(frames, signed=signed, syntax=syntax)
+    for index, frame in enumerate(frames):
+        arr = pydicom_windowing.get_frame_array(ds, index)
+        assert arr.dtype.kind == ('i' if signed else 'u')
+        assert np.array_equal(arr, frame)
+        # A view of PixelData, not a copy
+        assert not arr.flags.writeable and not arr.flags.owndata
+    with pytest.raises(IndexError):
+        pydicom_windowing.get_frame_array(ds, 3)
+
+
+def test_get_frame_array_colour():
+    frames = np.arange(2 * 4 * 5 * 3, dtype=np.uint8).reshape(2, 4, 5, 3)
+    ds = make_dataset(frames, samples=3)
+    assert np.array_equal(pydicom_windowing.get_frame_array(ds, 1),
+                          frames[1])
+    # Planar: all the reds, then the greens, then the blues
+    ds.PlanarConfiguration = 1
+    ds.PixelData = frames.transpose(0, 3, 1, 2).tobytes()
+    assert np.array_equal(pydicom_windowing.get_frame_array(ds, 1),
+                          frames[1])
+
+
+@pytest.mark.parametrize('name', ['MR_small_RLE.dcm', 'rtdose_rle.dcm'])
+def test_get_frame_array_decodes_compressed_frames(name):
+    ds = pydicom.dcmread(get_testdata_file(name, download=False))
+    frames = int(ds.get('NumberOfFrames', 1) or 1)
+    expected = ds.pixel_array.reshape((frames,) + ds.pixel_array.shape[-2:])
+    for index in (0, frames - 1):
+        assert np.array_equal(pydicom_windowing.get_frame_array(ds, index),
+                              expected[index])
+
+
+def test_apply_dataset_window_uses_the_dataset_window():
+    frames = np.arange(-8, 8, dtype=np.int16).reshape(1, 4, 4)
+    ds = make_dataset(frames, signed=True)
+    ds.WindowCenter, ds.WindowWidth = [10, 20], [5, 50]
+    ds.RescaleSlope, ds.RescaleIntercept = 2, 10
+    arr = pydicom_windowing.get_frame_array(ds)
+    assert np.array_equal(pydicom_windowing.apply_dataset_window(ds, arr),
+                          linear_window(arr, 5, 10, 2, 10))
+    assert np.array_equal(
+        pydicom_windowing.apply_dataset_window(ds, arr, 100, 0),
+        linear_window(arr, 100, 0, 2, 10))
+
+
+def test_get_stored_values():
+    values = np.array([-2048, -1000, -1, 0, 1500, 2047], np.int16)
+    stored = (values & 0xfff).astype(np.int16)  # Not sign extended
+    assert np.array_equal(
+        pydicom_windowing.get_stored_values(stored, 12, True), values)
+    assert np.array_equal(
+        pydicom_windowing.get_stored_values(stored.view(np.uint16), 12,
+                                            True), values)
+    # Unsigned values lose the bits above, e.g. overlays
+    dirty = np.array([0x0001, 0xf7ff, 0x8fff], np.uint16)
+    assert list(pydicom_windowing.get_stored_values(dirty, 12, False)) == \
+        [1, 0x7ff, 0xfff]
+    # Nothing to do, nothing copied
+    assert pydicom_windowing.get_stored_values(values, 16, True) is values
+    assert pydicom_windowing.get_stored_values(values) is values
+
+
+def test_get_frame_values_match_pixel_array():
+    values = np.array([[-2048, -1000, -1], [0, 1500, 2047]], np.int16)
+    for syntax in (pydicom.uid.ExplicitVRLittleEndian,
+                   pydicom.uid.ExplicitVRBigEndian):
+        ds = make_dataset((values & 0xfff)[np.newaxis], 12, True,
+                          syntax=syntax)
+        ds.NumberOfFrames = 1
+        assert np.array_equal(ds.pixel_array, values)
+        assert np.array_equal(pydicom_windowing.get_frame_values(ds),
+                              values)
+
+
+def test_apply_dataset_window_range_ignores_high_bits():
+    values = np.array([[-1000, 0], [500, 1500]], np.int16)
+    ds = make_dataset((values & 0xfff)[np.newaxis], 12, True)
+    expected = linear_window(values, 2501, 250.5)
+    arr = pydicom_windowing.get_frame_array(ds)
+    assert np.array_equal(pydicom_windowing.apply_dataset_window(ds, arr),
+                          expected)